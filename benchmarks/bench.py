@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# offline benchmarks of the bot's hot paths
+# everything runs on synthetic data (chunks, templates, pixel updates) and a recorded api/me response,
+# nothing is downloaded
+#
+# python benchmarks/bench.py                       run everything
+# python benchmarks/bench.py --quick               smaller inputs, shorter runs
+# python benchmarks/bench.py --save base.json      save the results
+# python benchmarks/bench.py --compare base.json   compare with saved results
+
+import sys, os.path as path
+import json, time, socket, argparse, platform, tracemalloc, threading
+
+BENCH_DIR = path.dirname(path.abspath(__file__))
+ROOT_DIR = path.dirname(BENCH_DIR)
+
+# the benchmarks must never touch the network
+def no_network(*args, **kwargs):
+    raise RuntimeError('the benchmarks must not use the network')
+socket.socket.connect = no_network
+socket.create_connection = no_network
+
+sys.path.insert(0, ROOT_DIR)
+import numpy as np
+import ppfun2
+
+# don't print event summaries in the middle of the results
+ppfun2.SUMMARY_INTERVAL = 1e9
+
+# a chunk loader that serves synthetic chunks instead of downloading them
+class OfflineChunkLoader(ppfun2.ChunkLoader):
+    def __init__(self, chunks):
+        super().__init__(None)
+        self.synthetic = chunks
+
+    def fetch(self, d, x, y, max_age=0):
+        data = self.synthetic.get((x, y), b'')
+        self._store((d, x, y), ppfun2.CachedChunk(bytearray(data), None, None, time.time()))
+        return data
+
+# random raw chunk data: palette indices, some of them protected
+def synthetic_chunk(rng, n_colors):
+    data = rng.integers(0, n_colors, ppfun2.CHUNK_BYTES, dtype=np.uint8)
+    data[rng.random(ppfun2.CHUNK_BYTES) < 0.05] |= ppfun2.PROTECTED_BIT
+    return data.tobytes()
+
+# a synthetic BGRA template: smooth gradients (many distinct colors) with transparent holes
+def synthetic_image(rng, size):
+    ys, xs = np.mgrid[0:size, 0:size]
+    img = np.empty((size, size, 4), np.uint8)
+    img[:, :, 0] = xs * 255 // max(size - 1, 1)
+    img[:, :, 1] = ys * 255 // max(size - 1, 1)
+    img[:, :, 2] = (xs + ys) % 256
+    img[:, :, 3] = np.where(rng.random((size, size)) < 0.1, 0, 255)
+    return img
+
+# a burst of 0xC1 pixel update frames, each one for a single chunk
+def synthetic_updates(rng, chunks, n_frames, per_frame, n_colors):
+    frames = []
+    for n in range(n_frames):
+        i, j = chunks[n % len(chunks)]
+        offs = rng.integers(0, ppfun2.CHUNK_BYTES, per_frame)
+        entries = np.stack((offs >> 16, (offs >> 8) & 0xFF, offs & 0xFF,
+                            rng.integers(0, n_colors, per_frame)), axis=1).astype(np.uint8)
+        frames.append(bytes([ppfun2.OP_PIXEL_UPDATE, i, j]) + entries.tobytes())
+    return frames
+
+# runs fn repeatedly for at least min_time seconds
+# returns the throughput in items per second, the time per run and the peak traced memory of one run
+def measure(fn, items, min_time):
+    # the first run fills caches (palette lookups etc.) that later runs reuse
+    fn()
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    runs, start = 0, time.perf_counter()
+    while True:
+        fn()
+        runs += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+    return {'items_per_s': items * runs / elapsed, 'sec_per_run': elapsed / runs, 'peak_bytes': peak, 'runs': runs}
+
+# sets up the globals the bot normally sets up in main()
+def setup_bot(me, canv_desc, chunks):
+    ppfun2.me = me
+    class Cfg: canv_id = 0
+    class C: image = Cfg
+    ppfun2.config = C
+    ppfun2.chunk_loader = OfflineChunkLoader(chunks)
+    ppfun2.canvas_store = ppfun2.CanvasStore(0, canv_desc['size'])
+    ppfun2.templates = []
+    ppfun2.preview = None
+    ppfun2.pipeline = ppfun2.PlacementPipeline()
+
+# yields (stage, name, fn, items, unit) for every benchmark
+def benchmarks(me, quick):
+    rng = np.random.default_rng(1)
+    canv_desc = me['canvases']['0']
+    n_colors = len(canv_desc['colors'])
+    sizes = [64, 512] if quick else [64, 512, 2048]
+    # a square of chunks around the center of the canvas
+    side = 4 if quick else 8
+    base = canv_desc['size'] // 2 // ppfun2.CHUNK_SIZE
+    keys = [(base + i, base + j) for j in range(side) for i in range(side)]
+    chunks = {key: synthetic_chunk(rng, n_colors) for key in keys}
+    setup_bot(me, canv_desc, chunks)
+
+    # chunk decoding
+    raw = list(chunks.values())
+    arr = np.empty((ppfun2.CHUNK_SIZE, ppfun2.CHUNK_SIZE), np.uint8)
+    prot = np.empty((ppfun2.CHUNK_SIZE, ppfun2.CHUNK_SIZE), np.bool_)
+    def decode():
+        for data in raw:
+            ppfun2.decode_chunk(data, arr, prot)
+    yield 'chunks', 'decode_chunk', decode, len(raw) * ppfun2.CHUNK_BYTES, 'px'
+    yield 'chunks', 'get_chunk', lambda: [ppfun2.get_chunk(0, i, j) for i, j in keys], \
+        len(keys) * ppfun2.CHUNK_BYTES, 'px'
+    def store_load():
+        store = ppfun2.CanvasStore(0, canv_desc['size'])
+        store.load(keys)
+        store.view(0, 0, side * ppfun2.CHUNK_SIZE, side * ppfun2.CHUNK_SIZE)
+    yield 'chunks', f'CanvasStore load+view {side}x{side}', store_load, len(keys) * ppfun2.CHUNK_BYTES, 'px'
+
+    # template quantization
+    images = {size: synthetic_image(rng, size) for size in sizes}
+    for size, img in images.items():
+        for metric in ppfun2.COLOR_METRICS:
+            yield 'quantize', f'quantize_image {size}x{size} {metric}', \
+                lambda img=img, metric=metric: ppfun2.quantize_image(img, canv_desc, metric), size * size, 'px'
+        yield 'quantize', f'quantize_image {size}x{size} rgb lut5', \
+            lambda img=img: ppfun2.quantize_image(img, canv_desc, 'rgb', lut_bits=5), size * size, 'px'
+
+    # rendering
+    region = ppfun2.canvas_store.view(0, 0, side * ppfun2.CHUNK_SIZE, side * ppfun2.CHUNK_SIZE).copy()
+    region[rng.random(region.shape) < 0.1] = 255
+    yield 'render', f'render_map {region.shape[1]}x{region.shape[0]}', \
+        lambda: ppfun2.render_map(0, region), region.size, 'px'
+
+    # planning the order of the pixels to draw
+    for size in sizes[-2:]:
+        color_idxs = ppfun2.quantize_image(images[size], canv_desc)
+        # (the contested strategy needs the overwrite counts)
+        t = ppfun2.Template(color_idxs, 0, 0, canv_desc, strategy='contested')
+        canvas = rng.integers(0, n_colors, color_idxs.shape, dtype=np.uint8)
+        def mismatched(t=t, canvas=canvas):
+            return t.damage.mismatched(canvas)
+        yield 'plan', f'mismatched {size}x{size}', mismatched, size * size, 'px'
+        mask = mismatched()
+        for name, strategy in ppfun2.STRATEGIES.items():
+            def plan(strategy=strategy, mask=mask, t=t):
+                stream = strategy.plan(mask, t.damage)
+                # take a few pixels, some strategies do their work lazily
+                for _ in range(100):
+                    stream.next()
+            yield 'plan', f'plan {name} {size}x{size}', plan, int(mask.sum()), 'px'
+
+    # 0xC1 pixel updates
+    frames = synthetic_updates(rng, keys, 200 if quick else 1000, 32, n_colors)
+    n_updates = sum((len(f) - ppfun2.PIXEL_UPDATE_HEADER) // ppfun2.PIXEL_UPDATE_ENTRY for f in frames)
+    yield 'updates', 'decode_pixel_updates', lambda: ppfun2.decode_pixel_updates(frames), n_updates, 'updates'
+    ppfun2.canvas_store.pin(keys)
+    ppfun2.canvas_store.load(keys)
+    size = side * ppfun2.CHUNK_SIZE
+    x0 = base * ppfun2.CHUNK_SIZE - canv_desc['size'] // 2
+    cond = threading.Condition()
+    ppfun2.templates = [ppfun2.Template(ppfun2.quantize_image(synthetic_image(rng, size), canv_desc),
+                                        x0, x0, canv_desc, cond=cond)]
+    def apply_updates():
+        ppfun2.dispatch_messages(frames)
+        for t in ppfun2.templates:
+            t.damage.queue.clear()
+            t.damage.queued[:] = False
+    yield 'updates', 'dispatch_messages 0xC1', apply_updates, n_updates, 'updates'
+
+def human(value, unit):
+    for prefix in ['', 'K', 'M', 'G']:
+        if abs(value) < 1000:
+            return f'{value:7.2f} {prefix}{unit}'
+        value /= 1000
+    return f'{value:7.2f} T{unit}'
+
+def human_bytes(value):
+    for prefix in ['B', 'KiB', 'MiB', 'GiB']:
+        if value < 1024:
+            return f'{value:7.1f} {prefix}'
+        value /= 1024
+    return f'{value:7.1f} TiB'
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Offline benchmarks of the ppfun2 hot paths')
+    parser.add_argument('--quick', action='store_true', help='smaller inputs and shorter runs')
+    parser.add_argument('--min-time', metavar='SEC', type=float, help='how long to run every benchmark for')
+    parser.add_argument('--filter', metavar='TEXT', help='only run benchmarks with TEXT in their name')
+    parser.add_argument('--save', metavar='FILE', help='save the results to FILE')
+    parser.add_argument('--compare', metavar='FILE', help='compare the results with the ones saved in FILE')
+    parser.add_argument('--tolerance', metavar='PCT', type=float, default=20,
+        help='exit with an error if a benchmark is this much slower than the saved one (default: 20)')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    min_time = args.min_time if args.min_time is not None else (0.2 if args.quick else 1.0)
+    with open(path.join(BENCH_DIR, 'fixtures', 'me.json')) as f:
+        me = json.load(f)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+
+    results = {}
+    regressions = []
+    for stage, name, fn, items, unit in benchmarks(me, args.quick):
+        if args.filter and args.filter not in name:
+            continue
+        result = measure(fn, items, min_time)
+        result.update(stage=stage, unit=unit)
+        results[name] = result
+        line = (f'{stage:9} {name:36} {human(result["items_per_s"], unit + "/s")} ' +
+                f'{result["sec_per_run"] * 1000:10.3f} ms/run  peak {human_bytes(result["peak_bytes"])}')
+        old = baseline.get(name) if baseline is not None else None
+        if old is not None:
+            change = (result['items_per_s'] / old['items_per_s'] - 1) * 100
+            line += f'  {change:+6.1f}%'
+            if change < -args.tolerance:
+                regressions.append(name)
+                line += ' SLOWER'
+        print(line, flush=True)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'meta': {
+                'time':     time.strftime('%Y-%m-%d %H:%M:%S'),
+                'python':   platform.python_version(),
+                'numpy':    np.__version__,
+                'platform': platform.platform(),
+                'quick':    args.quick,
+            }, 'results': results}, f, indent=2)
+        print(f'Results saved to {args.save}')
+    if len(regressions) > 0:
+        print(f'{len(regressions)} benchmark(s) got slower by more than {args.tolerance}%: ' + ', '.join(regressions))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
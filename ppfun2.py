@@ -5,12 +5,20 @@
 
 not_inst_libs = []
 
-import sys, threading
-import json, pickle
-import time, datetime, math, random
-import os.path as path, getpass
+import sys, threading, asyncio, subprocess
+import json, pickle, struct, base64
+import socket, ssl, urllib.parse, argparse, http.server
+from queue import Queue, Empty
+import time, datetime, math, random, heapq, bisect
+import io, zlib, mmap, cProfile, pstats, signal
+import os, os.path as path, getpass, hashlib, tempfile, importlib, importlib.util
+from collections import OrderedDict, deque
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # URLs of various files
+SERVER_URL = 'https://pixelplanet.fun'
+WS_URL     = 'wss://pixelplanet.fun:443/ws'
 BOT_URL    = 'https://raw.githubusercontent.com/portasynthinca3/ppfun2/master/ppfun2.py'
 VERDEF_URL = 'https://raw.githubusercontent.com/portasynthinca3/ppfun2/master/verdef'
 SOUND_URL  = 'https://raw.githubusercontent.com/portasynthinca3/ppfun2/master/notif.wav'
@@ -20,27 +28,19 @@ try:
 except ImportError:
     not_inst_libs.append('requests')
 
-try:
-    import pyaudio
-    import wave
-except ImportError:
-    not_inst_libs.append('PyAudio')
+# pyaudio and cv2 take a while to import and are only needed for some things,
+# so they are only looked for here and imported by lazy_import() when they're first used
+# (pyaudio is optional, it's only needed for the sound notifications)
+pyaudio, wave, cv2 = None, None, None
 
 try:
     import numpy as np
 except ImportError:
     not_inst_libs.append('numpy')
 
-try:
-    import cv2
-except ImportError:
+if importlib.util.find_spec('cv2') is None:
     not_inst_libs.append('opencv-python')
 
-try:
-    import websocket
-except ImportError:
-    not_inst_libs.append('websocket_client')
-
 try:
     from colorama import Fore, Back, Style, init
 except ImportError:
@@ -51,21 +51,38 @@ if len(not_inst_libs) > 0:
     print('Some libraries are not installed. Install them by running this command:\npip install ' + ' '.join(not_inst_libs))
     exit()
 
+# imports a module the first time it's needed and makes it a global
+def lazy_import(name):
+    module = globals()[name]
+    if module is None:
+        module = globals()[name] = importlib.import_module(name)
+    return module
+
 def download_file(url):
     local_filename = url.split('/')[-1]
-    r = sess.get(url, stream=True)
-    with open(local_filename, 'wb') as f:
+    r = sess.get(url, stream=True, timeout=30)
+    with open(local_filename + '.tmp', 'wb') as f:
         for chunk in r.iter_content(chunk_size=1024): 
             if chunk:
                 f.write(chunk)
+    os.replace(local_filename + '.tmp', local_filename)
     return local_filename
 
-# check the presence of the sound notification file
-if not path.exists('notif.wav'):
-    print('notif.wav is not present, downloading...')
-    download_file(SOUND_URL)
+# downloads the sound notification file if it's not there
+def fetch_notification_sound():
+    if not path.exists('notif.wav'):
+        console.print('notif.wav is not present, downloading...')
+        try:
+            download_file(SOUND_URL)
+        except requests.RequestException as e:
+            console.print(f'{Fore.RED}Failed to download notif.wav: {e}{Style.RESET_ALL}')
 
 me, thr, ws = {}, None, None
+chunk_loader = None
+# the templates being drawn
+templates = []
+# the live preview, if enabled
+preview = None
 
 # the version of the bot
 VERSION          = '1.1.16'
@@ -73,13 +90,14 @@ VERSION_NUM      = 17
 VERSION_DATE     = 'Oct. 22, 2021'
 VERSION_FEATURES = '  - proper status indication (thanks to Rem-u)'
 
-# are we allowed to draw
-draw = True
-# was the last placement of a pixel successful
-succ = False
+# the placement pipeline
+pipeline = None
+
+# the canvas tiles we care about
+canvas_store = None
 
-# chunk data cache
-chunk_data = None
+# the event stream recorder, if enabled
+recorder = None
 
 # number of pixels drawn and the starting time
 pixels_drawn = 1
@@ -101,289 +119,3315 @@ class PpfunConfigImage(object):
         self.path = ''
         self.x = 0
         self.y = 0
+        self.z = 0
         self.defend = False
         self.strategy = ''
+        self.metric = 'rgb'
+        self.priority = 0
         self.canv_id = 0
 class PpfunConfig(object):
     def __init__(self):
         self.auth  = PpfunConfigAuth()
         self.proxy = PpfunConfigProxy()
         self.image = PpfunConfigImage()
+        # all templates, the first one is the same as "image"
+        self.images = [self.image]
 
 config = None
 
-# play a notification sound
-def play_notification():
-    wf = wave.open('notif.wav', 'rb')
-    pa = pyaudio.PyAudio()
-    stream = pa.open(format=pa.get_format_from_width(wf.getsampwidth()),
-                     channels=wf.getnchannels(),
-                     rate=wf.getframerate(),
-                     output=True)
-    data = wf.readframes(128)
-    while len(data) > 0:
-        stream.write(data)
-        data = wf.readframes(128)
-
-    stream.stop_stream()
-    stream.close()
-    pa.terminate()
+# how often summaries of frequent events are printed, in seconds
+SUMMARY_INTERVAL = 5
+
+# prints messages on a background thread, so that the hot loops never wait for the terminal
+# frequent events (pixel updates, placements) are only counted and printed as periodic summaries
+class Console(object):
+    def __init__(self):
+        self.queue = Queue()
+        self.lock = threading.Lock()
+        # event counts since the last summary and the latest fields of every event kind
+        self.counts = {}
+        self.latest = {}
+        self.last_summary = time.time()
+        self.json_file = None
+        self.thread = None
+        # set by close(), lines are printed right away from then on
+        self.closed = False
+
+    # also write every event and summary to a file as JSON lines
+    def open_json(self, file_path):
+        self.json_file = open(file_path, 'a', buffering=1)
+
+    def _start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='Console', daemon=True)
+                self.thread.start()
+
+    # prints a line (or a prompt with end='')
+    def print(self, text, end='\n'):
+        if self.closed:
+            print(text, end=end, flush=True)
+            return
+        self._start()
+        self.queue.put(('text', text + end))
+
+    # waits until everything that's queued has been printed
+    def flush(self):
+        if self.thread is not None and not self.closed:
+            self.queue.join()
+        sys.stdout.flush()
+
+    # prints what's queued and stops the thread, called on exit
+    def close(self):
+        self.flush()
+        self.closed = True
+        if self.thread is not None:
+            self.queue.put(('stop', None))
+            self.thread.join()
+        if self.json_file is not None:
+            self.json_file.flush()
+
+    # records an event, or n events of the same kind at once (written as one JSON line)
+    def event(self, kind, n=1, **fields):
+        self._start()
+        with self.lock:
+            self.counts[kind] = self.counts.get(kind, 0) + n
+            self.latest[kind] = fields
+        if self.json_file is not None:
+            if n != 1:
+                fields = dict(n=n, **fields)
+            self.queue.put(('json', dict(t=time.time(), event=kind, **fields)))
+
+    def _rate(self, counts, kind, elapsed):
+        return counts.get(kind, 0) / elapsed
+
+    def _summary(self):
+        now = time.time()
+        with self.lock:
+            counts, latest = self.counts, dict(self.latest)
+            self.counts = {}
+        elapsed = max(now - self.last_summary, 1e-6)
+        self.last_summary = now
+        if len(counts) == 0:
+            return
+        placed, failed = counts.get('placed', 0), counts.get('failed', 0)
+        summary = {
+            'updates_per_s':    round(self._rate(counts, 'update', elapsed), 2),
+            'placements_per_s': round(self._rate(counts, 'placed', elapsed), 2),
+            'success_ratio':    round(placed / (placed + failed), 3) if placed + failed > 0 else None,
+        }
+        text = (f'{Fore.YELLOW}Updates: {Fore.GREEN}{summary["updates_per_s"]}/s' +
+                f'{Fore.YELLOW}, placements: {Fore.GREEN}{summary["placements_per_s"]}/s')
+        if summary['success_ratio'] is not None:
+            text += f'{Fore.YELLOW}, success: {Fore.GREEN}{summary["success_ratio"] * 100:.0f}%'
+        if 'online' in latest:
+            summary['online'] = latest['online']['count']
+            text += f'{Fore.YELLOW}, online: {Fore.GREEN}{summary["online"]}'
+        if 'place' in latest:
+            summary['progress'] = latest['place'].get('progress')
+            summary['eta'] = latest['place'].get('eta')
+            if summary['progress'] is not None:
+                text += f'{Fore.YELLOW}, progress: {Fore.GREEN}{summary["progress"]:2.4f}%'
+                text += f'{Fore.YELLOW}, ETA: {Fore.GREEN}{datetime.timedelta(seconds=summary["eta"])}'
+        print(text + Style.RESET_ALL)
+        if self.json_file is not None:
+            self.json_file.write(json.dumps(dict(t=now, event='summary', **summary)) + '\n')
+
+    def _run(self):
+        while True:
+            timeout = self.last_summary + SUMMARY_INTERVAL - time.time()
+            try:
+                kind, item = self.queue.get(timeout=max(timeout, 0))
+            except Empty:
+                kind = None
+            if kind == 'stop':
+                self.queue.task_done()
+                return
+            if kind is not None:
+                try:
+                    if kind == 'text':
+                        print(item, end='', flush=True)
+                    elif self.json_file is not None:
+                        self.json_file.write(json.dumps(item) + '\n')
+                finally:
+                    self.queue.task_done()
+            if time.time() >= self.last_summary + SUMMARY_INTERVAL:
+                self._summary()
+
+console = Console()
+
+# prints a prompt (after everything that's queued) and reads the answer
+def ask(prompt):
+    console.print(prompt, end='')
+    console.flush()
+    return input()
+
+# the same, but the answer isn't shown
+def ask_secret(prompt):
+    console.flush()
+    return getpass.getpass(prompt)
+
+# all metrics: name -> (type, description). exported with a "ppfun2_" prefix
+METRIC_DEFS = OrderedDict([
+    ('placements_total',          ('counter',   'Pixel placement replies by return code')),
+    ('place_rtt_seconds',         ('histogram', 'Time from sending a placement to its 0xC3 reply')),
+    ('place_wait_seconds',        ('histogram', 'Time spent waiting for the pipeline before placing a pixel')),
+    ('cooldown_seconds_total',    ('counter',   'Time spent waiting out the cooldown')),
+    ('cooldown_ms',               ('gauge',     'The total cooldown last reported by the server')),
+    ('chunk_fetch_seconds',       ('histogram', 'Chunk download latency')),
+    ('chunk_fetches_total',       ('counter',   'Chunk requests by HTTP status ("cached" if no request was made)')),
+    ('updates_total',             ('counter',   'Pixel updates received')),
+    ('update_apply_seconds',      ('histogram', 'Time spent applying a batch of pixel updates')),
+    ('defend_wait_seconds_total', ('counter',   'Time spent waiting for damaged pixels in defend mode')),
+    ('defend_backlog',            ('gauge',     'Damaged pixels waiting to be fixed')),
+    ('reconnects_total',          ('counter',   'Connections to the server after the first one')),
+    ('resync_chunks_total',       ('counter',   'Chunks downloaded again after reconnecting')),
+])
+# upper bounds of the histogram buckets, in seconds
+METRIC_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# counters, gauges and histograms of what the bot is doing
+class Metrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (name, labels) -> value, or [bucket counts, sum, count] for histograms
+        self.values = {}
+        # name -> function that returns the current value of a gauge
+        self.callbacks = {}
+
+    def inc(self, name, n=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + n
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[(name, tuple(sorted(labels.items())))] = value
+
+    # makes a gauge report whatever fn returns when the metrics are collected
+    def set_callback(self, name, fn):
+        self.callbacks[name] = fn
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            hist = self.values.get(key)
+            if hist is None:
+                hist = self.values[key] = [[0] * (len(METRIC_BUCKETS) + 1), 0.0, 0]
+            hist[0][bisect.bisect_left(METRIC_BUCKETS, value)] += 1
+            hist[1] += value
+            hist[2] += 1
+
+    # all metrics in the Prometheus text format
+    def render(self):
+        with self.lock:
+            values = {key: ([list(v[0]), v[1], v[2]] if isinstance(v, list) else v) for key, v in self.values.items()}
+        for name, fn in self.callbacks.items():
+            try:
+                values[(name, ())] = fn()
+            except Exception:
+                pass
+        def fmt(labels):
+            return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}' if len(labels) > 0 else ''
+        lines = []
+        for name, (kind, text) in METRIC_DEFS.items():
+            full = 'ppfun2_' + name
+            lines += [f'# HELP {full} {text}', f'# TYPE {full} {kind}']
+            for (n, labels), value in sorted(values.items(), key=lambda kv: str(kv[0])):
+                if n != name:
+                    continue
+                if kind != 'histogram':
+                    lines.append(f'{full}{fmt(labels)} {value}')
+                    continue
+                counts, total, count = value
+                cumulative = 0
+                for bound, c in zip(METRIC_BUCKETS + ('+Inf',), counts):
+                    cumulative += c
+                    lines.append(f'{full}_bucket{fmt(labels + (("le", bound),))} {cumulative}')
+                lines.append(f'{full}_sum{fmt(labels)} {total}')
+                lines.append(f'{full}_count{fmt(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+# a cProfile run of a thread that's been requested
+class ProfileRequest(object):
+    def __init__(self, seconds):
+        self.profile = cProfile.Profile()
+        self.seconds = seconds
+        self.end = None
+        # why the profiler couldn't be started
+        self.error = None
+        self.done = threading.Event()
+
+# runs cProfile in other threads at runtime
+# cProfile only sees the thread it's enabled in, so the threads call hook() from their main loops
+# and start and stop the profiler themselves
+# only one thread is profiled at a time (Python 3.12+ refuses to run two profilers at once)
+class ThreadProfiler(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        # thread name -> ProfileRequest
+        self.requests = {}
+
+    # profiles a thread for a while
+    # returns an HTTP status code and the statistics as text (or what went wrong)
+    def profile(self, thread_name, seconds):
+        request = ProfileRequest(seconds)
+        with self.lock:
+            if len(self.requests) > 0:
+                return 409, 'another thread is already being profiled\n'
+            self.requests[thread_name] = request
+        if not request.done.wait(seconds + 10):
+            with self.lock:
+                if request.end is None:
+                    self.requests.pop(thread_name, None)
+                    return 503, f'thread "{thread_name}" is not running\n'
+            # it's stopped by the thread the next time it calls hook()
+            return 503, f'thread "{thread_name}" didn\'t finish profiling in time\n'
+        if request.error is not None:
+            return 500, f'failed to start the profiler: {request.error}\n'
+        out = io.StringIO()
+        pstats.Stats(request.profile, stream=out).sort_stats('cumulative').print_stats(40)
+        return 200, out.getvalue()
+
+    def hook(self):
+        if len(self.requests) == 0:
+            return
+        name = threading.current_thread().name
+        with self.lock:
+            request = self.requests.get(name)
+            if request is None:
+                return
+            now = time.monotonic()
+            if request.end is None:
+                # a failure is reported to whoever asked for the profile, the thread goes on
+                try:
+                    request.profile.enable()
+                except (ValueError, RuntimeError) as e:
+                    request.error = str(e) or type(e).__name__
+                    del self.requests[name]
+                    request.done.set()
+                    return
+                request.end = now + request.seconds
+                return
+            if now < request.end:
+                return
+            request.profile.disable()
+            del self.requests[name]
+        request.done.set()
+
+profiler = ThreadProfiler()
+
+# how often the sampling profiler looks at the stacks, in seconds
+SAMPLE_INTERVAL = 0.005
+
+# samples the stacks of all threads for a while
+# returns "thread;function;function count" lines (the format flame graph tools take), most frequent first
+def sample_stacks(seconds, interval=SAMPLE_INTERVAL):
+    counts = {}
+    own = threading.get_ident()
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            key = ';'.join([names.get(ident, str(ident))] + stack[::-1])
+            counts[key] = counts.get(key, 0) + 1
+        time.sleep(interval)
+    return '\n'.join(f'{k} {v}' for k, v in sorted(counts.items(), key=lambda kv: -kv[1])) + '\n'
+
+# serves the metrics and the profilers:
+# /metrics                                  Prometheus metrics
+# /debug/sample?seconds=10                  stack samples of all threads
+# /debug/cprofile?seconds=10&thread=NAME    cProfile statistics of a thread (one at a time, 409 if busy)
+#                                           ("Drawing thread" by default, "MainThread" processes messages)
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        u = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(u.query))
+        try:
+            seconds = float(query.get('seconds', 10))
+        except ValueError:
+            seconds = 10
+        code, content_type = 200, 'text/plain; charset=utf-8'
+        if u.path == '/metrics':
+            body = metrics.render()
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        elif u.path == '/debug/sample':
+            body = sample_stacks(seconds)
+        elif u.path == '/debug/cprofile':
+            thread_name = query.get('thread', 'Drawing thread')
+            code, body = profiler.profile(thread_name, seconds)
+        else:
+            code, body = 404, 'not found\n'
+        body = body.encode()
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+# starts the metrics endpoint on a background thread, only reachable from this machine
+def start_metrics_server(port):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='Metrics', daemon=True).start()
+    return server
+
+# alerts of the same kind are merged into one for this many seconds
+NOTIFY_COALESCE = 30
+
+# plays the notification sound
+# the file is decoded and the audio device is opened once, not on every alert
+class SoundSink(object):
+    name = 'sound'
+
+    def __init__(self, file_path='notif.wav'):
+        self.file_path = file_path
+        self.pa = None
+        self.frames = None
+
+    def prepare(self):
+        if importlib.util.find_spec('pyaudio') is None:
+            raise RuntimeError('PyAudio is not installed (pip install PyAudio), use --notify to choose other notifications')
+        if not path.exists(self.file_path):
+            raise RuntimeError(f'{self.file_path} is not there, choose a WAV file with --sound FILE')
+        lazy_import('pyaudio')
+        lazy_import('wave')
+        with wave.open(self.file_path, 'rb') as wf:
+            self.params = (wf.getsampwidth(), wf.getnchannels(), wf.getframerate())
+            frames = wf.readframes(wf.getnframes())
+        self.pa = pyaudio.PyAudio()
+        self.frames = frames
+
+    def notify(self, title, text):
+        if self.frames is None:
+            # notif.wav might not have been downloaded yet at startup
+            self.prepare()
+        width, channels, rate = self.params
+        stream = self.pa.open(format=self.pa.get_format_from_width(width), channels=channels, rate=rate, output=True)
+        stream.write(self.frames)
+        stream.stop_stream()
+        stream.close()
+
+# shows a desktop notification
+class DesktopSink(object):
+    name = 'desktop'
+
+    def prepare(self):
+        if sys.platform.startswith('linux'):
+            self.command = lambda title, text: ['notify-send', title, text]
+        elif sys.platform == 'darwin':
+            self.command = lambda title, text: ['osascript', '-e',
+                f'display notification {json.dumps(text)} with title {json.dumps(title)}']
+        elif sys.platform == 'win32':
+            self.command = lambda title, text: ['msg', '*', f'{title}: {text}']
+        else:
+            raise RuntimeError(f'desktop notifications are not supported on {sys.platform}')
+
+    def notify(self, title, text):
+        subprocess.run(self.command(title, text), timeout=10, check=True,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+# posts the notification to a webhook (the payload works with Discord and Slack webhooks)
+class WebhookSink(object):
+    name = 'webhook'
+
+    def __init__(self, url):
+        self.url = url
+
+    def prepare(self):
+        pass
+
+    def notify(self, title, text):
+        requests.post(self.url, json={'content': f'**{title}**: {text}', 'text': f'{title}: {text}',
+            'title': title}, timeout=10).raise_for_status()
+
+# prints the notification (and writes it to the JSON log)
+class LogSink(object):
+    name = 'log'
+
+    def prepare(self):
+        pass
+
+    def notify(self, title, text):
+        console.print(f'{Fore.RED}[{title}] {text}{Style.RESET_ALL}')
+        console.event('notification', title=title, text=text)
+
+# tells the user about things that need their attention
+# alerts are delivered by a worker thread, so that nobody waits for the sinks,
+# and repeated alerts of the same kind are merged
+class Notifier(object):
+    def __init__(self, sinks, coalesce=NOTIFY_COALESCE):
+        self.sinks = sinks
+        self.coalesce = coalesce
+        self.queue = Queue()
+        # kind -> when it was last delivered, and how many alerts have been merged since
+        self.delivered = {}
+        self.merged = {}
+        # kind -> the latest alert that hasn't been delivered because of the merging
+        self.latest = OrderedDict()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    # (it's started both by the notification setup and by the first alert)
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='Notifier', daemon=True)
+                self.thread.start()
+
+    # queues an alert, returns immediately
+    def notify(self, kind, title, text):
+        self.start()
+        self.queue.put((kind, title, text))
+
+    def _deliver(self, title, text):
+        for sink in self.sinks:
+            try:
+                sink.notify(title, text)
+            except Exception as e:
+                console.print(f'{Fore.RED}Failed to deliver a {sink.name} notification: {e}{Style.RESET_ALL}')
+
+    def _run(self):
+        # sound decoding etc. happens here and not when the first alert comes
+        for sink in self.sinks:
+            try:
+                sink.prepare()
+            except Exception as e:
+                console.print(f'{Fore.RED}The {sink.name} notifications are not available: {e}{Style.RESET_ALL}')
+        while True:
+            # everything that's queued at the moment,
+            # waiting for alerts at most until the merged ones can be delivered
+            due = [self.delivered[kind] + self.coalesce for kind in self.latest]
+            alerts = []
+            try:
+                alerts.append(self.queue.get(timeout=max(min(due) - time.monotonic(), 0) if len(due) > 0 else None))
+            except Empty:
+                pass
+            while not self.queue.empty():
+                alerts.append(self.queue.get_nowait())
+            for kind, title, text in alerts:
+                self.latest[kind] = (title, text)
+                self.merged[kind] = self.merged.get(kind, 0) + 1
+            now = time.monotonic()
+            for kind, (title, text) in list(self.latest.items()):
+                if now - self.delivered.get(kind, -self.coalesce) < self.coalesce:
+                    continue
+                if self.merged[kind] > 1:
+                    text += f' ({self.merged[kind]} times)'
+                self.delivered[kind] = now
+                self.merged[kind] = 0
+                del self.latest[kind]
+                self._deliver(title, text)
+
+# notification sinks by name
+NOTIFY_SINKS = ['sound', 'desktop', 'webhook', 'log']
+
+# creates the notification sinks chosen on the command line
+def make_sinks(names, webhook_url=None, sound_path='notif.wav'):
+    sinks = []
+    for name in names:
+        if name == 'sound':
+            sinks.append(SoundSink(sound_path))
+        elif name == 'desktop':
+            sinks.append(DesktopSink())
+        elif name == 'log':
+            sinks.append(LogSink())
+        elif name == 'webhook':
+            if not webhook_url:
+                console.print(f'{Fore.RED}The webhook notifications need --webhook URL{Style.RESET_ALL}')
+            else:
+                sinks.append(WebhookSink(webhook_url))
+        else:
+            console.print(f'{Fore.RED}Unknown notification type: {name}{Style.RESET_ALL}')
+    if webhook_url and 'webhook' not in names:
+        sinks.append(WebhookSink(webhook_url))
+    return sinks
+
+notifier = Notifier([SoundSink()])
 
 # shows the image in a window
 def show_image(img):
-    print(f'{Fore.YELLOW}Scroll to zoom, drag to pan, press any key to close the window{Style.RESET_ALL}')
+    lazy_import('cv2')
+    console.print(f'{Fore.YELLOW}Scroll to zoom, drag to pan, press any key to close the window{Style.RESET_ALL}')
     cv2.imshow('image', img)
     cv2.waitKey(0)
     cv2.destroyAllWindows()
 
-# gets raw chunk data from the server
+# chunk dimensions
+CHUNK_SIZE  = 256
+CHUNK_BYTES = CHUNK_SIZE * CHUNK_SIZE
+# protected pixels are shifted up by 128
+PROTECTED_BIT = 0x80
+# voxel (3D) canvases are made of chunks of THREE_TILE_SIZE x THREE_TILE_SIZE columns, THREE_CANVAS_HEIGHT voxels high
+# a voxel chunk is indexed [y][z][x], y being the height: offset = y * THREE_TILE_SIZE^2 + z * THREE_TILE_SIZE + x
+# chunk X comes from the X coordinate and chunk Y from the Z one
+THREE_TILE_SIZE     = 32
+THREE_CANVAS_HEIGHT = 128
+THREE_CHUNK_BYTES   = THREE_TILE_SIZE * THREE_TILE_SIZE * THREE_CANVAS_HEIGHT
+
+# the shape of the decoded chunks of a canvas
+def chunk_shape(canv_desc):
+    if 'v' in canv_desc:
+        return (THREE_CANVAS_HEIGHT, THREE_TILE_SIZE, THREE_TILE_SIZE)
+    return (CHUNK_SIZE, CHUNK_SIZE)
+
+# decodes raw chunk data into the provided color index and protection planes
+# (both are expected to be chunk-sized views, usually into a bigger region array, or voxel chunk volumes)
+def decode_chunk(data, out, prot_out=None):
+    if len(data) != out.size:
+        # an empty chunk is sent as an empty (or otherwise short) response
+        out[:] = 0
+        if prot_out is not None:
+            prot_out[:] = False
+        return
+    # zero-copy view of the response bytes
+    raw = np.frombuffer(data, np.uint8).reshape(out.shape)
+    np.bitwise_and(raw, PROTECTED_BIT - 1, out=out)
+    if prot_out is not None:
+        np.greater_equal(raw, PROTECTED_BIT, out=prot_out)
+
+# how many chunks are downloaded at the same time
+CHUNK_WORKERS = 8
+# how many raw chunks are kept in memory
+CHUNK_CACHE_SIZE = 256
+# chunks that were downloaded less than this many seconds ago are not downloaded again
+CHUNK_MAX_AGE = 60
+
+# a raw chunk kept by the chunk loader
+class CachedChunk(object):
+    def __init__(self, data, etag, last_modified, fetched_at):
+        self.data = data
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched_at = fetched_at
+
+# downloads chunks concurrently and keeps the recently used ones in memory
+class ChunkLoader(object):
+    def __init__(self, session, base_url=SERVER_URL, workers=CHUNK_WORKERS, capacity=CHUNK_CACHE_SIZE):
+        self.session = session
+        self.base_url = base_url.rstrip('/')
+        self.capacity = capacity
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='Chunk loader')
+        self.chunks = OrderedDict()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        # chunks that are being downloaded -> [how many downloads, the updates received in the meantime]
+        self.loading = {}
+        # the size of a chunk of the canvas, for patching empty chunks
+        self.chunk_bytes = CHUNK_BYTES
+
+    # each worker gets its own session with the same settings as the main one
+    def _session(self):
+        sess = getattr(self.local, 'sess', None)
+        if sess is None:
+            sess = requests.Session()
+            sess.headers.update(self.session.headers)
+            sess.proxies.update(self.session.proxies)
+            sess.cookies.update(self.session.cookies)
+            self.local.sess = sess
+        return sess
+
+    def _lookup(self, key):
+        with self.lock:
+            entry = self.chunks.get(key)
+            if entry is not None:
+                self.chunks.move_to_end(key)
+            return entry
+
+    # the updates received while downloading a chunk are applied to it too,
+    # the download may have been made before them
+    def _store(self, key, entry):
+        with self.lock:
+            for offs, c in self.loading.get(key, [0, []])[1]:
+                self._patch(entry, offs, c)
+            self.chunks[key] = entry
+            self.chunks.move_to_end(key)
+            while len(self.chunks) > self.capacity:
+                self.chunks.popitem(last=False)
+
+    # returns the raw data of a chunk
+    # a stored copy younger than max_age seconds is returned as is,
+    # an older one is revalidated with a conditional request
+    def fetch(self, d, x, y, max_age=0):
+        key = (d, x, y)
+        entry = self._lookup(key)
+        now = time.time()
+        if entry is not None and now - entry.fetched_at < max_age:
+            metrics.inc('chunk_fetches_total', status='cached')
+            return bytes(entry.data)
+
+        headers = {}
+        if entry is not None:
+            if entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                headers['If-Modified-Since'] = entry.last_modified
+        with self.lock:
+            self.loading.setdefault(key, [0, []])[0] += 1
+        try:
+            start = time.perf_counter()
+            r = self._session().get(f'{self.base_url}/chunks/{d}/{x}/{y}.bmp', headers=headers, timeout=30)
+            metrics.observe('chunk_fetch_seconds', time.perf_counter() - start)
+            metrics.inc('chunk_fetches_total', status=r.status_code)
+            if r.status_code == 304 and entry is not None:
+                data = entry.data
+            elif r.status_code == 200:
+                data = bytearray(r.content)
+            else:
+                # an error page is not an empty chunk
+                r.raise_for_status()
+                raise requests.HTTPError(f'unexpected status {r.status_code} of chunk {d}/{x}/{y}', response=r)
+            if recorder is not None:
+                recorder.chunk(d, x, y, data)
+            entry = CachedChunk(data, r.headers.get('ETag'), r.headers.get('Last-Modified'), now)
+            self._store(key, entry)
+        finally:
+            with self.lock:
+                loading = self.loading[key]
+                loading[0] -= 1
+                if loading[0] == 0:
+                    del self.loading[key]
+        with self.lock:
+            return bytes(entry.data)
+
+    # same as fetch(), but asynchronous
+    def submit(self, d, x, y, max_age=0):
+        return self.pool.submit(self.fetch, d, x, y, max_age)
+
+    def _patch(self, entry, offs, c):
+        if len(entry.data) != self.chunk_bytes:
+            # empty chunks are sent without any data
+            entry.data = bytearray(self.chunk_bytes)
+        offs = offs & (self.chunk_bytes - 1)
+        data = np.frombuffer(entry.data, np.uint8)
+        data[offs] = (data[offs] & PROTECTED_BIT) | c
+
+    # applies arrays of pixel updates to the stored copies of their chunks (and the ones being downloaded)
+    # so that they stay current while we're receiving updates
+    # the updates of every chunk are written at once
+    def patch_many(self, d, xs, ys, offs, c):
+        keys = (xs << 8) | ys
+        with self.lock:
+            for k in np.unique(keys).tolist():
+                sel = keys == k
+                key = (d, k >> 8, k & 0xFF)
+                loading = self.loading.get(key)
+                if loading is not None:
+                    loading[1].append((offs[sel], c[sel]))
+                entry = self.chunks.get(key)
+                if entry is not None:
+                    self._patch(entry, offs[sel], c[sel])
+
+    # forgets all stored chunks
+    def clear(self):
+        with self.lock:
+            self.chunks.clear()
+
+# downloads raw chunk bytes from the server
+def fetch_chunk(d, x, y, max_age=0):
+    return chunk_loader.fetch(d, x, y, max_age)
+
+# gets decoded chunk data from the server
 def get_chunk(d, x, y):
     # get data from the server
-    data = sess.get(f'https://pixelplanet.fun/chunks/{d}/{x}/{y}.bmp').content
-    # construct a numpy array from it
-    arr = np.zeros((256, 256), np.uint8)
-    if len(data) != 65536:
-        return arr
-    for i in range(65536):
-        c = data[i]
-        # protected pixels are shifted up by 128
-        if c >= 128:
-            c = c - 128
-        arr[i // 256, i % 256] = c
-    return arr
-
-# gets several map chunks from the server
-def get_chunks(d, xs, ys, w, h):
-    # the final image
-    data = np.zeros((0, w * 256), np.uint8)
-    # go through the chunks
-    for y in range(h):
-        # the row
-        row = np.zeros((256, 0), np.uint8)
-        for x in range(w):
-            # append the chunk to the row
-            row = np.concatenate((row, get_chunk(d, x + xs, y + ys)), axis=1)
-        # append the row to the image
-        data = np.concatenate((data, row), axis=0)
-    return data
+    data = fetch_chunk(d, x, y)
+    # construct numpy arrays from it
+    shape = chunk_shape(me['canvases'][str(d)])
+    arr = np.empty(shape, np.uint8)
+    prot = np.empty(shape, np.bool_)
+    decode_chunk(data, arr, prot)
+    return arr, prot
+
+# how many tiles that aren't pinned are kept in memory
+TILE_CACHE_SIZE = 256
+
+# the time constant of the chunk update rate average, in seconds
+ACTIVITY_WINDOW = 300
+# after a disconnect, chunks that are expected to have missed at least this many updates are downloaded again
+RESYNC_MIN_EXPECTED = 0.5
+# after this many seconds offline every chunk is downloaded again
+RESYNC_FULL_AFTER = 600
+
+# keeps track of how often every chunk gets updated,
+# so that we know which chunks have probably changed while we were disconnected
+class ChunkActivity(object):
+    def __init__(self, window=ACTIVITY_WINDOW):
+        self.window = window
+        self.lock = threading.Lock()
+        # chunk -> (update rate, time of the last update)
+        self.rates = {}
+        # when we started receiving updates
+        self.since = None
+
+    # starts keeping track (only the first call counts)
+    def watch(self, now=None):
+        with self.lock:
+            if self.since is None:
+                self.since = time.time() if now is None else now
+
+    # records a batch of updates, i and j are arrays of their chunk coordinates
+    def record(self, i, j, now=None):
+        now = time.time() if now is None else now
+        keys, counts = np.unique((i << 8) | j, return_counts=True)
+        with self.lock:
+            for key, n in zip(keys.tolist(), counts.tolist()):
+                key = (key >> 8, key & 0xFF)
+                rate, last = self.rates.get(key, (0.0, now))
+                # exponentially decaying average
+                self.rates[key] = (rate * math.exp(-(now - last) / self.window) + n / self.window, now)
+
+    # the update rate of a chunk at some point in time, in updates per second
+    def rate(self, key, at):
+        with self.lock:
+            rate, last = self.rates.get(key, (0.0, at))
+            since = self.since
+        rate *= math.exp(-max(at - last, 0) / self.window)
+        # the average starts at zero, so it's too low until it has been running for a few windows
+        if since is not None and at > since:
+            rate /= 1 - math.exp(-(at - since) / self.window)
+        return rate
+
+    # the chunks that have probably changed while we were offline from "since" to "until"
+    def likely_changed(self, keys, since, until):
+        if until - since >= RESYNC_FULL_AFTER:
+            return list(keys)
+        return [key for key in keys if self.rate(key, since) * (until - since) >= RESYNC_MIN_EXPECTED]
+
+    # the start time and the rates as a list of [i, j, rate, time of the last update], for checkpoints
+    def state(self):
+        with self.lock:
+            return {'since': self.since, 'rates': [[i, j, rate, last] for (i, j), (rate, last) in self.rates.items()]}
+
+    def restore(self, state):
+        with self.lock:
+            self.since = state['since']
+            for i, j, rate, last in state['rates']:
+                self.rates[(i, j)] = (rate, last)
+
+chunk_activity = ChunkActivity()
+
+# the canvas as a sparse set of 256x256 chunk tiles, keyed by chunk coordinates
+# tiles are loaded when they are first needed; pinned tiles (the ones we receive updates for) stay in memory,
+# the rest are evicted when there are too many of them
+class CanvasStore(object):
+    # the size of a raw chunk, offsets in pixel updates are masked with chunk_bytes - 1
+    chunk_bytes = CHUNK_BYTES
+
+    def __init__(self, d, canv_size, capacity=TILE_CACHE_SIZE):
+        self.d = d
+        self.half = canv_size // 2
+        self.capacity = capacity
+        self.tiles = OrderedDict()
+        self.prot = {}
+        self.fetched_at = {}
+        self.pinned = set()
+        self.lock = threading.RLock()
+        # changes every time a tile changes
+        self.version = 0
+        # tiles that are being downloaded -> [how many downloads, the updates received in the meantime]
+        self.loading = {}
+
+    # stores raw chunk data as a tile
+    def put(self, key, data):
+        tile = np.empty((CHUNK_SIZE, CHUNK_SIZE), np.uint8)
+        prot = np.empty((CHUNK_SIZE, CHUNK_SIZE), np.bool_)
+        decode_chunk(data, tile, prot)
+        with self.lock:
+            self.tiles[key] = tile
+            self.prot[key] = prot
+            self.fetched_at[key] = time.time()
+            self.tiles.move_to_end(key)
+            self.version += 1
+            self._evict()
+
+    def _evict(self):
+        # least recently used first
+        unpinned = [key for key in self.tiles if key not in self.pinned]
+        for key in unpinned[:max(len(unpinned) - self.capacity, 0)]:
+            del self.tiles[key], self.prot[key], self.fetched_at[key]
+
+    # keeps tiles in memory
+    def pin(self, keys):
+        with self.lock:
+            self.pinned.update(keys)
+
+    def unpin(self, keys):
+        with self.lock:
+            self.pinned.difference_update(keys)
+            self._evict()
+
+    # the keys of the tiles that aren't there or are older than max_age seconds
+    def _stale(self, keys, max_age):
+        now = time.time()
+        with self.lock:
+            return [key for key in keys if now - self.fetched_at.get(key, -math.inf) >= max_age]
+
+    # starts downloading a tile, the updates it gets until _loaded() is called are kept
+    def _submit(self, key, max_age):
+        with self.lock:
+            self.loading.setdefault(key, [0, []])[0] += 1
+        return chunk_loader.submit(self.d, key[0], key[1], max_age)
+
+    # stores a downloaded tile (None if the download failed)
+    # and applies the updates received in the meantime, the download may have been made before them
+    def _loaded(self, key, data):
+        with self.lock:
+            loading = self.loading[key]
+            loading[0] -= 1
+            if loading[0] == 0:
+                del self.loading[key]
+            if data is None:
+                return
+            self.put(key, data)
+            for offs, c in loading[1]:
+                self._write(key, offs, c)
+
+    # downloads tiles (concurrently), tiles that are younger than max_age seconds are reused
+    def load(self, keys, max_age=0):
+        futures = {self._submit(key, max_age): key for key in self._stale(keys, max_age)}
+        errors = []
+        for future in as_completed(futures):
+            data = None
+            try:
+                data = future.result()
+            except Exception as e:
+                errors.append(e)
+            self._loaded(futures[future], data)
+        if len(errors) > 0:
+            raise errors[0]
+
+    # same as load(), but for the event loop
+    async def load_async(self, keys, max_age=0):
+        async def load_one(key):
+            data = None
+            try:
+                data = await asyncio.wrap_future(self._submit(key, max_age))
+            finally:
+                self._loaded(key, data)
+        await asyncio.gather(*[load_one(key) for key in self._stale(keys, max_age)])
+
+    # starts downloading tiles in the background
+    def prefetch(self, keys, max_age=0):
+        for key in keys:
+            if key in self.tiles:
+                continue
+            future = self._submit(key, max_age)
+            future.add_done_callback(lambda f, key=key: self._loaded(key, f.result() if f.exception() is None else None))
+
+    # returns a tile, loading it if it's not there and "load" is set
+    def tile(self, key, load=True):
+        with self.lock:
+            tile = self.tiles.get(key)
+            if tile is not None:
+                self.tiles.move_to_end(key)
+                return tile
+        if not load:
+            return None
+        data = None
+        try:
+            data = self._submit(key, 0).result()
+        finally:
+            self._loaded(key, data)
+        with self.lock:
+            return self.tiles.get(key)
+
+    # the chunks that have tiles
+    def keys(self):
+        with self.lock:
+            return list(self.tiles)
+
+    # copies of all tiles as raw chunk data, with the times they were downloaded
+    def snapshot(self):
+        with self.lock:
+            return [(key, self.tiles[key] | (self.prot[key] * np.uint8(PROTECTED_BIT)), self.fetched_at[key])
+                    for key in self.tiles]
+
+    # the tile that updates of a chunk are written to, None if we don't have it
+    def _writable(self, key):
+        return self.tiles.get(key)
+
+    def _write(self, key, offs, c):
+        tile = self._writable(key)
+        if tile is not None:
+            tile.reshape(-1)[offs & (self.chunk_bytes - 1)] = c
+            self.version += 1
+
+    # applies arrays of pixel updates, updates for tiles we don't have (and aren't downloading) are ignored
+    def apply_many(self, i, j, offs, c):
+        keys = (i << 8) | j
+        with self.lock:
+            for k in np.unique(keys).tolist():
+                sel = keys == k
+                key = (k >> 8, k & 0xFF)
+                loading = self.loading.get(key)
+                if loading is not None:
+                    loading[1].append((offs[sel], c[sel]))
+                self._write(key, offs[sel], c[sel])
+
+    # the color index of canvas pixel (x, y)
+    def pixel(self, x, y, load=True):
+        ax, ay = x + self.half, y + self.half
+        tile = self.tile((ax // CHUNK_SIZE, ay // CHUNK_SIZE), load)
+        return 0 if tile is None else tile[ay % CHUNK_SIZE, ax % CHUNK_SIZE]
+
+    # copies a rectangle of the canvas into a new array
+    def view(self, x, y, w, h, load=True):
+        out = np.zeros((h, w), np.uint8)
+        ax0, ay0 = x + self.half, y + self.half
+        for j in range(ay0 // CHUNK_SIZE, (ay0 + h - 1) // CHUNK_SIZE + 1):
+            for i in range(ax0 // CHUNK_SIZE, (ax0 + w - 1) // CHUNK_SIZE + 1):
+                tile = self.tile((i, j), load)
+                if tile is None:
+                    continue
+                # the intersection of the tile and the rectangle in absolute coordinates
+                x0, y0 = max(ax0, i * CHUNK_SIZE), max(ay0, j * CHUNK_SIZE)
+                x1, y1 = min(ax0 + w, (i + 1) * CHUNK_SIZE), min(ay0 + h, (j + 1) * CHUNK_SIZE)
+                out[y0 - ay0:y1 - ay0, x0 - ax0:x1 - ax0] = \
+                    tile[y0 - j * CHUNK_SIZE:y1 - j * CHUNK_SIZE, x0 - i * CHUNK_SIZE:x1 - i * CHUNK_SIZE]
+        return out
+
+# how many voxel chunk volumes share a memory-mapped file
+VOXEL_SLAB_CHUNKS = 64
+
+# the same for voxel canvases: a sparse set of chunk volumes, indexed [y][z][x]
+# the volumes live in memory-mapped temporary files (slabs of VOXEL_SLAB_CHUNKS volumes), so only what's
+# actually loaded takes up memory. empty chunks share one volume of air until something is placed into them
+class VoxelStore(CanvasStore):
+    chunk_bytes = THREE_CHUNK_BYTES
+
+    def __init__(self, d, canv_size, capacity=TILE_CACHE_SIZE):
+        super().__init__(d, canv_size, capacity)
+        self.slabs = []
+        self.free = []
+        self.empty = np.zeros((THREE_CANVAS_HEIGHT, THREE_TILE_SIZE, THREE_TILE_SIZE), np.uint8)
+        self.empty.flags.writeable = False
+
+    # a volume from a slab
+    def _allocate(self):
+        if len(self.free) == 0:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            slab = np.memmap(tempfile.TemporaryFile(dir=CACHE_DIR), np.uint8, 'w+',
+                shape=(VOXEL_SLAB_CHUNKS,) + self.empty.shape)
+            self.slabs.append(slab)
+            self.free.extend(slab[n] for n in range(VOXEL_SLAB_CHUNKS - 1, -1, -1))
+        return self.free.pop()
+
+    def _release(self, volume):
+        if volume is not None and volume is not self.empty:
+            self.free.append(volume)
+
+    def put(self, key, data):
+        with self.lock:
+            volume = self.tiles.get(key)
+            if len(data) != self.chunk_bytes:
+                # empty
+                self._release(volume)
+                volume = self.empty
+            else:
+                if volume is None or volume is self.empty:
+                    volume = self._allocate()
+                decode_chunk(data, volume)
+            self.tiles[key] = volume
+            self.fetched_at[key] = time.time()
+            self.tiles.move_to_end(key)
+            self.version += 1
+            self._evict()
+
+    def _evict(self):
+        unpinned = [key for key in self.tiles if key not in self.pinned]
+        for key in unpinned[:max(len(unpinned) - self.capacity, 0)]:
+            self._release(self.tiles.pop(key))
+            del self.fetched_at[key]
+
+    def _writable(self, key):
+        with self.lock:
+            volume = self.tiles.get(key)
+            if volume is self.empty:
+                volume = self.tiles[key] = self._allocate()
+                volume[:] = 0
+            return volume
+
+    def snapshot(self):
+        with self.lock:
+            return [(key, np.array(self.tiles[key]), self.fetched_at[key]) for key in self.tiles]
+
+    # the color index of canvas voxel (x, y, z)
+    def voxel(self, x, y, z, load=True):
+        ax, az = x + self.half, z + self.half
+        volume = self.tile((ax // THREE_TILE_SIZE, az // THREE_TILE_SIZE), load)
+        return 0 if volume is None else volume[y, az % THREE_TILE_SIZE, ax % THREE_TILE_SIZE]
+
+    # copies a box of the canvas (w wide, h high and d deep, starting at (x, y, z)) into a new array
+    # chunks that aren't there are treated as empty if "load" is not set
+    def box(self, x, y, z, w, h, d, load=True):
+        out = np.zeros((h, d, w), np.uint8)
+        ax0, az0 = x + self.half, z + self.half
+        for j in range(az0 // THREE_TILE_SIZE, (az0 + d - 1) // THREE_TILE_SIZE + 1):
+            for i in range(ax0 // THREE_TILE_SIZE, (ax0 + w - 1) // THREE_TILE_SIZE + 1):
+                volume = self.tile((i, j), load)
+                if volume is None:
+                    continue
+                x0, z0 = max(ax0, i * THREE_TILE_SIZE), max(az0, j * THREE_TILE_SIZE)
+                x1, z1 = min(ax0 + w, (i + 1) * THREE_TILE_SIZE), min(az0 + d, (j + 1) * THREE_TILE_SIZE)
+                out[:, z0 - az0:z1 - az0, x0 - ax0:x1 - ax0] = volume[y:y + h,
+                    z0 - j * THREE_TILE_SIZE:z1 - j * THREE_TILE_SIZE, x0 - i * THREE_TILE_SIZE:x1 - i * THREE_TILE_SIZE]
+        return out
+
+# BGRA color of every palette index, for rendering with fancy indexing
+def palette_bgra(d):
+    colors = np.array(me['canvases'][str(d)]['colors'], np.uint8)
+    lut = np.zeros((256, 4), np.uint8)
+    lut[:len(colors), :3] = colors[:, ::-1]
+    lut[:len(colors), 3] = 255
+    return lut
+
+# a checkerboard pattern for transparent parts of images
+def checkerboard(h, w, y0=0, x0=0):
+    ys, xs = np.ogrid[y0:y0 + h, x0:x0 + w]
+    dark = np.where(ys % 20 < 10, xs % 20 < 10, xs % 20 > 10)
+    img = np.empty((h, w, 4), np.uint8)
+    img[:] = (64, 64, 64, 255)
+    img[dark] = (32, 32, 32, 255)
+    return img
 
 # renders a chunk as a colored CV2 image
 def render_chunk(d, x, y):
-    global me
-    data = get_chunk(d, x, y)
-    img = np.zeros((256, 256, 3), np.uint8)
-    colors = me['canvases'][str(d)]['colors']
-    # go through the data
-    for y in range(256):
-        for x in range(256):
-            r, g, b = colors[data[y, x]]
-            img[y, x] = (b, g, r)
-    return img
+    data, _ = get_chunk(d, x, y)
+    return palette_bgra(d)[data, :3]
 
 # renders map data as a colored CV2 image
 def render_map(d, data):
-    global me
-    img = np.zeros((data.shape[0], data.shape[1], 4), np.uint8)
-    colors = me['canvases'][str(d)]['colors']
-    # go through the data
-    for y in range(data.shape[0]):
-        for x in range(data.shape[1]):
-            if data[y, x] != 255:
-                r, g, b = colors[data[y, x]]
-                img[y, x] = (b, g, r, 255)
+    img = palette_bgra(d)[data]
+    transparent = data == 255
+    img[transparent] = checkerboard(*data.shape)[transparent]
+    return img
+
+# side length of the blocks the live preview is redrawn in
+PREVIEW_BLOCK = 32
+# how often the live preview window is refreshed, in seconds
+PREVIEW_INTERVAL = 0.1
+# color of mismatched pixels in the preview (BGRA)
+PREVIEW_MISMATCH = (0, 0, 255, 255)
+
+# shows the part of the canvas covered by the template and highlights the pixels that don't match it
+# only the blocks that have received updates are redrawn
+class LivePreview(object):
+    def __init__(self, d, template):
+        self.lut = palette_bgra(d)
+        # pixels outside the template are dimmed
+        self.dim_lut = self.lut.copy()
+        self.dim_lut[:, :3] //= 3
+        self.template = template
+        self.tracker = template.damage
+        self.ready = False
+        h, w = self.tracker.target.shape
+        self.frame = np.zeros((h, w, 4), np.uint8)
+        self.dirty = np.ones(((h + PREVIEW_BLOCK - 1) // PREVIEW_BLOCK, (w + PREVIEW_BLOCK - 1) // PREVIEW_BLOCK), np.bool_)
+        # guards "ready" and "dirty", the frame is only touched by the preview thread
+        self.lock = threading.Lock()
+
+    # redraws everything, called when the canvas has been (re)loaded
+    def invalidate(self):
+        with self.lock:
+            self.ready = True
+            self.dirty[:] = True
+
+    # marks the blocks containing these canvas pixels as dirty
+    def mark_dirty(self, xs, ys):
+        xs, ys = xs - self.template.x, ys - self.template.y
+        h, w = self.frame.shape[:2]
+        inside = (xs >= 0) & (xs < w) & (ys >= 0) & (ys < h)
+        by, bx = ys[inside] // PREVIEW_BLOCK, xs[inside] // PREVIEW_BLOCK
+        # (refresh() swaps the mask under the lock)
+        with self.lock:
+            self.dirty[by, bx] = True
+
+    def _render_block(self, by, bx):
+        sl = (slice(by * PREVIEW_BLOCK, (by + 1) * PREVIEW_BLOCK), slice(bx * PREVIEW_BLOCK, (bx + 1) * PREVIEW_BLOCK))
+        target = self.tracker.target[sl]
+        canvas = canvas_store.view(self.template.x + bx * PREVIEW_BLOCK, self.template.y + by * PREVIEW_BLOCK,
+            target.shape[1], target.shape[0], load=False)
+        block = np.where((target == 255)[:, :, None], self.dim_lut[canvas], self.lut[canvas])
+        block[(target != 255) & (self.tracker.equiv[canvas] != target)] = PREVIEW_MISMATCH
+        self.frame[sl] = block
+
+    # redraws the dirty blocks, returns whether anything has changed
+    # (the blocks are rendered outside the lock, so that mark_dirty() doesn't wait for them)
+    def refresh(self):
+        with self.lock:
+            if not self.ready:
+                return False
+            dirty, self.dirty = self.dirty, np.zeros_like(self.dirty)
+        blocks = np.argwhere(dirty)
+        for by, bx in blocks.tolist():
+            self._render_block(by, bx)
+        return len(blocks) > 0
+
+    # writes the current frame to a PNG file
+    def save_snapshot(self, file_path):
+        lazy_import('cv2')
+        self.refresh()
+        cv2.imwrite(file_path, self.frame)
+
+    # shows the preview in a window and/or periodically saves snapshots
+    def run(self, window=True, snapshot_path=None, snapshot_interval=60):
+        lazy_import('cv2')
+        last_snapshot = 0
+        while True:
+            changed = self.refresh()
+            if window:
+                if changed:
+                    cv2.imshow('ppfun2 preview', self.frame)
+                cv2.waitKey(int(PREVIEW_INTERVAL * 1000))
             else:
-                # a checkerboard pattern in transparent parts of the image
-                if y % 20 < 10:
-                    img[y, x] = (32, 32, 32, 255) if x % 20 < 10 else (64, 64, 64, 255)
-                else:
-                    img[y, x] = (32, 32, 32, 255) if x % 20 > 10 else (64, 64, 64, 255)
+                time.sleep(PREVIEW_INTERVAL)
+            if snapshot_path is not None and time.time() - last_snapshot >= snapshot_interval:
+                self.save_snapshot(snapshot_path)
+                last_snapshot = time.time()
+
+    def start(self, window=True, snapshot_path=None, snapshot_interval=60):
+        threading.Thread(target=self.run, args=(window, snapshot_path, snapshot_interval),
+            name='Preview', daemon=True).start()
+
+# available color matching metrics
+COLOR_METRICS = ['rgb', 'lab']
+
+# RGB -> palette index lookup tables, cached per canvas palette
+palette_luts = {}
+
+# converts an (N, 3) array of RGB colors to CIE L*a*b* (D65 white point)
+def rgb_to_lab(rgb):
+    c = rgb.astype(np.float64) / 255
+    c = np.where(c > 0.04045, ((c + 0.055) / 1.055) ** 2.4, c / 12.92)
+    xyz = c @ np.array([[0.4124564, 0.3575761, 0.1804375],
+                        [0.2126729, 0.7151522, 0.0721750],
+                        [0.0193339, 0.1191920, 0.9503041]]).T
+    xyz /= (0.95047, 1.0, 1.08883)
+    f = np.where(xyz > (6 / 29) ** 3, np.cbrt(xyz), xyz / (3 * (6 / 29) ** 2) + 4 / 29)
+    return np.stack((116 * f[:, 1] - 16,
+                     500 * (f[:, 0] - f[:, 1]),
+                     200 * (f[:, 1] - f[:, 2])), axis=1)
+
+# finds the nearest palette entry for every color in an (N, 3) RGB array
+def nearest_colors(rgb, canv_desc, metric='rgb'):
+    # ignore the first "cli" colors, they show key background and are not allowed in the request
+    cli = canv_desc['cli']
+    pal = np.array(canv_desc['colors'], np.int64)[cli:]
+    if metric == 'lab':
+        src, pal = rgb_to_lab(rgb), rgb_to_lab(pal)
+    else:
+        # integer-valued doubles keep the distances exact
+        src, pal = rgb.astype(np.float64), pal.astype(np.float64)
+    # |src - pal|^2 = |src|^2 - 2 src.pal + |pal|^2, and the first term doesn't affect the minimum
+    # (argmin picks the first of equally close colors, just like a linear scan would)
+    pal_sq = (pal * pal).sum(axis=1)
+    out = np.empty(len(rgb), np.uint8)
+    # go in blocks so that the distance matrix stays small
+    block = 1 << 16
+    for s in range(0, len(rgb), block):
+        dist = pal_sq[None, :] - 2 * (src[s:s + block] @ pal.T)
+        out[s:s + block] = np.argmin(dist, axis=1) + cli
+    return out
+
+# returns a lookup table that maps packed RGB colors to palette indices
+# bits=8 gives an exact 16M-entry table, bits=5 gives a 32K-entry approximation
+def get_palette_lut(canv_desc, metric='rgb', bits=8):
+    key = (tuple(map(tuple, canv_desc['colors'])), canv_desc['cli'], metric, bits)
+    lut = palette_luts.get(key)
+    if lut is not None:
+        return lut
+    # the representative 8-bit value of each quantization level
+    levels = np.arange(1 << bits, dtype=np.int64)
+    values = levels if bits == 8 else (levels << (8 - bits)) | (levels >> (2 * bits - 8))
+    gg, bb = np.meshgrid(values, values, indexing='ij')
+    gb = np.stack((gg.ravel(), bb.ravel()), axis=1)
+    lut = np.empty(1 << (3 * bits), np.uint8)
+    plane = 1 << (2 * bits)
+    # one red level at a time
+    for r_level, r in enumerate(values):
+        rgb = np.concatenate((np.full((plane, 1), r), gb), axis=1)
+        lut[r_level * plane:(r_level + 1) * plane] = nearest_colors(rgb, canv_desc, metric)
+    palette_luts[key] = lut
+    return lut
+
+# converts a BGR(A) image into an array of palette indices
+# transparent pixels (alpha <= 128) get index 255
+# with lut_bits, colors are looked up in a table of the nearest colors of 2^lut_bits levels per channel:
+# that's exact with 8 and approximate (the low bits of every channel are ignored) with less
+def quantize_image(img, canv_desc, metric='rgb', lut_bits=None):
+    if img.ndim == 2: # grayscale image
+        img = img[:, :, None].repeat(3, axis=2)
+    img = img.astype(np.uint8, copy=False)
+    transparent = img[:, :, 3] <= 128 if img.shape[2] == 4 else np.zeros(img.shape[:2], np.bool_)
+    b = img[:, :, 0].astype(np.uint32)
+    g = img[:, :, 1].astype(np.uint32)
+    r = img[:, :, 2].astype(np.uint32)
+
+    color_idxs = np.full(img.shape[:2], 255, np.uint8)
+    opaque = ~transparent
+    if lut_bits is not None:
+        shift = 8 - lut_bits
+        packed = ((r >> shift) << (2 * lut_bits)) | ((g >> shift) << lut_bits) | (b >> shift)
+        lut = get_palette_lut(canv_desc, metric, lut_bits)
+        color_idxs[opaque] = lut[packed[opaque]]
+    else:
+        # only look up each distinct color once
+        packed = (r << 16) | (g << 8) | b
+        uniq, inverse = np.unique(packed[opaque], return_inverse=True)
+        rgb = np.stack((uniq >> 16, (uniq >> 8) & 0xFF, uniq & 0xFF), axis=1)
+        color_idxs[opaque] = nearest_colors(rgb, canv_desc, metric)[inverse.ravel()]
+    return color_idxs
+
+# directory for data that survives restarts
+CACHE_DIR = '.ppfun2_cache'
+
+# stores an array in the cache, atomically replacing the old entry
+def save_cached_array(name, arr):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    file_path = path.join(CACHE_DIR, name + '.npy')
+    with open(file_path + '.tmp', 'wb') as f:
+        np.save(f, arr)
+    os.replace(file_path + '.tmp', file_path)
+
+# memory-maps an array from the cache, returns None if it's not there
+def load_cached_array(name):
+    file_path = path.join(CACHE_DIR, name + '.npy')
+    if not path.exists(file_path):
+        return None
+    try:
+        return np.load(file_path, mmap_mode='r')
+    except (ValueError, OSError):
+        return None
+
+# the cache key of a template: depends on the image itself and on everything that affects its conversion
+# (img_path may also be a directory of the layers of a 3D template)
+def template_cache_key(img_path, canv_desc, metric, lut_bits=None):
+    h = hashlib.sha1()
+    files = [path.join(img_path, name) for name in layer_files(img_path)] if path.isdir(img_path) else [img_path]
+    for file_path in files:
+        h.update(path.basename(file_path).encode())
+        # read in blocks, the image may be huge
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+    h.update(json.dumps([canv_desc['colors'], canv_desc['cli'], metric] + ([lut_bits] if lut_bits else [])).encode())
+    return 'template-' + h.hexdigest()
+
+# templates with this many pixels or more are processed in tiles and drawn area by area,
+# so that memory stays bounded no matter how big they are
+HUGE_TEMPLATE_PIXELS = 4096 * 4096
+# the side of a work area of a huge template in chunks
+WORK_AREA_CHUNKS = 4
+# the side of a quantization tile, a multiple of the chunk size
+QUANTIZE_TILE = 4 * CHUNK_SIZE
+
+# splits `size` pixels that start at absolute canvas coordinate a into stretches of `step` pixels
+# (a multiple of the chunk size), returns their borders. all borders but the first and the last are on chunk borders:
+# the first one is one step away from the chunk border before a
+def chunk_borders(a, size, step):
+    return [0] + list(range((a // CHUNK_SIZE) * CHUNK_SIZE + step - a, size, step)) + [size]
+
+# quantizes a huge image tile by tile straight into a memory-mapped cache entry
+# the entry has the same shape as the image, unless another shape (with as many pixels) is given
+# origin is the absolute canvas position of the top-left pixel, the tiles are aligned to the chunks
+def quantize_to_cache(name, img, canv_desc, metric='rgb', shape=None, lut_bits=None, origin=(0, 0)):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    file_path = path.join(CACHE_DIR, name + '.npy')
+    h, w = img.shape[:2]
+    entry = np.lib.format.open_memmap(file_path + '.tmp', 'w+', np.uint8, shape or (h, w))
+    out = entry.reshape((h, w))
+    xs, ys = chunk_borders(origin[0], w, QUANTIZE_TILE), chunk_borders(origin[1], h, QUANTIZE_TILE)
+    for y0, y1 in zip(ys, ys[1:]):
+        for x0, x1 in zip(xs, xs[1:]):
+            out[y0:y1, x0:x1] = quantize_image(img[y0:y1, x0:x1], canv_desc, metric, lut_bits)
+    entry.flush()
+    del entry, out
+    os.replace(file_path + '.tmp', file_path)
+    return load_cached_array(name)
+
+# allocates a zero-filled array. arrays for huge templates live in a temporary file,
+# so only the parts that are actually touched take up memory
+def big_array(shape, dtype):
+    if np.prod(shape) < HUGE_TEMPLATE_PIXELS:
+        return np.zeros(shape, dtype)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    return np.memmap(tempfile.TemporaryFile(dir=CACHE_DIR), dtype, 'w+', shape=shape)
+
+# loads an image and converts it into palette indices
+# the result is cached, so unchanged images don't have to be processed again
+# lut_bits makes it go through a lookup table (see quantize_image())
+# origin is the absolute canvas position of the top-left pixel (huge images are processed in chunk-aligned tiles)
+def load_template(img_path, canv_desc, metric='rgb', lut_bits=None, origin=(0, 0)):
+    key = template_cache_key(img_path, canv_desc, metric, lut_bits)
+    color_idxs = load_cached_array(key)
+    if color_idxs is not None:
+        console.print(f'{Fore.YELLOW}Using the cached processed image{Style.RESET_ALL}')
+        return color_idxs
+
+    if path.splitext(img_path)[1].lower() == '.npy':
+        # raw BGR(A) arrays are memory-mapped, so they never have to be in memory at once
+        img = np.load(img_path, mmap_mode='r')
+    else:
+        # OpenCV can only decode the whole image at once
+        size = png_size(img_path)
+        if size is not None and size[0] * size[1] >= HUGE_TEMPLATE_PIXELS:
+            console.print(f'{Fore.YELLOW}Decoding the {size[0]}x{size[1]} image takes {Fore.GREEN}{size[0] * size[1] * 4 >> 20}' +
+                f'{Fore.YELLOW} MiB of memory. Save it as a .npy array of BGRA pixels to have it memory-mapped instead{Style.RESET_ALL}')
+        lazy_import('cv2')
+        img = cv2.imread(img_path, cv2.IMREAD_UNCHANGED)
+    if img is None:
+        raise ValueError('unsupported image format')
+    console.print(f'{Fore.YELLOW}Processing the image{Style.RESET_ALL}')
+    if img.shape[0] * img.shape[1] >= HUGE_TEMPLATE_PIXELS:
+        return quantize_to_cache(key, img, canv_desc, metric, lut_bits=lut_bits, origin=origin)
+    color_idxs = quantize_image(img, canv_desc, metric, lut_bits)
+    save_cached_array(key, color_idxs)
+    return color_idxs
+
+# the width and height of a PNG image, read from its header without decoding it
+# None if it's not a PNG image
+def png_size(img_path):
+    with open(img_path, 'rb') as f:
+        head = f.read(24)
+    if head[:8] != b'\x89PNG\r\n\x1a\n' or head[12:16] != b'IHDR':
+        return None
+    return struct.unpack('>II', head[16:24])
+
+# the images in a directory of layers, bottom layer first
+def layer_files(dir_path):
+    return sorted(name for name in os.listdir(dir_path) if not name.startswith('.'))
+
+# converts a grayscale, BGR or BGRA image to BGRA
+def to_bgra(img):
+    if img.ndim == 2:
+        img = img[:, :, None].repeat(3, axis=2)
+    if img.shape[2] == 3:
+        img = np.concatenate((img, np.full(img.shape[:2] + (1,), 255, np.uint8)), axis=2)
     return img
 
+# loads a 3D template and converts it into palette indices, indexed [y][z][x] (y is the height)
+# it's either a .npy array of BGR(A) voxels indexed the same way, or a directory of images of the layers,
+# bottom one first (in the order of their names), Z going down and X going right in every one
+# all layers are quantized at once as one tall image. the result is cached, like for 2D templates
+def load_voxel_template(img_path, canv_desc, metric='rgb', lut_bits=None, origin=(0, 0)):
+    key = template_cache_key(img_path, canv_desc, metric, lut_bits)
+    volume = load_cached_array(key)
+    if volume is not None:
+        console.print(f'{Fore.YELLOW}Using the cached processed image{Style.RESET_ALL}')
+        return volume
+
+    if path.isdir(img_path):
+        lazy_import('cv2')
+        layers = [cv2.imread(path.join(img_path, name), cv2.IMREAD_UNCHANGED) for name in layer_files(img_path)]
+        if len(layers) == 0 or any(layer is None for layer in layers):
+            raise ValueError('unsupported image format')
+        if len(set(layer.shape[:2] for layer in layers)) != 1:
+            raise ValueError('the layers are of different sizes')
+        img = np.stack([to_bgra(layer) for layer in layers])
+    else:
+        # memory-mapped, like 2D .npy templates
+        img = np.load(img_path, mmap_mode='r')
+    if img.ndim != 4 or img.shape[3] not in (3, 4):
+        raise ValueError('a 3D template must be indexed [y][z][x][BGR(A)]')
+    if img.shape[0] > THREE_CANVAS_HEIGHT:
+        raise ValueError(f'a 3D template can\'t be higher than {THREE_CANVAS_HEIGHT}')
+    console.print(f'{Fore.YELLOW}Processing the image{Style.RESET_ALL}')
+    h, d, w = img.shape[:3]
+    flat = img.reshape((h * d, w, img.shape[3]))
+    if h * d * w >= HUGE_TEMPLATE_PIXELS:
+        # (the rows are layers and Z, only X can be aligned to the chunks)
+        return quantize_to_cache(key, flat, canv_desc, metric, (h, d, w), lut_bits, (origin[0], 0))
+    volume = quantize_image(flat, canv_desc, metric, lut_bits).reshape((h, d, w))
+    save_cached_array(key, volume)
+    return volume
+
+# maps every color index to the first index with the same color value
+# (water and land have separate indices, but the same color values as regular colors)
+# 255 (transparency) maps to itself
+def color_equivalence(canv_clr):
+    equiv = np.arange(256, dtype=np.uint8)
+    first = {}
+    for i, c in enumerate(canv_clr[:255]):
+        equiv[i] = first.setdefault(tuple(c), i)
+    return equiv
+
+# overwrite counts stop at this
+OVERWRITES_MAX = 0xFFFF
+
+# keeps a queue of template pixels that don't match the canvas
+# it's fed by pixel updates, so nothing has to be rescanned
+# trackers may share a condition so that one can wait for damage in any of them
+# they only count how often each pixel is overwritten if count_overwrites is set (it takes 2 bytes per pixel)
+class DamageTracker(object):
+    def __init__(self, img, canv_clr, cond=None, count_overwrites=False):
+        self.equiv = color_equivalence(canv_clr)
+        # the color we want in every pixel, 255 if we don't care
+        # (filled in bands of rows, the template may be memory-mapped)
+        self.target = big_array(img.shape, np.uint8)
+        for y in range(0, img.shape[0], QUANTIZE_TILE):
+            self.target[y:y + QUANTIZE_TILE] = self.equiv[img[y:y + QUANTIZE_TILE]]
+        self.queue = deque()
+        self.queued = big_array(img.shape, np.bool_)
+        self.cond = cond if cond is not None else threading.Condition()
+        # how many times other players have damaged each pixel
+        self.overwrites = big_array(img.shape, np.uint16) if count_overwrites else None
+        # the pixel stream that's currently being drawn
+        self.stream = None
+
+    # checks if color index c is wrong for template pixel (x, y)
+    def is_damaged(self, x, y, c):
+        t = self.target[y, x]
+        return t != 255 and self.equiv[c] != t
+
+    # queues a pixel
+    def mark(self, x, y):
+        with self.cond:
+            if not self.queued[y, x]:
+                self.queued[y, x] = True
+                self.queue.append((x, y))
+                self.cond.notify()
+
+    # same as mark(), but for arrays of pixels (which may repeat)
+    def mark_many(self, xs, ys):
+        _, first = np.unique(ys * self.target.shape[1] + xs, return_index=True)
+        first.sort()
+        xs, ys = xs[first], ys[first]
+        with self.cond:
+            new = ~self.queued[ys, xs]
+            xs, ys = xs[new], ys[new]
+            if len(xs) == 0:
+                return
+            self.queued[ys, xs] = True
+            self.queue.extend(zip(xs.tolist(), ys.tolist()))
+            self.cond.notify(len(xs))
+
+    # returns a mask of template pixels that don't match the canvas
+    # region is the part of the canvas that's covered by the template,
+    # or by a part of it that starts at template pixel (x0, y0)
+    def mismatched(self, region, x0=0, y0=0):
+        target = self.target[y0:y0 + region.shape[0], x0:x0 + region.shape[1]]
+        return (target != 255) & (self.equiv[region] != target)
+
+    # the part of the tracker that strategies need, limited to a rectangle of the template
+    def window(self, x0, y0, x1, y1):
+        return TrackerWindow(self.target[y0:y1, x0:x1],
+            self.overwrites[y0:y1, x0:x1] if self.overwrites is not None else None)
+
+    # processes changes of template pixels (xs, ys) to color indices cs
+    def on_updates(self, xs, ys, cs):
+        h, w = self.target.shape
+        inside = (xs >= 0) & (xs < w) & (ys >= 0) & (ys < h)
+        xs, ys, cs = xs[inside], ys[inside], cs[inside]
+        t = self.target[ys, xs]
+        damaged = (t != 255) & (self.equiv[cs] != t)
+        xs, ys = xs[damaged], ys[damaged]
+        if self.overwrites is not None:
+            idx, n = np.unique(ys * w + xs, return_counts=True)
+            overwrites = self.overwrites.reshape(-1)
+            overwrites[idx] = np.minimum(overwrites[idx] + n, OVERWRITES_MAX)
+        stream = self.stream
+        if stream is not None:
+            stream.bump_many(xs, ys)
+        self.mark_many(xs, ys)
+
+    # rebuilds the queue from scratch
+    def recheck(self, region):
+        mismatched = self.mismatched(region)
+        ys, xs = np.nonzero(mismatched)
+        with self.cond:
+            self.queue = deque(zip(xs.tolist(), ys.tolist()))
+            self.queued = mismatched
+            self.cond.notify_all()
+
+    # returns the next damaged pixel, waiting for one if there isn't one
+    # returns None on timeout
+    def pop(self, timeout=None):
+        with self.cond:
+            while len(self.queue) == 0:
+                if not self.cond.wait(timeout):
+                    return None
+            x, y = self.queue.popleft()
+            self.queued[y, x] = False
+            return x, y
+
+    # the number of queued pixels
+    def backlog(self):
+        return len(self.queue)
+
+# a rectangle of a DamageTracker
+class TrackerWindow(object):
+    def __init__(self, target, overwrites):
+        self.target = target
+        self.overwrites = overwrites
+
+# a stream of pixels to place in a fixed order
+class OrderedPixelStream(object):
+    def __init__(self, xs, ys):
+        self.xs, self.ys = xs, ys
+        self.cursor = 0
+
+    # returns the next pixel or None if there are none left
+    def next(self):
+        if self.cursor >= len(self.xs):
+            return None
+        x, y = int(self.xs[self.cursor]), int(self.ys[self.cursor])
+        self.cursor += 1
+        return x, y
+
+    # the number of pixels left
+    def remaining(self):
+        return len(self.xs) - self.cursor
+
+    # called when someone else overwrites template pixels (xs, ys)
+    def bump_many(self, xs, ys):
+        pass
+
+# a stream of pixels to place in the order of their priority (highest first)
+# priorities may be raised while the stream is being consumed
+class PriorityPixelStream(object):
+    def __init__(self, xs, ys, priority):
+        # the priority every pixel currently has
+        self.priority = priority
+        self.pending = np.zeros(priority.shape, np.bool_)
+        self.pending[ys, xs] = True
+        self.count = len(xs)
+        # ties are broken by the original order
+        self.heap = [(-int(p), n, int(x), int(y)) for n, (x, y, p) in enumerate(zip(xs, ys, priority[ys, xs]))]
+        heapq.heapify(self.heap)
+        self.seq = len(self.heap)
+        self.lock = threading.Lock()
+
+    def next(self):
+        with self.lock:
+            while len(self.heap) > 0:
+                prio, _, x, y = heapq.heappop(self.heap)
+                if not self.pending[y, x]:
+                    continue
+                # the priority has been raised, the bump that re-queues the pixel may not have come yet
+                if -prio != self.priority[y, x]:
+                    heapq.heappush(self.heap, (-int(self.priority[y, x]), self.seq, x, y))
+                    self.seq += 1
+                    continue
+                self.pending[y, x] = False
+                self.count -= 1
+                return x, y
+            return None
+
+    def remaining(self):
+        return self.count
+
+    # the pixels are re-queued with their new priorities
+    def bump_many(self, xs, ys):
+        _, first = np.unique(ys * self.priority.shape[1] + xs, return_index=True)
+        first.sort()
+        xs, ys = xs[first], ys[first]
+        with self.lock:
+            new = ~self.pending[ys, xs]
+            self.pending[ys[new], xs[new]] = True
+            self.count += int(np.count_nonzero(new))
+            for p, x, y in zip((-self.priority[ys, xs].astype(np.int64)).tolist(), xs.tolist(), ys.tolist()):
+                heapq.heappush(self.heap, (p, self.seq, x, y))
+                self.seq += 1
+
+# translates a stream that was planned for a part of the template into template coordinates
+class OffsetPixelStream(object):
+    def __init__(self, stream, x0, y0, w, h):
+        self.stream = stream
+        self.x0, self.y0 = x0, y0
+        self.w, self.h = w, h
+
+    def next(self):
+        coord = self.stream.next()
+        if coord is None:
+            return None
+        return coord[0] + self.x0, coord[1] + self.y0
+
+    def remaining(self):
+        return self.stream.remaining()
+
+    # pixels outside of the part are none of our business
+    def bump_many(self, xs, ys):
+        xs, ys = xs - self.x0, ys - self.y0
+        inside = (xs >= 0) & (xs < self.w) & (ys >= 0) & (ys < self.h)
+        self.stream.bump_many(xs[inside], ys[inside])
+
+# a drawing strategy decides in which order the pixels are placed
+class DrawStrategy(object):
+    name = ''
+    description = ''
+    # whether plan() needs the overwrite counts of the tracker
+    needs_overwrites = False
+
+    # returns a pixel stream for the template pixels in the mask
+    # tracker is the DamageTracker of the template, or a TrackerWindow of the part the mask covers
+    def plan(self, mask, tracker):
+        raise NotImplementedError
+
+# row by row, left to right
+class ForwardStrategy(DrawStrategy):
+    name = 'forward'
+    description = 'row by row, top to bottom'
+
+    def plan(self, mask, tracker):
+        ys, xs = np.nonzero(mask)
+        return OrderedPixelStream(xs, ys)
+
+class BackwardStrategy(DrawStrategy):
+    name = 'backward'
+    description = 'row by row, bottom to top'
+
+    def plan(self, mask, tracker):
+        ys, xs = np.nonzero(mask)
+        return OrderedPixelStream(xs[::-1], ys[::-1])
+
+class LtrStrategy(DrawStrategy):
+    name = 'ltr'
+    description = 'column by column, left to right'
+
+    def plan(self, mask, tracker):
+        ys, xs = np.nonzero(mask)
+        order = np.lexsort((ys, xs))
+        return OrderedPixelStream(xs[order], ys[order])
+
+class RtlStrategy(DrawStrategy):
+    name = 'rtl'
+    description = 'column by column, right to left'
+
+    def plan(self, mask, tracker):
+        ys, xs = np.nonzero(mask)
+        order = np.lexsort((ys, -xs))
+        return OrderedPixelStream(xs[order], ys[order])
+
+class RandomStrategy(DrawStrategy):
+    name = 'random'
+    description = 'random order'
+
+    def plan(self, mask, tracker):
+        ys, xs = np.nonzero(mask)
+        order = np.random.permutation(len(xs))
+        return OrderedPixelStream(xs[order], ys[order])
+
+# pixels on the edges of the shapes first, so that the image becomes recognizable early
+class OutlineStrategy(DrawStrategy):
+    name = 'outline'
+    description = 'outlines first, then the rest row by row'
+
+    def plan(self, mask, tracker):
+        # a pixel is on an edge if any of its 4 neighbors has a different target color
+        target = np.pad(tracker.target, 1, constant_values=255)
+        center = target[1:-1, 1:-1]
+        edge = ((target[:-2, 1:-1] != center) | (target[2:, 1:-1] != center) |
+                (target[1:-1, :-2] != center) | (target[1:-1, 2:] != center))
+        ys, xs = np.nonzero(mask)
+        order = np.argsort(~edge[ys, xs], kind='stable')
+        return OrderedPixelStream(xs[order], ys[order])
+
+# from the center outwards, ring by ring
+class SpiralStrategy(DrawStrategy):
+    name = 'spiral'
+    description = 'spiral from the center'
+
+    def plan(self, mask, tracker):
+        ys, xs = np.nonzero(mask)
+        cy, cx = (mask.shape[0] - 1) / 2, (mask.shape[1] - 1) / 2
+        ring = np.maximum(np.abs(xs - cx), np.abs(ys - cy))
+        angle = np.arctan2(ys - cy, xs - cx)
+        order = np.lexsort((angle, ring))
+        return OrderedPixelStream(xs[order], ys[order])
+
+# the pixels that other players overwrite the most first
+class ContestedStrategy(DrawStrategy):
+    name = 'contested'
+    description = 'most contested pixels first'
+    needs_overwrites = True
+
+    def plan(self, mask, tracker):
+        ys, xs = np.nonzero(mask)
+        return PriorityPixelStream(xs, ys, tracker.overwrites)
+
+# all drawing strategies by name
+STRATEGIES = OrderedDict((s.name, s) for s in [ForwardStrategy(), BackwardStrategy(), RandomStrategy(),
+    RtlStrategy(), LtrStrategy(), OutlineStrategy(), SpiralStrategy(), ContestedStrategy()])
+
+# WebSocket frame opcodes
+WS_OP_CONT   = 0x0
+WS_OP_TEXT   = 0x1
+WS_OP_BINARY = 0x2
+WS_OP_CLOSE  = 0x8
+WS_OP_PING   = 0x9
+WS_OP_PONG   = 0xA
+WS_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+# the largest message (and frame) that's accepted, way more than anything PixelPlanet sends
+WS_MAX_MESSAGE = 1 << 20
+# the close status code for messages that are too big
+WS_CLOSE_TOO_BIG = 1009
+
+# raised when the connection to the server is lost
+class ConnectionClosedError(Exception):
+    pass
+
+# applies (or removes) a WebSocket mask
+def ws_mask(payload, key):
+    n = len(payload)
+    if n == 0:
+        return b''
+    mask = (key * (n // 4 + 1))[:n]
+    return (int.from_bytes(payload, 'big') ^ int.from_bytes(mask, 'big')).to_bytes(n, 'big')
+
+# the Sec-WebSocket-Accept value for a Sec-WebSocket-Key
+def ws_accept_key(key):
+    return base64.b64encode(hashlib.sha1((key + WS_GUID).encode()).digest()).decode()
+
+# reads an HTTP request or response head
+# returns the first line and a dict of headers with lowercase names
+async def read_http_head(reader):
+    head = (await reader.readuntil(b'\r\n\r\n')).decode('latin-1')
+    lines = head.split('\r\n')
+    headers = {}
+    for line in lines[1:]:
+        if ':' in line:
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+    return lines[0], headers
+
+# a WebSocket connection on top of asyncio streams
+# used by both ends: clients mask their frames, servers don't
+class WebSocketConnection(object):
+    def __init__(self, reader, writer, client=True):
+        self.reader = reader
+        self.writer = writer
+        self.client = client
+        self.closed = False
+
+    def write_frame(self, opcode, payload):
+        if self.closed:
+            raise ConnectionClosedError('connection closed')
+        payload = bytes(payload)
+        n = len(payload)
+        mask_bit = 0x80 if self.client else 0
+        head = bytearray([0x80 | opcode])
+        if n < 126:
+            head.append(mask_bit | n)
+        elif n < 65536:
+            head.append(mask_bit | 126)
+            head += struct.pack('>H', n)
+        else:
+            head.append(mask_bit | 127)
+            head += struct.pack('>Q', n)
+        if self.client:
+            key = os.urandom(4)
+            head += key
+            payload = ws_mask(payload, key)
+        try:
+            self.writer.write(bytes(head) + payload)
+        except OSError as e:
+            self.closed = True
+            raise ConnectionClosedError('connection lost') from e
+
+    async def read_frame(self):
+        try:
+            b1, b2 = await self.reader.readexactly(2)
+            n = b2 & 0x7F
+            if n == 126:
+                n, = struct.unpack('>H', await self.reader.readexactly(2))
+            elif n == 127:
+                n, = struct.unpack('>Q', await self.reader.readexactly(8))
+            if n > WS_MAX_MESSAGE:
+                self.fail(WS_CLOSE_TOO_BIG, f'frame of {n} bytes is too big')
+            key = await self.reader.readexactly(4) if b2 & 0x80 else None
+            payload = await self.reader.readexactly(n)
+        # (OSError also covers SSL errors and timeouts)
+        except (asyncio.IncompleteReadError, OSError) as e:
+            self.closed = True
+            raise ConnectionClosedError('connection lost') from e
+        if key is not None:
+            payload = ws_mask(payload, key)
+        return bool(b1 & 0x80), b1 & 0x0F, payload
+
+    # returns the next message: str if it's text, bytes if it's binary
+    async def recv(self):
+        parts, msg_op, size = [], None, 0
+        while True:
+            fin, opcode, payload = await self.read_frame()
+            if opcode == WS_OP_PING:
+                self.write_frame(WS_OP_PONG, payload)
+                continue
+            if opcode == WS_OP_PONG:
+                continue
+            if opcode == WS_OP_CLOSE:
+                self.write_frame(WS_OP_CLOSE, payload[:2])
+                self.closed = True
+                raise ConnectionClosedError('connection closed by the other side')
+            if opcode != WS_OP_CONT:
+                msg_op = opcode
+            parts.append(payload)
+            size += len(payload)
+            if size > WS_MAX_MESSAGE:
+                self.fail(WS_CLOSE_TOO_BIG, f'message of more than {size} bytes is too big')
+            if fin:
+                data = b''.join(parts)
+                return data.decode('utf-8') if msg_op == WS_OP_TEXT else data
+
+    # waits until the written frames have been handed over to the OS
+    async def drain(self):
+        try:
+            await self.writer.drain()
+        except OSError as e:
+            self.closed = True
+            raise ConnectionClosedError('connection lost') from e
+
+    # closes the connection with a status code because of a protocol violation
+    def fail(self, code, reason):
+        try:
+            self.write_frame(WS_OP_CLOSE, struct.pack('>H', code))
+        except ConnectionClosedError:
+            pass
+        self.closed = True
+        raise ConnectionClosedError(reason)
+
+    def send_binary(self, data):
+        self.write_frame(WS_OP_BINARY, data)
+
+    def send_text(self, text):
+        self.write_frame(WS_OP_TEXT, text.encode('utf-8'))
+
+    async def close(self):
+        if not self.closed:
+            try:
+                self.write_frame(WS_OP_CLOSE, struct.pack('>H', 1000))
+            except ConnectionClosedError:
+                pass
+            self.closed = True
+        self.writer.close()
+
+# opens a tunnel through an HTTP proxy, returns the connected socket
+def open_proxy_tunnel(proxy_host, proxy_port, proxy_user, proxy_passwd, host, port):
+    sock = socket.create_connection((proxy_host, proxy_port), timeout=30)
+    request = f'CONNECT {host}:{port} HTTP/1.1\r\nHost: {host}:{port}\r\n'
+    if proxy_user:
+        creds = base64.b64encode(f'{proxy_user}:{proxy_passwd}'.encode()).decode()
+        request += f'Proxy-Authorization: Basic {creds}\r\n'
+    sock.sendall((request + '\r\n').encode())
+    response = b''
+    while b'\r\n\r\n' not in response:
+        part = sock.recv(4096)
+        if not part:
+            break
+        response += part
+    status = response.split(b'\r\n', 1)[0].split()
+    if len(status) < 2 or status[1] != b'200':
+        sock.close()
+        raise ConnectionError(f'proxy refused the connection: {response[:100]}')
+    sock.settimeout(None)
+    return sock
+
+# connects to a WebSocket server
+# headers is a list of additional "Name: value" header lines
+# proxy is a PpfunConfigProxy or None
+async def ws_connect(url, headers=(), proxy=None):
+    u = urllib.parse.urlsplit(url)
+    secure = u.scheme == 'wss'
+    port = u.port or (443 if secure else 80)
+    ssl_ctx = ssl.create_default_context() if secure else None
+    try:
+        if proxy is not None and proxy.host:
+            sock = await asyncio.get_running_loop().run_in_executor(None, open_proxy_tunnel,
+                proxy.host, proxy.port, proxy.user, proxy.passwd, u.hostname, port)
+            reader, writer = await asyncio.open_connection(sock=sock, ssl=ssl_ctx,
+                server_hostname=u.hostname if secure else None)
+        else:
+            reader, writer = await asyncio.open_connection(u.hostname, port, ssl=ssl_ctx)
+
+        key = base64.b64encode(os.urandom(16)).decode()
+        request = [f'GET {u.path or "/"}{"?" + u.query if u.query else ""} HTTP/1.1',
+                   f'Host: {u.netloc}',
+                   'Upgrade: websocket',
+                   'Connection: Upgrade',
+                   f'Sec-WebSocket-Key: {key}',
+                   'Sec-WebSocket-Version: 13',
+                   f'Origin: {"https" if secure else "http"}://{u.hostname}']
+        writer.write(('\r\n'.join(request + list(headers)) + '\r\n\r\n').encode())
+        status, resp_headers = await read_http_head(reader)
+    except (OSError, asyncio.IncompleteReadError) as e:
+        raise ConnectionClosedError(f'failed to connect: {e}') from e
+    if status.split()[1:2] != ['101'] or resp_headers.get('sec-websocket-accept') != ws_accept_key(key):
+        writer.close()
+        raise ConnectionClosedError(f'WebSocket handshake failed: {status}')
+    return WebSocketConnection(reader, writer, client=True)
+
+# how many seconds other threads wait for a message to be sent
+WS_SEND_TIMEOUT = 30
+
+# the connection to the server, owned by an asyncio event loop
+# other threads may use send_binary(), it hands the data over to the loop
+class AsyncClient(object):
+    def __init__(self, url=WS_URL, headers=(), proxy=None):
+        self.url = url
+        self.headers = list(headers)
+        self.proxy = proxy
+        self.loop = None
+        self.conn = None
+
+    async def connect(self):
+        self.loop = asyncio.get_running_loop()
+        self.conn = await ws_connect(self.url, self.headers, self.proxy)
+
+    @property
+    def connected(self):
+        return self.conn is not None and not self.conn.closed
+
+    async def _send(self, data):
+        try:
+            self.conn.send_binary(data)
+            await self.conn.drain()
+        except ConnectionClosedError:
+            # make the reader notice too, so that we reconnect
+            self.conn.writer.close()
+            raise
+
+    # sends a message, from the event loop or from another thread
+    # other threads wait until it's been sent, errors are raised as ConnectionClosedError
+    def send_binary(self, data):
+        if not self.connected:
+            raise ConnectionClosedError('connection closed')
+        if recorder is not None:
+            recorder.frame(data, sent=True)
+        try:
+            on_loop = asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            on_loop = False
+        if on_loop:
+            self.conn.send_binary(data)
+            return
+        send = self._send(bytes(data))
+        try:
+            future = asyncio.run_coroutine_threadsafe(send, self.loop)
+        except RuntimeError as e: # the loop is gone
+            send.close()
+            raise ConnectionClosedError('connection closed') from e
+        try:
+            future.result(WS_SEND_TIMEOUT)
+        # (the loop stopped before sending it)
+        except (concurrent.futures.CancelledError, concurrent.futures.TimeoutError) as e:
+            raise ConnectionClosedError('connection closed') from e
+
+    async def recv(self):
+        return await self.conn.recv()
+
+    async def _receive(self, queue):
+        try:
+            while True:
+                data = await self.conn.recv()
+                if recorder is not None:
+                    recorder.frame(data)
+                queue.put_nowait(data)
+        except ConnectionClosedError as e:
+            queue.put_nowait(e)
+
+    # receives messages and passes them to dispatch() in batches of everything that has arrived so far
+    async def serve(self, dispatch):
+        queue = asyncio.Queue()
+        reader = asyncio.ensure_future(self._receive(queue))
+        try:
+            while True:
+                batch = [await queue.get()]
+                while not queue.empty():
+                    batch.append(queue.get_nowait())
+                closed = [m for m in batch if isinstance(m, ConnectionClosedError)]
+                dispatch([m for m in batch if not isinstance(m, ConnectionClosedError)])
+                if len(closed) > 0:
+                    raise closed[0]
+        finally:
+            reader.cancel()
+
+    async def close(self):
+        if self.conn is not None:
+            await self.conn.close()
+
+# protocol opcodes
+OP_REG_CANVAS   = 0xA0
+OP_REG_CHUNK    = 0xA1
+OP_ONLINE       = 0xA7
+OP_PIXEL_UPDATE = 0xC1 # also used to place pixels
+OP_COOLDOWN     = 0xC2
+OP_PIXEL_RETURN = 0xC3
+
+# message layouts
+REG_CANVAS_FMT   = struct.Struct('>BB')      # opcode, canvas
+REG_CHUNK_FMT    = struct.Struct('>BBB')     # opcode, chunk X, chunk Y
+PIXEL_FMT        = struct.Struct('>BBBBHB')  # opcode, chunk X, chunk Y, 24-bit offset, color
+ONLINE_FMT       = struct.Struct('>xH')      # counter
+COOLDOWN_FMT     = struct.Struct('<xI')      # total cooldown in ms (little-endian, unlike everything else)
+PIXEL_RETURN_FMT = struct.Struct('>xBIH')    # return code, wait in ms, cooldown in s
+# a pixel update consists of a chunk X and Y followed by any number of 4-byte (offset, color) pairs
+PIXEL_UPDATE_HEADER = 3
+PIXEL_UPDATE_ENTRY  = 4
+
+def encode_select_canvas(d):
+    return REG_CANVAS_FMT.pack(OP_REG_CANVAS, d)
+
+def encode_register_chunk(x, y):
+    return REG_CHUNK_FMT.pack(OP_REG_CHUNK, x, y)
+
+def encode_pixel(i, j, offs, c):
+    return PIXEL_FMT.pack(OP_PIXEL_UPDATE, i, j, offs >> 16, offs & 0xFFFF, c)
+
+# returns (i, j, offset, color)
+def decode_pixel(data):
+    _, i, j, offs_hi, offs_lo, c = PIXEL_FMT.unpack_from(data)
+    return i, j, (offs_hi << 16) | offs_lo, c
+
+def decode_online(data):
+    return ONLINE_FMT.unpack_from(data)[0]
+
+def decode_cooldown(data):
+    return COOLDOWN_FMT.unpack_from(data)[0]
+
+# returns (return code, wait, cooldown seconds)
+def decode_pixel_return(data):
+    return PIXEL_RETURN_FMT.unpack_from(data)
+
+# the server side of the protocol (used by the simulator)
+def decode_select_canvas(data):
+    return REG_CANVAS_FMT.unpack_from(data)[1]
+
+# returns (chunk X, chunk Y)
+def decode_register_chunk(data):
+    return REG_CHUNK_FMT.unpack_from(data)[1:]
+
+def encode_online(count):
+    return bytes([OP_ONLINE]) + ONLINE_FMT.pack(count)[1:]
+
+def encode_cooldown(ms):
+    return bytes([OP_COOLDOWN]) + COOLDOWN_FMT.pack(ms)[1:]
+
+def encode_pixel_return(rc, wait, cd_s):
+    return bytes([OP_PIXEL_RETURN]) + PIXEL_RETURN_FMT.pack(rc, wait, cd_s)[1:]
+
+# one pixel update message with any number of pixels of the same chunk
+def encode_pixel_updates(i, j, offs, colors):
+    offs, colors = np.asarray(offs, np.int64), np.asarray(colors, np.int64)
+    entries = np.stack((offs >> 16, (offs >> 8) & 0xFF, offs & 0xFF, colors), axis=1).astype(np.uint8)
+    return bytes([OP_PIXEL_UPDATE, i, j]) + entries.tobytes()
+
+# decodes a burst of pixel update messages at once
+# returns arrays of chunk X, chunk Y, offset and color of every updated pixel
+# frames without a complete header and incomplete trailing entries are ignored
+def decode_pixel_updates(frames):
+    views = [memoryview(f) for f in frames if len(f) >= PIXEL_UPDATE_HEADER]
+    counts = [(len(v) - PIXEL_UPDATE_HEADER) // PIXEL_UPDATE_ENTRY for v in views]
+    body = b''.join(v[PIXEL_UPDATE_HEADER:PIXEL_UPDATE_HEADER + n * PIXEL_UPDATE_ENTRY] for v, n in zip(views, counts))
+    entries = np.frombuffer(body, np.uint8).reshape((-1, PIXEL_UPDATE_ENTRY)).astype(np.int64)
+    i = np.repeat(np.array([v[1] for v in views], np.int64), counts)
+    j = np.repeat(np.array([v[2] for v in views], np.int64), counts)
+    offs = (entries[:, 0] << 16) | (entries[:, 1] << 8) | entries[:, 2]
+    return i, j, offs, entries[:, 3].astype(np.uint8)
+
 # selects a canvas for future use
 def select_canvas(ws, d):
-    data = bytearray(2)
-    data[0] = 0xA0
-    data[1] = d
-    # send data
-    ws.send_binary(data)
+    ws.send_binary(encode_select_canvas(d))
 
 # register a chunk
 def register_chunk(ws, d, x, y):
-    data = bytearray(3)
-    data[0] = 0xA1
-    data[1] = x
-    data[2] = y
-    # send data
-    ws.send_binary(data)
-
-# places a pixel
-def place_pixel(ws, d, x, y, c):
+    ws.send_binary(encode_register_chunk(x, y))
+
+# the chunk and the offset of a pixel (or of the voxel (x, y, z) on a voxel canvas, y being the height)
+def locate_pixel(d, x, y, z=None):
     # convert the X and Y coordinates to I, J and Offset
     csz = me['canvases'][str(d)]['size']
+    if z is not None:
+        ax, az = x + csz // 2, z + csz // 2
+        offs = (y * THREE_TILE_SIZE * THREE_TILE_SIZE) + ((az % THREE_TILE_SIZE) * THREE_TILE_SIZE) + (ax % THREE_TILE_SIZE)
+        return ax // THREE_TILE_SIZE, az // THREE_TILE_SIZE, offs
     modOffs = (csz // 2) % 256
     offs = (((y + modOffs) % 256) * 256) + ((x + modOffs) % 256)
     i = (x + csz // 2) // 256
     j = (y + csz // 2) // 256
-    # construct the data array
-    data = bytearray(7)
-    data[0] = 0xC1
-    data[1] = i
-    data[2] = j
-    data[3] = (offs >> 16) & 0xFF
-    data[4] = (offs >>  8) & 0xFF
-    data[5] = (offs >>  0) & 0xFF
-    data[6] = c
-    # send data
-    ws.send_binary(data)
-
-# draws the image
-def draw_function(ws, canv_id, draw_x, draw_y, c_start_x, c_start_y, img, defend, strategy):
+    return i, j, offs
+
+# chat message
+def on_chat_message(data):
+    # data comes as a JS(ON) array
+    msg = json.loads('{"msg":' + data + '}')
+    msg = msg['msg']
+    if isinstance(msg, list): # it also could be a string, in which case it's our nickname
+        console.print(f'{Fore.GREEN}{msg[0]}{Fore.YELLOW} (country: {Fore.GREEN}{msg[2]}{Fore.YELLOW}) ' +
+            f'says: {Fore.GREEN}{msg[1]}{Fore.YELLOW} in chat {Fore.GREEN}{"int" if msg[2] == 2 else "en"}{Style.RESET_ALL}')
+
+# online counter
+def on_online_counter(data):
+    console.event('online', count=decode_online(data))
+
+# total cooldown packet
+def on_cooldown(data):
+    ms = decode_cooldown(data)
+    metrics.set('cooldown_ms', ms)
+    console.event('cooldown', ms=ms)
+
+# pixel return packet
+def on_pixel_return(data):
+    rc, wait, cd_s = decode_pixel_return(data)
+    console.event('placed' if rc == 0 else 'failed', code=rc, wait=wait, cd_s=cd_s)
+    if rc != 0:
+        console.print(f'{Fore.YELLOW}Pixel return{Fore.YELLOW} (code: {Fore.RED}{rc}{Fore.YELLOW}): ' +
+            f'wait: {Fore.GREEN}{wait}{Fore.YELLOW} ms {Fore.GREEN}[+{cd_s} s]{Style.RESET_ALL}')
+    # CAPTCHA error
+    if rc == 10:
+        notifier.notify('captcha', 'CAPTCHA', 'Place a pixel somewhere manually and enter CAPTCHA')
+        console.print(Fore.RED + 'Place a pixel somewhere manually and enter CAPTCHA' + Style.RESET_ALL)
+    elif rc == 0 and wait >= COOLDOWN_THRESHOLD:
+        console.print(f'{Fore.YELLOW}Cooling down{Style.RESET_ALL}')
+    # the drawing thread will retry after an error or wait out the cooldown
+    pipeline.resolve(rc, wait, cd_s)
+
+# a batch of pixel updates
+def on_pixel_updates(frames):
+    start = time.perf_counter()
+    d = config.image.canv_id
+    canv_desc = me['canvases'][str(d)]
+    csz = canv_desc['size']
+    i, j, offs, clr = decode_pixel_updates(frames)
+    if 'v' in canv_desc:
+        # convert it to X, Y (height) and Z coords
+        xs = ((i * THREE_TILE_SIZE) - (csz // 2)) + offs % THREE_TILE_SIZE
+        zs = ((j * THREE_TILE_SIZE) - (csz // 2)) + (offs // THREE_TILE_SIZE) % THREE_TILE_SIZE
+        ys = offs // (THREE_TILE_SIZE * THREE_TILE_SIZE)
+    else:
+        # convert it to X and Y coords
+        in_x, in_y = offs & 0xFF, (offs >> 8) & 0xFF
+        xs = ((i * 256) - (csz // 2)) + in_x
+        ys = ((j * 256) - (csz // 2)) + in_y
+        zs = None
+    # write that change
+    canvas_store.apply_many(i, j, offs, clr)
+    chunk_loader.patch_many(d, i, j, offs, clr)
+    # the echoes of our own placements aren't activity of other players
+    others = ~pipeline.own_updates(i, j, offs, clr)
+    chunk_activity.record(i[others], j[others])
+    for t in templates:
+        t.damage.on_updates(*t.to_local(xs, ys, zs), clr)
+    if preview is not None:
+        preview.mark_dirty(xs, ys)
+    # one event for the whole batch
+    if len(xs) > 0:
+        console.event('update', n=len(xs), chunks=len(np.unique((i << 8) | j)))
+    metrics.inc('updates_total', len(xs))
+    metrics.observe('update_apply_seconds', time.perf_counter() - start)
+
+# handlers of binary messages by opcode
+# (pixel updates are batched and go to on_pixel_updates())
+MESSAGE_HANDLERS = {
+    OP_ONLINE:       on_online_counter,
+    OP_COOLDOWN:     on_cooldown,
+    OP_PIXEL_RETURN: on_pixel_return,
+}
+
+# processes received messages, consecutive pixel updates are handled together
+def dispatch_messages(messages):
+    profiler.hook()
+    updates = []
+    for data in messages:
+        if not isinstance(data, str) and len(data) > 0 and data[0] == OP_PIXEL_UPDATE:
+            updates.append(data)
+            continue
+        if len(updates) > 0:
+            on_pixel_updates(updates)
+            updates = []
+        # text data = chat message
+        if isinstance(data, str):
+            on_chat_message(data)
+            continue
+        # binary data = event
+        handler = MESSAGE_HANDLERS.get(data[0]) if len(data) > 0 else None
+        if handler is None:
+            console.print(f'{Fore.RED}Unreconized data opcode from the server. Raw data: {data}{Style.RESET_ALL}')
+        else:
+            handler(data)
+    if len(updates) > 0:
+        on_pixel_updates(updates)
+
+# recording and replaying the event stream
+# a recording starts with RECORDING_MAGIC and is only ever appended to
+# every record is a header (wall clock time, kind, payload length) followed by the payload
+RECORDING_MAGIC = b'PPF2REC\x01'
+RECORD_FMT      = struct.Struct('<dBI')
+# record kinds
+REC_INFO      = 0 # session information (JSON)
+REC_RECV      = 1 # a received binary message
+REC_RECV_TEXT = 2 # a received text message
+REC_SENT      = 3 # a sent message
+REC_CHUNK     = 4 # a downloaded chunk
+# a chunk record is the canvas, chunk X and chunk Y followed by the compressed raw chunk
+CHUNK_RECORD_FMT = struct.Struct('<BBB')
+# how often the recording is flushed to the disk, in seconds
+RECORDING_FLUSH_INTERVAL = 1
+# longer pauses (e.g. between two runs of the bot) are shortened to this many seconds when replaying
+REPLAY_MAX_GAP = 5
+# at most this many messages are handled at once when replaying faster than they were recorded
+REPLAY_MAX_BATCH = 1024
+
+# writes the messages that are received and sent, and the chunks that are downloaded, to a file
+class EventRecorder(object):
+    def __init__(self, file_path):
+        self.lock = threading.Lock()
+        self.file = open(file_path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(RECORDING_MAGIC)
+        self.last_flush = time.monotonic()
+
+    def _write(self, kind, payload):
+        with self.lock:
+            self.file.write(RECORD_FMT.pack(time.time(), kind, len(payload)))
+            self.file.write(payload)
+            now = time.monotonic()
+            if now - self.last_flush >= RECORDING_FLUSH_INTERVAL:
+                self.file.flush()
+                self.last_flush = now
+
+    # records information about the session (the api/me response etc.)
+    def info(self, **fields):
+        self._write(REC_INFO, json.dumps(fields).encode())
+
+    # records a received or a sent message
+    def frame(self, data, sent=False):
+        if isinstance(data, str):
+            self._write(REC_RECV_TEXT, data.encode())
+        else:
+            self._write(REC_SENT if sent else REC_RECV, data)
+
+    # records a downloaded chunk
+    def chunk(self, d, x, y, data):
+        self._write(REC_CHUNK, CHUNK_RECORD_FMT.pack(d, x, y) + zlib.compress(data, 1))
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+# a recording that's being replayed, the file is memory-mapped
+class Recording(object):
+    def __init__(self, file_path):
+        with open(file_path, 'rb') as f:
+            if f.read(len(RECORDING_MAGIC)) != RECORDING_MAGIC:
+                raise ValueError(f'{file_path} is not a recording')
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    # yields (time, kind, payload) of every record
+    # (a record that was cut short, e.g. because the bot was killed, ends the recording)
+    def records(self):
+        view = memoryview(self.map)
+        pos, end = len(RECORDING_MAGIC), len(self.map)
+        while pos + RECORD_FMT.size <= end:
+            t, kind, length = RECORD_FMT.unpack_from(view, pos)
+            pos += RECORD_FMT.size
+            if pos + length > end:
+                return
+            yield t, kind, view[pos:pos + length]
+            pos += length
+
+    # returns the first session information record
+    def info(self):
+        for _, kind, payload in self.records():
+            if kind == REC_INFO:
+                return json.loads(bytes(payload))
+        raise ValueError('the recording has no session information')
+
+# serves the chunks of a recording instead of downloading them
+# a chunk is what it was the last time it was downloaded before the point the replay has reached
+# (or the first time, if the replay hasn't reached it yet)
+class ReplayChunkLoader(ChunkLoader):
+    def __init__(self, recording):
+        super().__init__(None)
+        self.snapshots = {}
+        for _, kind, payload in recording.records():
+            if kind == REC_CHUNK:
+                self.snapshots.setdefault(CHUNK_RECORD_FMT.unpack_from(payload), payload)
+
+    # the replay has reached a chunk record
+    def reached(self, payload):
+        self.snapshots[CHUNK_RECORD_FMT.unpack_from(payload)] = payload
+
+    def fetch(self, d, x, y, max_age=0):
+        key = (d, x, y)
+        entry = self._lookup(key)
+        now = time.time()
+        if entry is not None and now - entry.fetched_at < max_age:
+            return bytes(entry.data)
+        payload = self.snapshots.get(key)
+        data = bytearray(zlib.decompress(payload[CHUNK_RECORD_FMT.size:]) if payload is not None else b'')
+        self._store(key, CachedChunk(data, None, None, now))
+        return bytes(data)
+
+# plays a recording back instead of connecting to the server
+# the received messages are handed to dispatch() with the recorded timing, `speed` times faster
+# (0 = as fast as possible). the messages the bot sends are only counted
+class ReplayClient(object):
+    def __init__(self, recording, loader, speed=1):
+        self.recording = recording
+        self.loader = loader
+        self.speed = speed
+        self.loop = None
+        self.open = False
+        # message counts, the replayed (recorded) time and how long the replay took
+        self.received = 0
+        self.sent = 0
+        self.recorded_sent = 0
+        self.duration = 0
+        self.elapsed = 0
+
+    async def connect(self):
+        self.loop = asyncio.get_running_loop()
+        self.open = True
+
+    @property
+    def connected(self):
+        return self.open
+
+    def send_binary(self, data):
+        if not self.open:
+            raise ConnectionClosedError('connection closed')
+        self.sent += 1
+
+    async def serve(self, dispatch):
+        start = time.monotonic()
+        batch, last_t, virtual = [], None, 0
+        for t, kind, payload in self.recording.records():
+            if last_t is not None:
+                virtual += min(max(t - last_t, 0), REPLAY_MAX_GAP)
+            last_t = t
+            if kind == REC_CHUNK:
+                self.loader.reached(payload)
+                continue
+            if kind == REC_SENT:
+                self.recorded_sent += 1
+                continue
+            if kind not in (REC_RECV, REC_RECV_TEXT):
+                continue
+            # everything that arrived before this message is handled together, like AsyncClient.serve() does
+            due = start + (virtual / self.speed if self.speed > 0 else 0)
+            if len(batch) > 0 and (due > time.monotonic() or len(batch) >= REPLAY_MAX_BATCH):
+                dispatch(batch)
+                batch = []
+            delay = due - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            batch.append(bytes(payload) if kind == REC_RECV else str(payload, 'utf-8'))
+            self.received += 1
+        if len(batch) > 0:
+            dispatch(batch)
+        self.duration = virtual
+        self.elapsed = time.monotonic() - start
+
+    async def close(self):
+        self.open = False
+
+# pixels are placed once per this many seconds, plus or minus the jitter
+# (a little bit of artifical fluctuation so the server doesn't think we're a bot)
+PLACE_INTERVAL = 0.5
+PLACE_JITTER   = 0.25
+# how many seconds to wait after an error
+ERROR_DELAY = 2
+# when the total cooldown reaches this many ms, we wait until the cooldown of the last pixel passes
+COOLDOWN_THRESHOLD = 30000
+# how many seconds the server has to echo a placement back to us as a pixel update
+ECHO_TIMEOUT = 10
+
+# a pixel placement that's waiting for a reply from the server
+class PendingPlacement(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.rc = None
+        self.wait = 0
+        self.cd_s = 0
+        # time.monotonic() value when it was sent
+        self.sent_at = None
+        # the pixel update the server should echo back
+        self.echo = None
+
+# sends pixel placements one at a time and hands the replies back to the senders
+# the next placement is scheduled from the cooldown the server reports
+class PlacementPipeline(object):
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.pending = deque()
+        # time.monotonic() value after which the next pixel may be placed
+        self.ready_at = 0
+        self.closed = False
+        # how many times it's been opened (once for every connection)
+        self.connection = 0
+        # (deadline, chunk X, chunk Y, offset, color) of the placements the server should echo back
+        self.echoes = deque()
+
+    # places a pixel (or a voxel) and waits for the server to reply
+    # returns the PendingPlacement with the reply
+    def place(self, ws, d, x, y, c, z=None):
+        start = time.monotonic()
+        with self.cond:
+            while True:
+                if self.closed:
+                    raise ConnectionClosedError('connection closed')
+                delay = self.ready_at - time.monotonic()
+                if delay <= 0 and len(self.pending) == 0:
+                    break
+                self.cond.wait(delay if delay > 0 else None)
+            placement = PendingPlacement()
+            placement.sent_at = time.monotonic()
+            metrics.observe('place_wait_seconds', placement.sent_at - start)
+            i, j, offs = locate_pixel(d, x, y, z)
+            # the echo may arrive before the reply
+            placement.echo = (placement.sent_at + ECHO_TIMEOUT, i, j, offs, c)
+            self.pending.append(placement)
+            self.echoes.append(placement.echo)
+        # (not under the lock: sending waits for the event loop, which needs it to process replies)
+        try:
+            ws.send_binary(encode_pixel(i, j, offs, c))
+        except ConnectionClosedError:
+            with self.cond:
+                if placement in self.pending:
+                    self.pending.remove(placement)
+                if placement.echo in self.echoes:
+                    self.echoes.remove(placement.echo)
+                self.cond.notify_all()
+            raise
+        placement.done.wait()
+        if placement.rc is None:
+            raise ConnectionClosedError('connection closed')
+        return placement
+
+    # processes a pixel return packet
+    def resolve(self, rc, wait, cd_s):
+        with self.cond:
+            now = time.monotonic()
+            if rc != 0:
+                self.ready_at = now + ERROR_DELAY
+            elif wait >= COOLDOWN_THRESHOLD:
+                # wait that many seconds plus 1 (to be sure)
+                self.ready_at = now + cd_s + 1
+                metrics.inc('cooldown_seconds_total', cd_s + 1)
+            else:
+                self.ready_at = now + PLACE_INTERVAL + random.uniform(-PLACE_JITTER, PLACE_JITTER)
+            metrics.inc('placements_total', rc=rc)
+            metrics.set('cooldown_ms', wait)
+            if len(self.pending) > 0:
+                placement = self.pending.popleft()
+                metrics.observe('place_rtt_seconds', now - placement.sent_at)
+                placement.rc, placement.wait, placement.cd_s = rc, wait, cd_s
+                # a rejected placement won't be echoed
+                if rc != 0 and placement.echo in self.echoes:
+                    self.echoes.remove(placement.echo)
+                placement.done.set()
+            self.cond.notify_all()
+
+    # which of a batch of pixel updates are the echoes of our own placements
+    # returns a boolean mask, every echo is only matched once
+    def own_updates(self, i, j, offs, clr):
+        own = np.zeros(len(offs), bool)
+        with self.cond:
+            now = time.monotonic()
+            while len(self.echoes) > 0 and self.echoes[0][0] < now:
+                self.echoes.popleft()
+            for echo in list(self.echoes):
+                _, ei, ej, eoffs, ec = echo
+                match = np.flatnonzero((i == ei) & (j == ej) & (offs == eoffs) & (clr == ec) & ~own)
+                if len(match) > 0:
+                    own[match[0]] = True
+                    self.echoes.remove(echo)
+        return own
+
+    # fails all outstanding placements, called when the connection is lost
+    def close(self):
+        with self.cond:
+            self.closed = True
+            while len(self.pending) > 0:
+                self.pending.popleft().done.set()
+            self.cond.notify_all()
+
+    # waits until the pipeline is open for a connection after connection number `connection`
+    def wait_open(self, connection):
+        with self.cond:
+            while self.closed or self.connection <= connection:
+                self.cond.wait()
+
+    # allows placing pixels again, called when a new connection is established (and the canvas is resynced)
+    def reopen(self):
+        with self.cond:
+            self.closed = False
+            self.connection += 1
+            self.cond.notify_all()
+
+# a template that's being drawn
+class Template(object):
+    def __init__(self, img, x, y, canv_desc, defend=False, strategy='forward', priority=0, cond=None):
+        self.img = img
+        self.x, self.y = x, y
+        self.canv_size = canv_desc['size']
+        self.defend = defend
+        self.strategy = strategy
+        self.priority = priority
+        self.damage = DamageTracker(img, canv_desc['colors'], cond, STRATEGIES[strategy].needs_overwrites)
+        self.tiled = img.size >= HUGE_TEMPLATE_PIXELS
+        # the work area of a huge template that's being drawn (len(work_areas()) when it's done)
+        self.area = 0
+        # set when the first drawing pass is over, from then on its damage is what there is to defend
+        self.drawn = False
+        # the image file, if it was loaded from one
+        self.path = None
+        # how many pixels have been placed and planned, and the area that was drawn first,
+        # for the progress estimate (it carries on after reconnects)
+        self.progress = None
+
+    @staticmethod
+    def from_config(cfg, img, canv_desc, cond=None):
+        t = Template(img, cfg.x, cfg.y, canv_desc, cfg.defend, cfg.strategy, getattr(cfg, 'priority', 0), cond)
+        t.path = cfg.path
+        return t
+
+    # the chunks the template covers
+    # area limits it to a part of the template, (x0, y0, x1, y1) in template coordinates
+    def chunks(self, area=None):
+        x0, y0, x1, y1 = area if area is not None else (0, 0, self.img.shape[1], self.img.shape[0])
+        half = self.canv_size // 2
+        ax, ay = half + self.x, half + self.y
+        return [(i, j) for j in range((ay + y0) // CHUNK_SIZE, (ay + y1 - 1) // CHUNK_SIZE + 1)
+                       for i in range((ax + x0) // CHUNK_SIZE, (ax + x1 - 1) // CHUNK_SIZE + 1)]
+
+    # the parts of the template that are drawn one after another
+    # huge templates are split into areas of WORK_AREA_CHUNKS x WORK_AREA_CHUNKS chunks,
+    # so only the chunks around the current area have to be in memory
+    def work_areas(self):
+        h, w = self.img.shape
+        if not self.tiled:
+            return [(0, 0, w, h)]
+        half = self.canv_size // 2
+        step = WORK_AREA_CHUNKS * CHUNK_SIZE
+        xs, ys = chunk_borders(half + self.x, w, step), chunk_borders(half + self.y, h, step)
+        return [(x0, y0, x1, y1) for y0, y1 in zip(ys, ys[1:]) for x0, x1 in zip(xs, xs[1:])]
+
+    # a copy of the part of the canvas covered by the template (or by an area of it)
+    def region(self, area=None):
+        x0, y0, x1, y1 = area if area is not None else (0, 0, self.img.shape[1], self.img.shape[0])
+        return canvas_store.view(self.x + x0, self.y + y0, x1 - x0, y1 - y0)
+
+    # the current canvas color index of template pixel (x, y)
+    def canvas_color(self, x, y):
+        return canvas_store.pixel(self.x + x, self.y + y)
+
+    # the canvas coordinates of template pixel (x, y)
+    def position(self, x, y):
+        return self.x + x, self.y + y
+
+    # places template pixel (x, y), see PlacementPipeline.place()
+    def place(self, ws, canv_id, x, y):
+        return pipeline.place(ws, canv_id, self.x + x, self.y + y, self.img[y, x])
+
+    # converts arrays of canvas coordinates to template coordinates (zs is for voxel canvases)
+    def to_local(self, xs, ys, zs=None):
+        return xs - self.x, ys - self.y
+
+    # the chunks of arrays of template pixels
+    def chunk_of(self, xs, ys):
+        half = self.canv_size // 2
+        return (xs + (half + self.x)) // CHUNK_SIZE, (ys + (half + self.y)) // CHUNK_SIZE
+
+# a template for a voxel canvas: a volume of color indices indexed [y][z][x] (255 where we don't care)
+# it's handled as a 2D image of its layers stacked on top of each other (layer y is rows y * depth to
+# (y + 1) * depth, row z of the layer is the Z coordinate), so damage tracking and the strategies work on it as is.
+# every layer is a work area: it's drawn layer by layer from the bottom up, each layer in the order of the strategy
+class VoxelTemplate(Template):
+    def __init__(self, volume, x, y, z, canv_desc, defend=False, strategy='forward', priority=0, cond=None):
+        super().__init__(volume.reshape((-1, volume.shape[2])), x, y, canv_desc, defend, strategy, priority, cond)
+        self.volume = volume
+        self.z = z
+        self.depth = volume.shape[1]
+        # the volume is only ever looked at layer by layer
+        self.tiled = False
+        self.layers = [n for n in range(volume.shape[0]) if (volume[n] != 255).any()]
+        self.all_chunks = self._chunks(0, volume.shape[0], 0, volume.shape[2])
+
+    @staticmethod
+    def from_config(cfg, volume, canv_desc, cond=None):
+        t = VoxelTemplate(volume, cfg.x, cfg.y, getattr(cfg, 'z', 0), canv_desc, cfg.defend, cfg.strategy,
+            getattr(cfg, 'priority', 0), cond)
+        t.path = cfg.path
+        return t
+
+    # the chunks that have voxels of layers l0 to l1 (and columns x0 to x1)
+    def _chunks(self, l0, l1, x0, x1):
+        columns = np.zeros((self.depth, x1 - x0), np.bool_)
+        for n in range(l0, l1):
+            columns |= self.volume[n, :, x0:x1] != 255
+        zs, xs = np.nonzero(columns)
+        half = self.canv_size // 2
+        keys = np.unique(((xs + (half + self.x + x0)) // THREE_TILE_SIZE << 8) | ((zs + (half + self.z)) // THREE_TILE_SIZE))
+        return [(key >> 8, key & 0xFF) for key in keys.tolist()]
+
+    # only the chunks that actually have voxels of the template are loaded
+    def chunks(self, area=None):
+        if area is None:
+            return self.all_chunks
+        x0, y0, x1, y1 = area
+        return self._chunks(y0 // self.depth, -(-y1 // self.depth), x0, x1)
+
+    def work_areas(self):
+        w = self.img.shape[1]
+        return [(0, n * self.depth, w, (n + 1) * self.depth) for n in self.layers]
+
+    def region(self, area=None):
+        x0, y0, x1, y1 = area if area is not None else (0, 0, self.img.shape[1], self.img.shape[0])
+        l0, l1 = y0 // self.depth, -(-y1 // self.depth)
+        # the chunks without voxels of the template don't matter
+        box = canvas_store.box(self.x + x0, self.y + l0, self.z, x1 - x0, l1 - l0, self.depth, load=False)
+        return box.reshape((-1, x1 - x0))[y0 - l0 * self.depth:y1 - l0 * self.depth]
+
+    def canvas_color(self, x, y):
+        return canvas_store.voxel(self.x + x, self.y + y // self.depth, self.z + y % self.depth)
+
+    def position(self, x, y):
+        return self.x + x, self.y + y // self.depth, self.z + y % self.depth
+
+    def place(self, ws, canv_id, x, y):
+        px, py, pz = self.position(x, y)
+        return pipeline.place(ws, canv_id, px, py, self.img[y, x], pz)
+
+    # voxels outside of the template get an X of -1
+    def to_local(self, xs, ys, zs=None):
+        lx, ly, lz = xs - self.x, ys - self.y, zs - self.z
+        inside = (ly >= 0) & (ly < self.volume.shape[0]) & (lz >= 0) & (lz < self.depth)
+        return np.where(inside, lx, -1), ly * self.depth + lz
+
+    def chunk_of(self, xs, ys):
+        half = self.canv_size // 2
+        return (xs + (half + self.x)) // THREE_TILE_SIZE, (ys % self.depth + (half + self.z)) // THREE_TILE_SIZE
+
+# makes sure that templates don't fight each other:
+# lower priority templates don't care about pixels covered by higher priority ones
+def resolve_overlaps(templates):
+    ordered = sorted(templates, key=lambda t: -t.priority)
+    for n, low in enumerate(ordered):
+        for high in ordered[:n]:
+            if isinstance(low, VoxelTemplate):
+                resolve_voxel_overlap(low, high)
+                continue
+            x0, y0 = max(low.x, high.x), max(low.y, high.y)
+            x1 = min(low.x + low.img.shape[1], high.x + high.img.shape[1])
+            y1 = min(low.y + low.img.shape[0], high.y + high.img.shape[0])
+            if x0 >= x1 or y0 >= y1:
+                continue
+            covered = high.img[y0 - high.y:y1 - high.y, x0 - high.x:x1 - high.x] != 255
+            low.damage.target[y0 - low.y:y1 - low.y, x0 - low.x:x1 - low.x][covered] = 255
+
+# the same for two voxel templates
+def resolve_voxel_overlap(low, high):
+    (lh, ld, lw), (hh, hd, hw) = low.volume.shape, high.volume.shape
+    x0, y0, z0 = max(low.x, high.x), max(low.y, high.y), max(low.z, high.z)
+    x1, y1, z1 = min(low.x + lw, high.x + hw), min(low.y + lh, high.y + hh), min(low.z + ld, high.z + hd)
+    if x0 >= x1 or y0 >= y1 or z0 >= z1:
+        return
+    covered = high.volume[y0 - high.y:y1 - high.y, z0 - high.z:z1 - high.z, x0 - high.x:x1 - high.x] != 255
+    target = low.damage.target.reshape(low.volume.shape)
+    target[y0 - low.y:y1 - low.y, z0 - low.z:z1 - low.z, x0 - low.x:x1 - low.x][covered] = 255
+
+# merges templates into one, higher priority ones on top
+def composite_template(templates, canv_desc):
+    x0, y0 = min(t.x for t in templates), min(t.y for t in templates)
+    x1 = max(t.x + t.img.shape[1] for t in templates)
+    y1 = max(t.y + t.img.shape[0] for t in templates)
+    img = np.full((y1 - y0, x1 - x0), 255, np.uint8)
+    for t in sorted(templates, key=lambda t: t.priority):
+        part = img[t.y - y0:t.y - y0 + t.img.shape[0], t.x - x0:t.x - x0 + t.img.shape[1]]
+        np.copyto(part, t.img, where=t.img != 255)
+    return Template(img, x0, y0, canv_desc)
+
+# returns (template, (x, y)) of a damaged pixel from the first template that has one,
+# or (None, None) on timeout. all templates must share the same damage condition
+def pop_damage(templates, timeout=None):
+    cond = templates[0].damage.cond
+    with cond:
+        while True:
+            for t in templates:
+                if t.damage.backlog() > 0:
+                    return t, t.damage.pop()
+            if not cond.wait(timeout):
+                return None, None
+
+# fixes a damaged pixel of a template
+def defend_pixel(ws, canv_id, t, x, y):
+    if not ws.connected:
+        # try again after reconnecting
+        t.damage.mark(x, y)
+        raise ConnectionClosedError('connection closed')
+    # it might have been fixed in the meantime
+    if not t.damage.is_damaged(x, y, t.canvas_color(x, y)):
+        return
+    console.event('defend', **dict(zip('xyz', t.position(x, y))), backlog=t.damage.backlog())
+    if t.place(ws, canv_id, x, y).rc != 0:
+        # try again later
+        t.damage.mark(x, y)
+
+# draws a template, area by area
+# damage to the (already drawn) higher priority templates is fixed first
+def draw_template(ws, canv_id, t, higher):
+    areas = t.work_areas()
+    # huge templates carry on from the area they were at (also after a restart, see Checkpoint)
+    first = t.area if t.tiled else 0
+    if t.progress is None:
+        t.progress = [0, 0, first]
+    progress = t.progress
+    for n in range(first, len(areas)):
+        area = areas[n]
+        t.area = n
+        if not t.tiled:
+            draw_area(ws, canv_id, t, higher, area, progress, n, len(areas))
+            continue
+        # page the chunks of this area in, and start getting the ones of the next area
+        keys = t.chunks(area)
+        canvas_store.pin(keys)
+        try:
+            canvas_store.load(keys, max_age=CHUNK_MAX_AGE)
+            if n + 1 < len(areas):
+                canvas_store.prefetch(t.chunks(areas[n + 1]), max_age=CHUNK_MAX_AGE)
+            draw_area(ws, canv_id, t, higher, area, progress, n - progress[2], len(areas) - progress[2])
+        finally:
+            canvas_store.unpin(keys)
+    t.area = len(areas)
+    t.drawn = True
+
+# draws area number n (out of count) of a template
+def draw_area(ws, canv_id, t, higher, area, progress, n, count):
+    global pixels_drawn
+
+    # only the pixels that actually differ, ordered by the strategy
+    x0, y0, x1, y1 = area
+    mask = t.damage.mismatched(t.region(area), x0, y0)
+    stream = STRATEGIES[t.strategy].plan(mask, t.damage.window(x0, y0, x1, y1))
+    stream = OffsetPixelStream(stream, x0, y0, x1 - x0, y1 - y0)
+    t.damage.stream = stream
+    progress[1] += stream.remaining()
+
     try:
-        global me, draw, succ, chunk_data, pixels_drawn, start_time
-
-        size = img.shape
-        canv_sz = me['canvases'][str(canv_id)]['size']
-        canv_clr = me['canvases'][str(canv_id)]['colors']
-
-        # fill a list of coordinates based on the strategy
-        coords = []
-        if strategy == 'forward':
-            for y in range(size[0]):
-                for x in range(size[1]):
-                    coords.append((x, y))
-        elif strategy == 'backward':
-            for y in range(size[0] - 1, -1, -1):
-                for x in range(size[1] - 1, -1, -1):
-                    coords.append((x, y))
-        elif strategy == 'rtl':
-            for x in range(size[1] - 1, -1, -1):
-                for y in range(size[0]):
-                    coords.append((x, y))
-        elif strategy == 'ltr':
-            for x in range(size[1]):
-                for y in range(size[0]):
-                    coords.append((x, y))
-        elif strategy == 'random':
-            for y in range(size[0]):
-                for x in range(size[1]):
-                    coords.append((x, y))
-            random.shuffle(coords)
-
-        # calculate position in the chunk data array
-        start_in_d_x = draw_x + ((canv_sz // 2) - (c_start_x * 256))
-        start_in_d_y = draw_y + ((canv_sz // 2) - (c_start_y * 256))
+        while True:
+            profiler.hook()
+            if len(higher) > 0:
+                h, coord = pop_damage(higher, timeout=0)
+                if h is not None:
+                    defend_pixel(ws, canv_id, h, *coord)
+                    continue
+
+            coord = stream.next()
+            if coord is None:
+                break
+            x, y = coord
+            progress[0] += 1
+
+            # we need to compare actual color values and not indicies
+            # because water and land have seprate indicies, but the same color values
+            #  as regular colors
+            while t.damage.is_damaged(x, y, t.canvas_color(x, y)):
+                c_idx = t.img[y, x]
+                # the areas that haven't been looked at are assumed to be like the ones that have
+                pixels_remaining = stream.remaining() + progress[1] * (count - n - 1) // (n + 1)
+                sec_per_px = (datetime.datetime.now() - start_time).total_seconds() / pixels_drawn
+                console.event('place', **dict(zip('xyz', t.position(x, y))), color=int(c_idx),
+                    progress=(progress[0] - 1) * 100 / (progress[0] + pixels_remaining), placed=pixels_drawn,
+                    eta=round(pixels_remaining * sec_per_px))
+
+                # try to draw it, retrying on errors
+                if t.place(ws, canv_id, x, y).rc == 0:
+                    pixels_drawn += 1
+                    break
+    finally:
+        t.damage.stream = None
+        # (what's left is planned again next time)
+        progress[1] -= stream.remaining()
+
+# draws the templates in the order of their priority, then defends them
+def draw_function(ws, canv_id, templates):
+    templates = sorted(templates, key=lambda t: -t.priority)
+
+    finished = []
+    for t in templates:
+        draw_template(ws, canv_id, t, [f for f in finished if f.defend])
+        finished.append(t)
+
+    console.print(f'{Fore.GREEN}Done drawing{Style.RESET_ALL}')
+    defended = [t for t in templates if t.defend]
+    if len(defended) == 0:
+        return
+    console.print(f'{Fore.GREEN}Entering defend mode{Style.RESET_ALL}')
 
+    # do the same thing, but only for pixels that have been changed
+    while True:
+        profiler.hook()
+        start = time.perf_counter()
+        t, coord = pop_damage(defended, timeout=1)
+        metrics.inc('defend_wait_seconds_total', time.perf_counter() - start)
+        if t is not None:
+            defend_pixel(ws, canv_id, t, *coord)
+
+# the drawing thread, there's only one and it survives reconnects:
+# when the connection is lost, it waits for the next one (and the resync) and carries on
+# (the templates are planned again, so only the pixels that still differ are drawn, huge ones from their current area)
+def draw_worker(ws, canv_id, templates):
+    global start_time
+    # (a checkpoint may have set it already)
+    if start_time is None:
         start_time = datetime.datetime.now()
-        draw = True
-
-        while len(coords) > 0:
-            # get a coordinate
-            coord = coords[0]
-            x, y = (coord)
-            coords.remove(coord)
-
-            # check if the pixel is transparent
-            if img[y, x] == 255:
-                continue
-
-            succ = False
-            while not succ:
-                # we need to compare actual color values and not indicies
-                # because water and land have seprate indicies, but the same color values
-                #  as regular colors
-                if canv_clr[chunk_data[start_in_d_y + y, start_in_d_x + x]] != canv_clr[img[y, x]]:
-                    c_idx = img[y, x]
-                    pixels_remaining = len(coords)
-                    sec_per_px = (datetime.datetime.now() - start_time).total_seconds() / pixels_drawn
-                    time_remaining = datetime.timedelta(seconds=(pixels_remaining * sec_per_px))
-                    print(f'{Fore.YELLOW}Placing a pixel at {Fore.GREEN}({x + draw_x}, {y + draw_y})' + 
-                        f'{Fore.YELLOW}, color index: {Fore.GREEN}{c_idx}', end="")
-                    if strategy == "forward":
-                        print(f'{Fore.YELLOW}, progress: {Fore.GREEN}{"{:2.4f}".format((y * size[0] + x) * 100 / (size[0] * size[1]))}%' +
-                              f'{Fore.YELLOW}, {Fore.GREEN}{pixels_drawn}{Fore.YELLOW} pixels placed{Style.RESET_ALL}')
-                    elif strategy == "backward":
-                        print(f'{Fore.YELLOW}, progress: {Fore.GREEN}{"{:2.4f}".format(100 - (y * size[0] + x) * 100 / (size[0] * size[1]))}%' +
-                              f'{Fore.YELLOW}, {Fore.GREEN}{pixels_drawn}{Fore.YELLOW} pixels placed{Style.RESET_ALL}')
-                    elif strategy == "random":
-                        print(f'{Fore.YELLOW}, {Fore.GREEN}{pixels_drawn}{Fore.YELLOW} pixels placed{Style.RESET_ALL}')
-                        
-                    # try to draw it
-                    while not draw:
-                        time.sleep(0.25)
-                    draw = False
-                    place_pixel(ws, canv_id, x + draw_x, y + draw_y, c_idx)
-                    # this flag will be reset when the other thread receives a confirmation message
-                    while not draw:
-                        time.sleep(0.25)
-                    if succ:
-                        pixels_drawn += 1
-                    # wait half a second
-                    # (a little bit of artifical fluctuation
-                    #  so the server doesn't think we're a bot)
-                    time.sleep(0.5 + random.uniform(-0.25, 0.25))
+    while True:
+        connection = pipeline.connection
+        try:
+            draw_function(ws, canv_id, templates)
+            return
+        except ConnectionClosedError:
+            offline_since = datetime.datetime.now()
+            pipeline.wait_open(connection)
+            # the time spent offline doesn't count towards the drawing speed
+            start_time += datetime.datetime.now() - offline_since
+        except requests.RequestException as e:
+            # a chunk of a huge template couldn't be downloaded, try that area again later
+            console.print(f'{Fore.RED}Failed to download a chunk ({e}), retrying in {ERROR_DELAY}s{Style.RESET_ALL}')
+            time.sleep(ERROR_DELAY)
+
+# checkpoints: the canvas tiles and the drawing progress are saved periodically,
+# so that a restart doesn't have to download everything and start over
+# a checkpoint file is CHECKPOINT_MAGIC, the length of a JSON header (4 bytes), the header, padding up to
+# a multiple of CHECKPOINT_ALIGN and the raw data of every tile (of chunk_bytes each) in the header's order
+CHECKPOINT_MAGIC = b'PPF2CKP\x02'
+CHECKPOINT_ALIGN = 4096
+# how often a checkpoint is saved, in seconds
+CHECKPOINT_INTERVAL = 60
+# tiles that haven't been kept current for longer than this many seconds are downloaded again after a restart
+CHECKPOINT_MAX_AGE = 600
+
+# where the tiles start in a checkpoint with a header of that many bytes
+def checkpoint_data_offset(header_length):
+    return -(-(len(CHECKPOINT_MAGIC) + 4 + header_length) // CHECKPOINT_ALIGN) * CHECKPOINT_ALIGN
+
+# saves and loads checkpoints
+class Checkpoint(object):
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.lock = threading.Lock()
+        # what was saved last time, so that nothing is written if nothing has changed
+        self.saved = None
+        # when every tile was last known to be current
+        self.current_at = {}
+
+    # writes a checkpoint to a temporary file and swaps it in
+    # current tells if the tiles of the registered chunks are current (we're connected and receive updates)
+    def save(self, current):
+        with self.lock:
+            state = (canvas_store.version, pixels_drawn, tuple(t.area for t in templates))
+            if state == self.saved:
+                return
+            now = time.time()
+            tiles = canvas_store.snapshot()
+            registered = set(c for t in templates for c in t.chunks()) if current else set()
+            for key, _, fetched_at in tiles:
+                if key in registered:
+                    self.current_at[key] = now
                 else:
-                    succ = True
-
-        print(f'{Fore.GREEN}Done drawing{Style.RESET_ALL}')
-        if not defend:
+                    self.current_at[key] = max(self.current_at.get(key, 0), fetched_at)
+            header = json.dumps({
+                'server': SERVER_URL,
+                'canv_id': canvas_store.d,
+                'saved_at': now,
+                'tiles': [[i, j, self.current_at[(i, j)]] for (i, j), _, _ in tiles],
+                'activity': chunk_activity.state(),
+                'pixels_drawn': pixels_drawn,
+                'drawing_time': (datetime.datetime.now() - start_time).total_seconds() if start_time is not None else 0,
+                'templates': [{'path': t.path, 'x': t.x, 'y': t.y, 'shape': list(t.img.shape), 'area': t.area}
+                              for t in templates],
+            }).encode()
+            with open(self.file_path + '.tmp', 'wb') as f:
+                f.write(CHECKPOINT_MAGIC + struct.pack('<I', len(header)) + header)
+                f.seek(checkpoint_data_offset(len(header)))
+                for _, tile, _ in tiles:
+                    f.write(tile)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(self.file_path + '.tmp', self.file_path)
+            self.saved = state
+
+    # loads the checkpoint, if there is one for this canvas
+    # tiles that are current enough are put into the canvas store, the rest is left to be downloaded
+    def restore(self):
+        global pixels_drawn, start_time
+        try:
+            with open(self.file_path, 'rb') as f:
+                if f.read(len(CHECKPOINT_MAGIC)) != CHECKPOINT_MAGIC:
+                    raise ValueError('not a checkpoint')
+                length = struct.unpack('<I', f.read(4))[0]
+                header = json.loads(f.read(length))
+        except FileNotFoundError:
             return
-        print(f'{Fore.GREEN}Entering defend mode{Style.RESET_ALL}')
-
-        # do the same thing, but now in a loop that checks everything once per second
+        except (OSError, ValueError, struct.error) as e:
+            console.print(f'{Fore.RED}Ignoring the checkpoint {self.file_path}: {e}{Style.RESET_ALL}')
+            return
+        if header['server'] != SERVER_URL or header['canv_id'] != canvas_store.d:
+            console.print(f'{Fore.RED}Ignoring the checkpoint {self.file_path}, it\'s for another canvas{Style.RESET_ALL}')
+            return
+        offset = checkpoint_data_offset(length)
+        now = time.time()
+        chunk_activity.restore(header['activity'])
+        data = np.memmap(self.file_path, np.uint8, 'r', offset, (len(header['tiles']), canvas_store.chunk_bytes)) \
+            if len(header['tiles']) > 0 else []
+        # tiles that were current a while ago, or that have probably changed since, are downloaded again
+        reused = 0
+        for n, (i, j, current_at) in enumerate(header['tiles']):
+            key = (i, j)
+            if now - current_at >= CHECKPOINT_MAX_AGE or len(chunk_activity.likely_changed([key], current_at, now)) > 0:
+                continue
+            canvas_store.put(key, data[n].tobytes())
+            self.current_at[key] = current_at
+            reused += 1
+        del data
+        # the drawing progress
+        pixels_drawn = header['pixels_drawn']
+        start_time = datetime.datetime.now() - datetime.timedelta(seconds=header['drawing_time'])
+        for t in templates:
+            for saved in header['templates']:
+                if [saved['path'], saved['x'], saved['y'], saved['shape']] == [t.path, t.x, t.y, list(t.img.shape)]:
+                    t.area = saved['area']
+        console.print(f'{Fore.YELLOW}Resuming from a checkpoint saved {Fore.GREEN}{now - header["saved_at"]:.0f}s{Fore.YELLOW} ago, ' +
+            f'reusing {Fore.GREEN}{reused}{Fore.YELLOW} of {Fore.GREEN}{len(header["tiles"])}{Fore.YELLOW} tiles{Style.RESET_ALL}')
+
+    def _run(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.save(ws is not None and ws.connected)
+            except OSError as e:
+                console.print(f'{Fore.RED}Failed to save the checkpoint: {e}{Style.RESET_ALL}')
+
+    # saves checkpoints periodically in the background
+    def start(self, interval=CHECKPOINT_INTERVAL):
+        threading.Thread(target=self._run, args=(interval,), name='Checkpoint', daemon=True).start()
+
+# dry runs: what differs from the canvas and how long drawing it will take, without placing anything
+# how many chunks and colors are listed
+DRY_RUN_TOP = 20
+# the cooldown is simulated for at most this many pixels, the time the rest takes is extrapolated
+DRY_RUN_SIMULATED = 1000000
+# the assumed round trip time of a placement, in seconds
+DRY_RUN_RTT = 0.1
+
+# simulates placing pixels that add `costs` ms of cooldown each, one after another, like PlacementPipeline does:
+# the next pixel is placed after PLACE_INTERVAL, or after the cooldown of the last one if the total
+# cooldown has reached COOLDOWN_THRESHOLD. pixels that would stack more than cds ms of cooldown are rejected
+# (and placed again after ERROR_DELAY). cooldown_ms is the total cooldown at the start (see 0xC2)
+# returns how long it takes, in seconds
+def simulate_cooldown(costs, cds, cooldown_ms=0, rtt=DRY_RUN_RTT):
+    now, cooldown_end = 0.0, cooldown_ms / 1000
+    for cost in costs:
         while True:
-            for y in range(size[0]):
-                for x in range(size[1]):
-                    if img[y, x] == 255:
-                        continue
-                    if canv_clr[chunk_data[start_in_d_y + y, start_in_d_x + x]] != canv_clr[img[y, x]]:
-                        print(f'{Fore.YELLOW}[DEFENDING] Placing a pixel at {Fore.GREEN}({x + draw_x}, {y + draw_y}){Style.RESET_ALL}')
-
-                        c_idx = img[y, x]
-                        while not draw:
-                            time.sleep(0.25)
-                        draw = False
-                        place_pixel(ws, canv_id, x + draw_x, y + draw_y, c_idx)
-
-                        while not draw:
-                            time.sleep(0.25)
-                        time.sleep(0.5 + random.uniform(-0.25, 0.25))
-            time.sleep(1)
-    except websocket.WebSocketConnectionClosedException:
-        # BAIL
+            cooldown_end = max(cooldown_end, now)
+            if (cooldown_end - now) * 1000 > cds:
+                now += rtt + ERROR_DELAY
+                continue
+            cooldown_end += cost / 1000
+            if (cooldown_end - now) * 1000 >= COOLDOWN_THRESHOLD:
+                now += rtt + round(cost / 1000) + 1
+            else:
+                now += rtt + PLACE_INTERVAL
+            break
+    return now
+
+# the pixels of templates that differ from the canvas, by chunk and by color
+class DiffReport(object):
+    def __init__(self, canv_desc):
+        self.canv_desc = canv_desc
+        # template pixels we care about, how many of them differ and how many of those are unset on the canvas
+        self.total = 0
+        self.differ = 0
+        self.unset = 0
+        self.chunks = {}
+        self.colors = np.zeros(256, np.int64)
+        # the cooldowns of the first DRY_RUN_SIMULATED differing pixels
+        self.costs = []
+        self.n_costs = 0
+
+    # adds an area (x0, y0, x1, y1) of template t, its chunks have to be loaded
+    def add(self, t, area):
+        x0, y0, x1, y1 = area
+        region = t.region(area)
+        mask = t.damage.mismatched(region, x0, y0)
+        self.total += int(np.count_nonzero(t.damage.target[y0:y1, x0:x1] != 255))
+        ys, xs = np.nonzero(mask)
+        if len(xs) == 0:
+            return
+        self.differ += len(xs)
+        i, j = t.chunk_of(xs + x0, ys + y0)
+        keys, counts = np.unique(np.stack((i, j)), axis=1, return_counts=True)
+        for key, n in zip(map(tuple, keys.T.tolist()), counts.tolist()):
+            self.chunks[key] = self.chunks.get(key, 0) + n
+        self.colors += np.bincount(t.img[y0:y1, x0:x1][mask], minlength=256)
+        # placing over an unset (background) pixel adds less cooldown
+        unset = region[mask] < self.canv_desc['cli']
+        self.unset += int(np.count_nonzero(unset))
+        room = DRY_RUN_SIMULATED - self.n_costs
+        if room > 0:
+            costs = np.where(unset[:room], self.canv_desc.get('bcd', 0), self.canv_desc.get('pcd', 0))
+            self.costs.append(costs)
+            self.n_costs += len(costs)
+
+    # how long drawing the differing pixels will take, in seconds
+    def estimate(self, cooldown_ms=0):
+        if self.n_costs == 0:
+            return 0
+        costs = np.concatenate(self.costs).tolist()
+        seconds = simulate_cooldown(costs, self.canv_desc.get('cds', 60000), cooldown_ms)
+        return seconds * self.differ / self.n_costs
+
+    def print(self):
+        half = self.canv_desc['size'] // 2
+        tile = THREE_TILE_SIZE if 'v' in self.canv_desc else CHUNK_SIZE
+        console.print(f'{Fore.YELLOW}Pixels that differ: {Fore.GREEN}{self.differ}{Fore.YELLOW} of {Fore.GREEN}{self.total}' +
+            f'{Fore.YELLOW} ({Fore.GREEN}{self.differ / max(self.total, 1) * 100:.2f}%{Fore.YELLOW}), ' +
+            f'{Fore.GREEN}{self.unset}{Fore.YELLOW} of them unset{Style.RESET_ALL}')
+        if self.differ == 0:
+            return
+        console.print(f'{Fore.YELLOW}By chunk (chunk X, Y: canvas X, {"Z" if "v" in self.canv_desc else "Y"} of its top-left corner):{Style.RESET_ALL}')
+        by_chunk = sorted(self.chunks.items(), key=lambda item: -item[1])
+        for (i, j), n in by_chunk[:DRY_RUN_TOP]:
+            console.print(f'  {Fore.YELLOW}{i:3}, {j:3}: {i * tile - half:6}, {j * tile - half:6}  {Fore.GREEN}{n}{Style.RESET_ALL}')
+        if len(by_chunk) > DRY_RUN_TOP:
+            console.print(f'  {Fore.YELLOW}... and {len(by_chunk) - DRY_RUN_TOP} more chunks{Style.RESET_ALL}')
+        console.print(f'{Fore.YELLOW}By color:{Style.RESET_ALL}')
+        by_color = [(c, n) for c, n in enumerate(self.colors.tolist()) if n > 0 and c < len(self.canv_desc['colors'])]
+        for c, n in sorted(by_color, key=lambda item: -item[1])[:DRY_RUN_TOP]:
+            r, g, b = self.canv_desc['colors'][c]
+            console.print(f'  {Fore.YELLOW}{c:3} #{r:02x}{g:02x}{b:02x}  {Fore.GREEN}{n}{Style.RESET_ALL}')
+        if len(by_color) > DRY_RUN_TOP:
+            console.print(f'  {Fore.YELLOW}... and {len(by_color) - DRY_RUN_TOP} more colors{Style.RESET_ALL}')
+        console.print(f'{Fore.YELLOW}Estimated drawing time: {Fore.GREEN}{datetime.timedelta(seconds=round(self.estimate()))}' +
+            f'{Fore.YELLOW} (bcd {self.canv_desc.get("bcd", 0)} ms, pcd {self.canv_desc.get("pcd", 0)} ms, ' +
+            f'cds {self.canv_desc.get("cds", 60000)} ms, no cooldown at the start){Style.RESET_ALL}')
+
+# loads the canvas under the templates area by area and reports what differs
+def dry_run(templates, canv_desc):
+    report = DiffReport(canv_desc)
+    console.print(f'{Fore.YELLOW}Dry run, comparing the templates with the canvas{Style.RESET_ALL}')
+    for t in sorted(templates, key=lambda t: -t.priority):
+        areas = t.work_areas()
+        for n, area in enumerate(areas):
+            keys = t.chunks(area)
+            canvas_store.pin(keys)
+            try:
+                canvas_store.load(keys, max_age=CHUNK_MAX_AGE)
+                if n + 1 < len(areas):
+                    canvas_store.prefetch(t.chunks(areas[n + 1]), max_age=CHUNK_MAX_AGE)
+                report.add(t, area)
+            finally:
+                canvas_store.unpin(keys)
+    report.print()
+    return report
+
+# asks the user about an image to draw
+def ask_template(image):
+    image.path = ask(f'{Fore.YELLOW}Enter a path to the image:{Style.RESET_ALL} ')
+
+    image.x = int(ask(f'{Fore.YELLOW}Enter the X coordiante of the top-left corner:{Style.RESET_ALL} '))
+    image.y = int(ask(f'{Fore.YELLOW}Enter the Y coordiante of the top-left corner:{Style.RESET_ALL} '))
+
+    # defend the image?
+    image.defend = ''
+    while image.defend not in ['y', 'n', 'yes', 'no']:
+        image.defend = ask(f'{Fore.YELLOW}Defend [y, n]?{Style.RESET_ALL} ').lower()
+    image.defend = image.defend if image.defend in ['y', 'yes'] else False
+
+    # choose a strategy
+    image.strategy = None
+    while image.strategy not in STRATEGIES:
+        console.print(Fore.YELLOW + '\n'.join([f'[{Fore.GREEN}{k}{Fore.YELLOW}] {v.description}' for k, v in STRATEGIES.items()]))
+        image.strategy = ask(f'Choose the drawing strategy [{"/".join(STRATEGIES)}]:{Style.RESET_ALL} ').lower()
+
+    # choose the color matching metric
+    image.metric = None
+    while image.metric not in COLOR_METRICS:
+        image.metric = ask(f'{Fore.YELLOW}Choose the color matching metric [rgb/lab]:{Style.RESET_ALL} ').lower()
+
+    # priority
+    priority = ask(f'{Fore.YELLOW}Enter the priority (images with a higher priority are drawn first, leave empty for 0):{Style.RESET_ALL} ')
+    image.priority = int(priority) if priority != '' else 0
+
+# asks about the Z coordinate of an image on a voxel canvas (the X and Y ones have been asked already)
+def ask_voxel_position(image):
+    console.print(f'{Fore.YELLOW}That\'s a 3D canvas: the image is a .npy array or a directory of the images of its layers, ' +
+        f'Y is the height of its bottom layer{Style.RESET_ALL}')
+    image.z = int(ask(f'{Fore.YELLOW}Enter the Z coordiante of the corner:{Style.RESET_ALL} '))
+
+# delays between reconnection attempts, in seconds
+RECONNECT_MIN_DELAY = 1
+RECONNECT_MAX_DELAY = 60
+# a connection that lasted this many seconds resets the delay
+RECONNECT_STABLE = 30
+
+# exponential backoff with full jitter: the delay is random, up to a limit that doubles after every attempt
+class Backoff(object):
+    def __init__(self, base=RECONNECT_MIN_DELAY, cap=RECONNECT_MAX_DELAY):
+        self.base, self.cap = base, cap
+        self.attempt = 0
+
+    def next(self):
+        limit = min(self.cap, self.base * 2 ** min(self.attempt, 30))
+        self.attempt += 1
+        return random.uniform(0, limit)
+
+    def reset(self):
+        self.attempt = 0
+
+# parses the command line
+def parse_args():
+    parser = argparse.ArgumentParser(description='PixelPlanet bot')
+    parser.add_argument('preset', nargs='*', help='configuration preset to load')
+    parser.add_argument('--json-log', metavar='FILE', help='also write events to FILE as JSON lines')
+    parser.add_argument('--preview', action='store_true', help='show a live preview window')
+    parser.add_argument('--snapshot', metavar='FILE', help='periodically save a preview snapshot to a PNG file')
+    parser.add_argument('--snapshot-interval', metavar='SEC', type=float, default=60,
+        help='how often to save the snapshot (default: 60)')
+    parser.add_argument('--notify', metavar='SINKS', default='sound',
+        help=f'how to notify you when CAPTCHA is needed, comma-separated: {", ".join(NOTIFY_SINKS)} (default: sound)')
+    parser.add_argument('--webhook', metavar='URL', help='post notifications to a (Discord or Slack) webhook')
+    parser.add_argument('--sound', metavar='FILE',
+        help='the WAV file to play for sound notifications (default: notif.wav, downloaded if it\'s not there)')
+    parser.add_argument('--metrics-port', metavar='PORT', type=int,
+        help='serve metrics (Prometheus) and profilers at http://127.0.0.1:PORT/metrics')
+    parser.add_argument('--server', metavar='URL',
+        help=f'use another server, e.g. a local simulator at http://127.0.0.1:8080 (default: {SERVER_URL})')
+    parser.add_argument('--record', metavar='FILE',
+        help='record the messages received from and sent to the server, and the downloaded chunks, to FILE')
+    parser.add_argument('--replay', metavar='FILE', help='replay a recording instead of connecting to the server')
+    parser.add_argument('--replay-speed', metavar='X', type=float, default=1,
+        help='replay the recording X times faster, 0 = as fast as possible (default: 1)')
+    parser.add_argument('--checkpoint', metavar='FILE',
+        help='periodically save the canvas and the drawing progress to FILE, and resume from it when restarted')
+    parser.add_argument('--dry-run', action='store_true',
+        help='only report what differs from the canvas and estimate how long drawing it will take')
+    parser.add_argument('--lut', metavar='BITS', type=int, choices=range(5, 9),
+        help='convert the images through a color lookup table with BITS bits per channel: faster for big images, ' +
+             'but approximate below 8 (with 5, 3-5%% of the pixels may get a slightly different color)')
+    args = parser.parse_args()
+    if args.record and args.replay:
+        parser.error('--record and --replay can\'t be used together')
+    return args
+
+# how long to wait for the version check, in seconds
+UPDATE_CHECK_TIMEOUT = 5
+# how long the cached api/me response is used for, in seconds
+ME_CACHE_TTL = 6 * 60 * 60
+
+# downloads a new version if there is one
+# runs in the background, the new version is used the next time the bot is started
+def check_for_updates():
+    # get the version on the server
+    try:
+        server_verdef = sess.get(VERDEF_URL, timeout=UPDATE_CHECK_TIMEOUT).text
+        server_num = int(server_verdef.split('\n')[1])
+    except (requests.RequestException, ValueError, IndexError) as e:
+        console.print(f'{Fore.RED}Failed to check for updates: {e}{Style.RESET_ALL}')
         return
+    if server_num > VERSION_NUM:
+        # update
+        server_ver = server_verdef.split('\n')[0]
+        console.print(f'{Fore.YELLOW}There\'s a new version {Fore.GREEN}{server_ver}{Fore.YELLOW} on the server. Downloading{Style.RESET_ALL}')
+        try:
+            download_file(BOT_URL)
+        except requests.RequestException as e:
+            console.print(f'{Fore.RED}Failed to download the new version: {e}{Style.RESET_ALL}')
+            return
+        console.print(f'{Fore.YELLOW}The new version will be used when you start the bot again{Style.RESET_ALL}')
+    else:
+        console.print(f'{Fore.YELLOW}You\'re running the latest version{Style.RESET_ALL}')
+
+# returns the api/me response (canvas info list and user identifier)
+# it's cached for max_age seconds, so that restarts don't have to wait for it
+def get_me(max_age=ME_CACHE_TTL):
+    cache_path = path.join(CACHE_DIR, 'me.json')
+    try:
+        with open(cache_path) as f:
+            cached = json.load(f)
+        if cached['server'] == SERVER_URL and time.time() - cached['fetched_at'] < max_age:
+            return cached['me']
+    except (OSError, ValueError, KeyError):
+        pass
+    console.print(f'{Fore.YELLOW}Requesting initial data{Style.RESET_ALL}')
+    me = sess.get(f'{SERVER_URL}/api/me', timeout=30).json()
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(cache_path + '.tmp', 'w') as f:
+        json.dump({'server': SERVER_URL, 'fetched_at': time.time(), 'me': me}, f)
+    os.replace(cache_path + '.tmp', cache_path)
+    return me
+
+# the WebSocket URL of a server
+def server_ws_url(server_url):
+    u = urllib.parse.urlsplit(server_url)
+    return urllib.parse.urlunsplit(('wss' if u.scheme == 'https' else 'ws', u.netloc, '/ws', '', ''))
 
 def main():
-    global me, draw, succ, chunk_data, config, sess
+    global me, canvas_store, templates, preview, pipeline, config, sess, chunk_loader, ws, notifier, recorder, SERVER_URL, WS_URL
+    args = parse_args()
+    notifier = Notifier(make_sinks([n.strip() for n in args.notify.split(',') if n.strip()], args.webhook,
+                                   path.expanduser(args.sound or 'notif.wav')))
+    if args.json_log:
+        console.open_json(args.json_log)
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port)
+    if args.server:
+        SERVER_URL = args.server.rstrip('/')
+        WS_URL = server_ws_url(SERVER_URL)
     sess = requests.Session()
     sess.headers['user-agent'] = "Copium"
-    print(sess.headers['user-agent'])
+    console.print(sess.headers['user-agent'])
+    recording = None
+    if args.replay:
+        try:
+            recording = Recording(args.replay)
+            recorded = recording.info()
+        except (OSError, ValueError) as e:
+            console.print(f'{Fore.RED}Failed to open the recording: {e}{Style.RESET_ALL}')
+            exit()
+        chunk_loader = ReplayChunkLoader(recording)
+    else:
+        chunk_loader = ChunkLoader(sess, SERVER_URL)
+    pipeline = PlacementPipeline()
     # initialize colorama
     init()
 
-    # get the version on the server
-    print(f'{Fore.YELLOW}PixelPlanet bot by portasynthinca3 version {Fore.GREEN}{VERSION}{Fore.YELLOW}' +
+    console.print(f'{Fore.YELLOW}PixelPlanet bot by portasynthinca3 version {Fore.GREEN}{VERSION}{Fore.YELLOW}' +
         f' released on {Fore.GREEN}{VERSION_DATE}{Fore.YELLOW}' + 
-        f'\nNew features in this version: \n{Fore.GREEN}{VERSION_FEATURES}{Fore.YELLOW}'
-        f'\nChecking for updates{Style.RESET_ALL}')
-    server_verdef = sess.get(VERDEF_URL).text
-    if int(server_verdef.split('\n')[1]) > VERSION_NUM:
-        # update
-        server_ver = server_verdef.split('\n')[0]
-        print(f'{Fore.YELLOW}There\'s a new version {Fore.GREEN}{server_ver}{Fore.YELLOW} on the server. Downloading{Style.RESET_ALL}')
-        with open('ppfun2.py', 'wb') as bot_file:
-            bot_file.write(sess.get(BOT_URL).content)
-        print(f'{Fore.YELLOW}Please start the bot again{Style.RESET_ALL}')
-        exit()
+        f'\nNew features in this version: \n{Fore.GREEN}{VERSION_FEATURES}{Style.RESET_ALL}')
+    if args.replay:
+        console.print(f'{Fore.YELLOW}Replaying {Fore.GREEN}{args.replay}{Fore.YELLOW} recorded on {Fore.GREEN}{recorded["server"]}{Fore.YELLOW}' +
+            f' by version {Fore.GREEN}{recorded["version"]}{Fore.YELLOW}, not checking for updates{Style.RESET_ALL}')
+    elif args.server:
+        console.print(f'{Fore.YELLOW}Using the server at {Fore.GREEN}{SERVER_URL}{Fore.YELLOW}, not checking for updates{Style.RESET_ALL}')
     else:
-        print(f'{Fore.YELLOW}You\'re running the latest version{Style.RESET_ALL}')
+        threading.Thread(target=check_for_updates, name='Update check', daemon=True).start()
+    # get the notification sound (if it's needed) and the notifications ready in the background
+    # (the default sound comes from GitHub, which isn't contacted when using another server or replaying)
+    def prepare_notifications():
+        if any(isinstance(sink, SoundSink) for sink in notifier.sinks) and not (args.sound or args.server or args.replay) \
+                and importlib.util.find_spec('pyaudio') is not None:
+            fetch_notification_sound()
+        notifier.start()
+    threading.Thread(target=prepare_notifications, name='Notification setup', daemon=True).start()
 
     # get canvas info list and user identifier
-    print(f'{Fore.YELLOW}Requesting initial data{Style.RESET_ALL}')
-    me = sess.get('https://pixelplanet.fun/api/me').json()
+    me = recorded['me'] if args.replay else get_me()
 
     # try to load the config file
     try:
-        config_path = ' '.join(sys.argv[1:])
+        config_path = ' '.join(args.preset)
         with open(config_path, 'rb') as cf:
             config = pickle.load(cf)
     except:
@@ -391,16 +3435,14 @@ def main():
 
     if config.image.path == "":
         # ask for login and password
-        print(f'{Fore.YELLOW}Enter your PixelPlanet username or e-mail (leave empty to skip authorization): {Style.RESET_ALL}', end='')
-        config.auth.login = input()
+        config.auth.login = ask(f'{Fore.YELLOW}Enter your PixelPlanet username or e-mail (leave empty to skip authorization): {Style.RESET_ALL}')
         config.auth.passwd = ''
         auth_token = ''
         if config.auth.login != '':
-            config.auth.passwd = getpass.getpass(f'{Fore.YELLOW}Enter your PixelPlanet password: {Style.RESET_ALL}')
+            config.auth.passwd = ask_secret(f'{Fore.YELLOW}Enter your PixelPlanet password: {Style.RESET_ALL}')
 
         # ask for proxy
-        print(f'{Fore.YELLOW}Enter your proxy (host:port), leave empty to not use a proxy: {Style.RESET_ALL}', end='')
-        config.proxy.host = input()
+        config.proxy.host = ask(f'{Fore.YELLOW}Enter your proxy (host:port), leave empty to not use a proxy: {Style.RESET_ALL}')
         config.proxy.port = None
         config.proxy.user = ''
         config.proxy.passwd = ''
@@ -408,231 +3450,225 @@ def main():
             config.proxy.port = int(config.proxy.host.split(':')[1])
             config.proxy.host = config.proxy.host.split(':')[0]
 
-            print(f'{Fore.YELLOW}Enter your proxy username: {Style.RESET_ALL}', end='')
-            config.proxy.user = input()
-            config.proxy.passwd = getpass.getpass(f'{Fore.YELLOW}Enter your proxy password: {Style.RESET_ALL}')
+            config.proxy.user = ask(f'{Fore.YELLOW}Enter your proxy username: {Style.RESET_ALL}')
+            config.proxy.passwd = ask_secret(f'{Fore.YELLOW}Enter your proxy password: {Style.RESET_ALL}')
 
         # request some info from the user
-        print(f'{Fore.YELLOW}Enter a path to the image:{Style.RESET_ALL} ', end='')
-        config.image.path = input()
-
-        print(f'{Fore.YELLOW}Enter the X coordiante of the top-left corner:{Style.RESET_ALL} ', end='')
-        config.image.x = int(input())
-        print(f'{Fore.YELLOW}Enter the Y coordiante of the top-left corner:{Style.RESET_ALL} ', end='')
-        config.image.y = int(input())
-
-        # defend the image?
-        config.image.defend = ''
-        while config.image.defend not in ['y', 'n', 'yes', 'no']:
-            print(f'{Fore.YELLOW}Defend [y, n]?{Style.RESET_ALL} ', end='')
-            config.image.defend = input().lower()
-        config.image.defend = config.image.defend if config.image.defend in ['y', 'yes'] else False
-
-        # choose a strategy
-        strategies = ['forward', 'backward', 'random', 'rtl', 'ltr']
-        config.image.strategy = None
-        while config.image.strategy not in strategies:
-            print(f'{Fore.YELLOW}Choose the drawing strategy [forward/backward/random/rtl/ltr]:{Style.RESET_ALL} ', end='')
-            config.image.strategy = input().lower()
-        
+        ask_template(config.image)
+
         # choose the canvas
         config.image.canv_id = -1
         while str(config.image.canv_id) not in me['canvases']:
-            print(Fore.YELLOW + '\n'.join(['[' + (Fore.GREEN if ("v" not in me["canvases"][k]) else Fore.RED) + f'{k}{Fore.YELLOW}] ' +
-                                            me['canvases'][k]['title'] for k in me['canvases']]))
-            print(f'Select the canvas [0-{len(me["canvases"]) - 1}]:{Style.RESET_ALL} ', end='')
-            config.image.canv_id = input()
-            if 0 <= int(config.image.canv_id) <= len(me['canvases']) - 1:
-                if 'v' in me['canvases'][config.image.canv_id]:
-                    print(Fore.RED + 'Only 2D canvases are supported' + Style.RESET_ALL)
-                    config.image.canv_id = -1
+            console.print(Fore.YELLOW + '\n'.join(['[' + Fore.GREEN + f'{k}{Fore.YELLOW}] ' + me['canvases'][k]['title'] +
+                                            (' (3D)' if 'v' in me['canvases'][k] else '') for k in me['canvases']]))
+            config.image.canv_id = ask(f'Select the canvas [0-{len(me["canvases"]) - 1}]:{Style.RESET_ALL} ')
         config.image.canv_id = int(config.image.canv_id)
+        voxel = 'v' in me['canvases'][str(config.image.canv_id)]
+        if voxel:
+            ask_voxel_position(config.image)
+
+        # more templates on the same canvas
+        config.images = [config.image]
+        while True:
+            answer = ''
+            while answer not in ['y', 'n', 'yes', 'no']:
+                answer = ask(f'{Fore.YELLOW}Add another image [y, n]?{Style.RESET_ALL} ').lower()
+            if answer in ['n', 'no']:
+                break
+            image = PpfunConfigImage()
+            ask_template(image)
+            if voxel:
+                ask_voxel_position(image)
+            image.canv_id = config.image.canv_id
+            config.images.append(image)
 
         # save the config
-        print(f'{Fore.YELLOW}Enter the configuration preset name (leave empty to not save configuration):{Style.RESET_ALL} ', end='')
-        config_path = input()
+        config_path = ask(f'{Fore.YELLOW}Enter the configuration preset name (leave empty to not save configuration):{Style.RESET_ALL} ')
         if config_path != '':
             config_path = config_path + '.pickle'
             with open(config_path, 'wb') as cf:
                 pickle.dump(config, cf)
-            print(f'{Fore.YELLOW}Configuration was saved. Run {Fore.GREEN}python ppfun2.py {config_path}{Fore.YELLOW} next time to load it{Style.RESET_ALL} ')
+            console.print(f'{Fore.YELLOW}Configuration was saved. Run {Fore.GREEN}python ppfun2.py {config_path}{Fore.YELLOW} next time to load it{Style.RESET_ALL} ')
 
-    # load the image
-    canv_desc = me['canvases'][str(config.image.canv_id)]
-    print(f'{Fore.YELLOW}Loading the image{Style.RESET_ALL}')
-    img = None
-    img_size = (0, 0)
-    try:
-        config.image.path = path.expanduser(config.image.path)
-        img = cv2.imread(config.image.path, cv2.IMREAD_UNCHANGED)
-        img_size = img.shape[:2]
-    except:
-        print(f'{Fore.RED}Failed to load the image. Does it exist? Is it an obscure image format?{Style.RESET_ALL}')
+    # load the images
+    if args.replay and config.image.canv_id != recorded['canv_id']:
+        console.print(f'{Fore.RED}The recording was made on canvas {recorded["canv_id"]}, not {config.image.canv_id}{Style.RESET_ALL}')
         exit()
-    # check if it's JPEG
-    img_extension = path.splitext(config.image.path)[1]
-    if img_extension in ['jpeg', 'jpg']:
-        print(f'{Fore.RED}WARNING: you appear to have loaded a JPEG image. It uses lossy compression, so it\'s not good at all for pixel-art.{Style.RESET_ALL}')
-    
-    # transform the colors
-    print(f'{Fore.YELLOW}Processing the image{Style.RESET_ALL}')
-    color_idxs = np.zeros(img_size, np.uint8)
-    for y in range(img_size[0]):
-        for x in range(img_size[1]):
-            # ignore the pixel if it's transparent
-            transparent = None
-            if img.shape[2] == 3: # the image doesn't have an alpha channel
-                transparent = False
-            else: # the image has an alpha channel
-                transparent = img[y, x][3] <= 128
-            if not transparent:
-                # fetch BGR color
-                bgr = img[y, x]
-                bgr = (int(bgr[0]), int(bgr[1]), int(bgr[2]))
-                # find the nearest one in the palette
-                best_diff = 100000000000000
-                best_no = 0
-                # ignore the first "cli" colors, they show key background and are not allowed in the request
-                for i in range(canv_desc['cli'], len(canv_desc['colors'])):
-                    c_bgr = tuple(canv_desc['colors'][i])
-                    diff = (c_bgr[2] - bgr[0]) ** 2 + (c_bgr[1] - bgr[1]) ** 2 + (c_bgr[0] - bgr[2]) ** 2
-                    if diff < best_diff:
-                        best_diff = diff
-                        best_no = i
-                # store the color idx
-                color_idxs[y, x] = best_no
-            else:
-                color_idxs[y, x] = 255
+    if str(config.image.canv_id) not in me['canvases']:
+        # the cached canvas list is out of date
+        me = get_me(max_age=0)
+    canv_desc = me['canvases'][str(config.image.canv_id)]
+    voxel = 'v' in canv_desc
+    template_cfgs = getattr(config, 'images', None) or [config.image]
+    # all trackers share a condition, so that the drawing thread can wait for damage in any of them
+    damage_cond = threading.Condition()
+    for image in template_cfgs:
+        console.print(f'{Fore.YELLOW}Loading the image {Fore.GREEN}{image.path}{Style.RESET_ALL}')
+        try:
+            image.path = path.expanduser(image.path)
+            half = canv_desc['size'] // 2
+            color_idxs = (load_voxel_template if voxel else load_template)(image.path, canv_desc,
+                getattr(image, 'metric', 'rgb'), args.lut, (half + image.x, half + image.y))
+        except ValueError as e:
+            console.print(f'{Fore.RED}Failed to load the image: {e}{Style.RESET_ALL}')
+            exit()
+        except:
+            console.print(f'{Fore.RED}Failed to load the image. Does it exist? Is it an obscure image format?{Style.RESET_ALL}')
+            exit()
+        # check if it's JPEG
+        img_extension = path.splitext(image.path)[1]
+        if img_extension in ['.jpeg', '.jpg']:
+            console.print(f'{Fore.RED}WARNING: you appear to have loaded a JPEG image. It uses lossy compression, so it\'s not good at all for pixel-art.{Style.RESET_ALL}')
+        if voxel and not 0 <= image.y <= THREE_CANVAS_HEIGHT - color_idxs.shape[0]:
+            console.print(f'{Fore.RED}The image doesn\'t fit: the canvas is {THREE_CANVAS_HEIGHT} voxels high{Style.RESET_ALL}')
+            exit()
+        templates.append((VoxelTemplate if voxel else Template).from_config(image, color_idxs, canv_desc, damage_cond))
+    resolve_overlaps(templates)
+    # (before a template is drawn, its backlog is everything that's left to draw)
+    metrics.set_callback('defend_backlog', lambda: sum(t.damage.backlog() for t in templates if t.defend and t.drawn))
+    canvas_store = (VoxelStore if voxel else CanvasStore)(config.image.canv_id, canv_desc['size'])
+    chunk_loader.chunk_bytes = canvas_store.chunk_bytes
+    if args.dry_run:
+        dry_run(templates, canv_desc)
+        return
+    checkpoint = None
+    if args.checkpoint:
+        checkpoint = Checkpoint(args.checkpoint)
+        checkpoint.restore()
+        checkpoint.start()
 
     # authorize
     extra_ws_headers = []
-    if config.auth.login != '':
-        print(f'{Fore.YELLOW}Authorizing{Style.RESET_ALL}')
-        response = sess.post('https://pixelplanet.fun/api/auth/local', json={
+    if config.auth.login != '' and not args.replay:
+        console.print(f'{Fore.YELLOW}Authorizing{Style.RESET_ALL}')
+        response = sess.post(f'{SERVER_URL}/api/auth/local', json={
             'nameoremail':config.auth.login,
             'password':config.auth.passwd
         })
         resp_js = response.json()
         if 'success' in resp_js and resp_js['success']:
-            print(f'{Fore.YELLOW}Logged in as {Fore.GREEN}{resp_js["me"]["name"]}{Style.RESET_ALL}')
+            console.print(f'{Fore.YELLOW}Logged in as {Fore.GREEN}{resp_js["me"]["name"]}{Style.RESET_ALL}')
             # get the token and add it as a WebSocket cookie
             auth_token = response.cookies.get('pixelplanet.session')
             extra_ws_headers.append("Cookie: pixelplanet.session=" + auth_token)
         else:
-            print(f'{Fore.RED}Authorization failed{Style.RESET_ALL}')
+            console.print(f'{Fore.RED}Authorization failed{Style.RESET_ALL}')
             exit()
 
-    def run_client():
-        global me, draw, succ, chunk_data, config, thr, ws
+    if (args.preview or args.snapshot) and (voxel or any(t.tiled for t in templates)):
+        console.print(f'{Fore.RED}The preview is not available for huge images and 3D canvases{Style.RESET_ALL}')
+    elif args.preview or args.snapshot:
+        preview = LivePreview(config.image.canv_id, composite_template(templates, canv_desc))
+        preview.start(args.preview, args.snapshot, args.snapshot_interval)
 
-        print(f'{Fore.YELLOW}Connecting to the server{Style.RESET_ALL}')
-        ws = websocket.create_connection('wss://pixelplanet.fun:443/ws', header=extra_ws_headers,
-            http_proxy_host=config.proxy.host, http_proxy_port=config.proxy.port,
-            http_proxy_auth=(config.proxy.user, config.proxy.passwd))
+    if args.replay:
+        ws = ReplayClient(recording, chunk_loader, args.replay_speed)
+    else:
+        ws = AsyncClient(WS_URL, extra_ws_headers, config.proxy)
+    if args.record:
+        recorder = EventRecorder(args.record)
+        recorder.info(server=SERVER_URL, version=VERSION, canv_id=config.image.canv_id, me=me)
+    # when the last connection was established and when it was lost
+    connected_at, offline_since = None, None
+    # later connections only download the chunks that have probably changed
+    initial_load_done = False
+
+    async def run_client_async():
+        global me, canvas_store, pipeline, config, thr
+        nonlocal connected_at, offline_since, initial_load_done
+
+        console.print(f'{Fore.YELLOW}Connecting to the server{Style.RESET_ALL}')
+        await ws.connect()
+        connected_at = time.time()
+        chunk_activity.watch(connected_at)
         select_canvas(ws, config.image.canv_id)
-        
-        # load and register chunks
-        csz = canv_desc['size']
-        c_start_y = ((csz // 2) + config.image.y) // 256
-        c_start_x = ((csz // 2) + config.image.x) // 256
-        c_end_y = ((csz // 2) + config.image.y + img.shape[0]) // 256
-        c_end_x = ((csz // 2) + config.image.x + img.shape[1]) // 256
-        c_occupied_y = c_end_y - c_start_y + 1
-        c_occupied_x = c_end_x - c_start_x + 1
-        chunk_data = get_chunks(config.image.canv_id, c_start_x, c_start_y, c_occupied_x, c_occupied_y)
-        for c_y in range(c_occupied_y):
-            for c_x in range(c_occupied_x):
-                register_chunk(ws, config.image.canv_id, c_x + c_start_x, c_y + c_start_y)
-
-        # start drawing
-        thr = threading.Thread(target=draw_function, args=(
-                ws, config.image.canv_id, config.image.x, config.image.y,
-                c_start_x, c_start_y, color_idxs, config.image.defend, config.image.strategy),
-            name='Drawing thread')
-        thr.start()
+
+        # register the chunks all templates need first, so that no updates are missed while loading
+        for c_x, c_y in sorted(set(c for t in templates for c in t.chunks())):
+            register_chunk(ws, config.image.canv_id, c_x, c_y)
+        if not initial_load_done:
+            # load the chunks
+            # (huge templates page their chunks in while they're being drawn)
+            chunks = sorted(set(c for t in templates if not t.tiled for c in t.chunks()))
+            canvas_store.pin(chunks)
+            await canvas_store.load_async(chunks, max_age=CHUNK_MAX_AGE)
+            initial_load_done = True
+        else:
+            # only download the chunks that have probably changed while we were offline
+            # (the rest is what it was when the connection was lost)
+            metrics.inc('reconnects_total')
+            keys = canvas_store.keys()
+            stale = chunk_activity.likely_changed(keys, offline_since, connected_at)
+            await canvas_store.load_async(stale)
+            metrics.inc('resync_chunks_total', len(stale))
+            console.print(f'{Fore.YELLOW}Reconnected after {Fore.GREEN}{connected_at - offline_since:.1f}s{Fore.YELLOW}, ' +
+                f'refreshed {Fore.GREEN}{len(stale)}{Fore.YELLOW} of {Fore.GREEN}{len(keys)}{Fore.YELLOW} chunks{Style.RESET_ALL}')
+        offline_since = None
+        # find out what needs to be fixed
+        # (the drawing pass goes over every area of a huge template anyway)
+        for t in templates:
+            if not t.tiled:
+                t.damage.recheck(t.region())
+        if preview is not None:
+            preview.invalidate()
+
+        # start (or resume) drawing
+        pipeline.reopen()
+        if thr is None:
+            thr = threading.Thread(target=draw_worker, args=(ws, config.image.canv_id, templates),
+                name='Drawing thread', daemon=True)
+            thr.start()
 
         # read server messages
-        while True:
-            data = ws.recv()
-            # text data = chat message
-            if type(data) == str:
-                # data comes as a JS(ON) array
-                msg = json.loads('{"msg":' + data + '}')
-                msg = msg['msg']
-                if isinstance(msg, list): # it also could be a string, in which case it's our nickname
-                    print(f'{Fore.GREEN}{msg[0]}{Fore.YELLOW} (country: {Fore.GREEN}{msg[2]}{Fore.YELLOW}) ' + 
-                        f'says: {Fore.GREEN}{msg[1]}{Fore.YELLOW} in chat {Fore.GREEN}{"int" if msg[2] == 2 else "en"}{Style.RESET_ALL}')
-
-            # binary data = event
-            else:
-                opcode = data[0]
-                # online counter
-                if opcode == 0xA7:
-                    oc = (data[1] << 8) | data[2]
-                    print(f'{Fore.YELLOW}Online counter: {Fore.GREEN}{oc}{Style.RESET_ALL}')
-
-                # total cooldown packet
-                elif opcode == 0xC2:
-                    cd = (data[4] << 24) | (data[3] << 16) | (data[2] << 8) | data[1]
-                    print(f'{Fore.YELLOW}Total cooldown: {Fore.GREEN}{cd} ms{Style.RESET_ALL}')
-
-                # pixel return packet
-                elif opcode == 0xC3:
-                    rc = data[1]
-                    wait = (data[2] << 24) | (data[3] << 16) | (data[4] << 8) | data[5]
-                    cd_s = (data[6] << 8) | data[7]
-                    print(f'{Fore.YELLOW}Pixel return{Fore.YELLOW} (code: {Fore.RED if rc != 0 else Fore.GREEN}{rc}{Fore.YELLOW}): ' + 
-                            f'wait: {Fore.GREEN}{wait}{Fore.YELLOW} ms {Fore.GREEN}[+{cd_s} s]{Style.RESET_ALL}')
-                    # CAPTCHA error
-                    if rc == 10:
-                        draw = False
-                        play_notification()
-                        print(Fore.RED + 'Place a pixel somewhere manually and enter CAPTCHA' + Style.RESET_ALL)
-                    # any error
-                    if rc != 0:
-                        time.sleep(2)
-                        succ = False
-                        draw = True
-                    # success
-                    else:
-                        # if wait >= 59*1000::
-                        if wait >= 30000:
-                            print(f'{Fore.YELLOW}Cooling down{Style.RESET_ALL}')
-                            # wait that many seconds plus 1 (to be sure)
-                            time.sleep(cd_s + 1)
-                        succ = True
-                        draw = True
-
-                # pixel update
-                elif opcode == 0xC1:
-                    # get raw data
-                    i = data[1]
-                    j = data[2]
-                    offs = (data[3] << 16) | (data[4] << 8) | data[5]
-                    clr = data[6]
-                    # convert it to X and Y coords
-                    csz = me['canvases'][str(config.image.canv_id)]['size']
-                    x = ((i * 256) - (csz // 2)) + (offs & 0xFF)
-                    y = ((j * 256) - (csz // 2)) + ((offs >> 8) & 0xFF)
-                    print(f'{Fore.YELLOW}Pixel update at {Fore.GREEN}({str(x)}, {str(y)}){Style.RESET_ALL}')
-                    # write that change
-                    local_x = (i - c_start_x) * 256 + (offs & 0xFF)
-                    local_y = (j - c_start_y) * 256 + ((offs >> 8) & 0xFF)
-                    chunk_data[local_y, local_x] = clr
-                else:
-                    print(f'{Fore.RED}Unreconized data opcode from the server. Raw data: {data}{Style.RESET_ALL}')
+        await ws.serve(dispatch_messages)
 
-    while True:
-        try:
-            run_client()
-        except websocket.WebSocketConnectionClosedException:
-            print(f'{Fore.RED}Disconnected, trying to reconnect in 5s{Style.RESET_ALL}')
-            time.sleep(5)
-            succ = False
-            draw = True
-        except KeyboardInterrupt:
-            print(f'{Fore.RED}Interrupting{Style.RESET_ALL}')
-            sys.exit()
+    # the threaded entry point, runs the client on its own event loop
+    def run_client():
+        async def session():
+            try:
+                await run_client_async()
+            finally:
+                await ws.close()
+        asyncio.run(session())
+
+    if args.replay:
+        run_client()
+        pipeline.close()
+        console.print(f'{Fore.YELLOW}Replayed {Fore.GREEN}{ws.received}{Fore.YELLOW} messages ({Fore.GREEN}{ws.duration:.1f}s{Fore.YELLOW}' +
+            f' recorded) in {Fore.GREEN}{ws.elapsed:.1f}s{Fore.YELLOW}, sent {Fore.GREEN}{ws.sent}{Fore.YELLOW} messages' +
+            f' ({Fore.GREEN}{ws.recorded_sent}{Fore.YELLOW} in the recording){Style.RESET_ALL}')
+        return
+
+    backoff = Backoff()
+    # (Ctrl+C may also come while waiting to reconnect)
+    try:
+        while True:
+            try:
+                run_client()
+            except (ConnectionClosedError, requests.RequestException) as e:
+                pipeline.close()
+                if offline_since is None:
+                    offline_since = time.time()
+                # only keep backing off if the connections don't last
+                if connected_at is not None and time.time() - connected_at >= RECONNECT_STABLE:
+                    backoff.reset()
+                connected_at = None
+                delay = backoff.next()
+                console.print(f'{Fore.RED}Disconnected ({e}), trying to reconnect in {delay:.1f}s{Style.RESET_ALL}')
+                time.sleep(delay)
+    except KeyboardInterrupt:
+        console.print(f'{Fore.RED}Interrupting{Style.RESET_ALL}')
+        # another Ctrl+C shouldn't cut saving short
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        if recorder is not None:
+            recorder.flush()
+        if checkpoint is not None:
+            checkpoint.save(current=initial_load_done and offline_since is None)
+        sys.exit()
 
 if __name__ == "__main__":
-    main()
+    try:
+        main()
+    finally:
+        # the queued lines (and the last error) would be lost otherwise
+        console.close()
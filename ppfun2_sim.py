@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+# a local stand-in for the PixelPlanet server, for testing the bot without touching the real canvas
+# it serves /api/me, /api/auth/local, chunk .bmp files and the WebSocket protocol:
+# canvas selection, chunk registration, pixel placement with cooldowns and configurable errors,
+# and floods of pixel updates from simulated "other players"
+#
+# python ppfun2_sim.py --port 8080 --flood 5000
+# python ppfun2.py --server http://127.0.0.1:8080
+
+import asyncio, json, time, random, argparse
+import os.path as path
+import urllib.parse
+from collections import defaultdict
+
+import numpy as np
+from colorama import Fore, Style, init
+
+import ppfun2
+from ppfun2 import (CHUNK_SIZE, CHUNK_BYTES, THREE_TILE_SIZE, THREE_CHUNK_BYTES, ConnectionClosedError, WebSocketConnection,
+    read_http_head, ws_accept_key, OP_REG_CANVAS, OP_REG_CHUNK, OP_PIXEL_UPDATE)
+
+# the api/me response that's served by default
+DEFAULT_ME = path.join(path.dirname(path.abspath(__file__)), 'benchmarks', 'fixtures', 'me.json')
+# pixel return codes
+RC_OK        = 0
+RC_BAD_CANV  = 1
+RC_BAD_COORD = 2
+RC_BAD_COLOR = 5
+RC_COOLDOWN  = 9
+RC_CAPTCHA   = 10
+# how often statistics are printed, in seconds
+STATS_INTERVAL = 5
+# how often flood updates are sent, in seconds
+FLOOD_TICK = 0.01
+
+# the canvas, chunks are created when they're first written to
+class SimCanvas(object):
+    def __init__(self, desc):
+        self.desc = desc
+        # voxel canvases have smaller chunks that are volumes
+        self.tile_size = THREE_TILE_SIZE if 'v' in desc else CHUNK_SIZE
+        self.chunk_len = THREE_CHUNK_BYTES if 'v' in desc else CHUNK_BYTES
+        self.chunks = {}
+        # bumped on every change of a chunk, used as its ETag
+        self.versions = defaultdict(int)
+
+    def chunk(self, i, j):
+        data = self.chunks.get((i, j))
+        if data is None:
+            data = self.chunks[(i, j)] = bytearray(self.chunk_len)
+        return data
+
+    # the raw data that's sent for a chunk, empty chunks are sent without any data
+    def chunk_bytes(self, i, j):
+        data = self.chunks.get((i, j))
+        return bytes(data) if data is not None else b''
+
+    def get(self, i, j, offs):
+        data = self.chunks.get((i, j))
+        return data[offs] & (ppfun2.PROTECTED_BIT - 1) if data is not None else 0
+
+    def set(self, i, j, offs, c):
+        data = self.chunk(i, j)
+        data[offs] = (data[offs] & ppfun2.PROTECTED_BIT) | c
+        self.versions[(i, j)] += 1
+
+    # same as set(), but for arrays of pixels of one chunk
+    def set_many(self, i, j, offs, colors):
+        arr = np.frombuffer(self.chunk(i, j), np.uint8)
+        arr[offs] = (arr[offs] & ppfun2.PROTECTED_BIT) | colors
+        self.versions[(i, j)] += 1
+
+# a connected bot
+class SimClient(object):
+    def __init__(self, conn):
+        self.conn = conn
+        self.canvas = None
+        self.chunks = set()
+        # when the cooldown of the client ends (time.time() in ms)
+        self.cooldown_end = 0
+
+class SimServer(object):
+    def __init__(self, args, me):
+        self.args = args
+        self.me = me
+        self.canvases = {int(d): SimCanvas(desc) for d, desc in me['canvases'].items()}
+        self.clients = set()
+        self.stats = defaultdict(int)
+        self.rng = np.random.default_rng(args.seed)
+
+    # the cooldown settings of a canvas, with the overrides from the command line
+    def cooldowns(self, desc):
+        return (self.args.bcd if self.args.bcd is not None else desc.get('bcd', 0),
+                self.args.pcd if self.args.pcd is not None else desc.get('pcd', 0),
+                self.args.cds if self.args.cds is not None else desc.get('cds', 60000))
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                status, headers = await read_http_head(reader)
+                method, target = status.split()[:2]
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                if headers.get('upgrade', '').lower() == 'websocket':
+                    await self.handle_ws(reader, writer, headers)
+                    return
+                await self.handle_http(writer, method, urllib.parse.urlsplit(target).path, headers, body)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def respond(self, writer, code, body=b'', content_type='application/json', extra=()):
+        reason = {200: 'OK', 304: 'Not Modified', 404: 'Not Found', 405: 'Method Not Allowed', 502: 'Bad Gateway'}.get(code, '')
+        head = [f'HTTP/1.1 {code} {reason}', f'Content-Length: {len(body)}',
+                f'Content-Type: {content_type}', 'Connection: keep-alive'] + list(extra)
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode() + body)
+
+    async def handle_http(self, writer, method, url_path, headers, body):
+        parts = url_path.strip('/').split('/')
+        self.stats['http'] += 1
+        if url_path == '/api/me':
+            self.respond(writer, 200, json.dumps(self.me).encode())
+        elif url_path == '/api/auth/local' and method == 'POST':
+            name = json.loads(body or b'{}').get('nameoremail', 'bot')
+            self.respond(writer, 200, json.dumps({'success': True, 'me': {'name': name}}).encode(),
+                extra=['Set-Cookie: pixelplanet.session=simulated; Path=/'])
+        elif len(parts) == 4 and parts[0] == 'chunks' and parts[3].endswith('.bmp'):
+            try:
+                d, i, j = int(parts[1]), int(parts[2]), int(parts[3][:-4])
+                canvas = self.canvases[d]
+            except (ValueError, KeyError):
+                self.respond(writer, 404)
+                return
+            if self.args.chunk_latency > 0:
+                await asyncio.sleep(self.args.chunk_latency / 1000)
+            self.stats['chunks'] += 1
+            if self.args.chunk_error_rate > 0 and self.rng.random() < self.args.chunk_error_rate:
+                self.respond(writer, 502, b'<html><body>502 Bad Gateway</body></html>', 'text/html')
+                await writer.drain()
+                return
+            etag = f'"{d}-{i}-{j}-{canvas.versions[(i, j)]}"'
+            if headers.get('if-none-match') == etag:
+                self.respond(writer, 304, extra=[f'ETag: {etag}'])
+            else:
+                self.respond(writer, 200, canvas.chunk_bytes(i, j), 'image/bmp', [f'ETag: {etag}'])
+        else:
+            self.respond(writer, 404)
+        await writer.drain()
+
+    async def handle_ws(self, reader, writer, headers):
+        writer.write(('HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n' +
+            f'Sec-WebSocket-Accept: {ws_accept_key(headers["sec-websocket-key"])}\r\n\r\n').encode())
+        client = SimClient(WebSocketConnection(reader, writer, client=False))
+        self.clients.add(client)
+        print(f'{Fore.GREEN}Client connected{Fore.YELLOW}, {len(self.clients)} online{Style.RESET_ALL}')
+        if self.args.disconnect_after > 0:
+            # like a server restart or a proxy timeout
+            asyncio.get_running_loop().call_later(self.args.disconnect_after,
+                lambda: asyncio.ensure_future(client.conn.close()))
+        try:
+            client.conn.send_binary(ppfun2.encode_cooldown(0))
+            while True:
+                data = await client.conn.recv()
+                if isinstance(data, str) or len(data) == 0:
+                    continue
+                if data[0] == OP_REG_CANVAS:
+                    client.canvas = ppfun2.decode_select_canvas(data)
+                elif data[0] == OP_REG_CHUNK:
+                    client.chunks.add(tuple(ppfun2.decode_register_chunk(data)))
+                elif data[0] == OP_PIXEL_UPDATE:
+                    await self.place(client, *ppfun2.decode_pixel(data))
+        except ConnectionClosedError:
+            pass
+        finally:
+            self.clients.discard(client)
+            print(f'{Fore.RED}Client disconnected{Fore.YELLOW}, {len(self.clients)} online{Style.RESET_ALL}')
+
+    # handles a placement request
+    async def place(self, client, i, j, offs, c):
+        self.stats['place_requests'] += 1
+        if self.args.latency > 0:
+            await asyncio.sleep(self.args.latency / 1000)
+        canvas = self.canvases.get(client.canvas)
+        now = time.time() * 1000
+        rc, wait, cd_s = RC_OK, 0, 0
+        if canvas is None:
+            rc = RC_BAD_CANV
+        elif max(i, j) >= canvas.desc['size'] // canvas.tile_size or offs >= canvas.chunk_len:
+            rc = RC_BAD_COORD
+        elif not canvas.desc['cli'] <= c < len(canvas.desc['colors']):
+            rc = RC_BAD_COLOR
+        elif random.random() < self.args.captcha_rate:
+            rc = RC_CAPTCHA
+        else:
+            bcd, pcd, cds = self.cooldowns(canvas.desc)
+            client.cooldown_end = max(client.cooldown_end, now)
+            if client.cooldown_end - now > cds or random.random() < self.args.error_rate:
+                rc, wait = RC_COOLDOWN, int(client.cooldown_end - now)
+            else:
+                # placing over an unset (background) pixel is cheaper
+                added = bcd if canvas.get(i, j, offs) < canvas.desc['cli'] else pcd
+                client.cooldown_end += added
+                wait, cd_s = int(client.cooldown_end - now), round(added / 1000)
+                canvas.set(i, j, offs, c)
+                self.broadcast(client.canvas, i, j, ppfun2.encode_pixel(i, j, offs, c))
+        self.stats['placed' if rc == RC_OK else 'rejected'] += 1
+        try:
+            client.conn.send_binary(ppfun2.encode_pixel_return(rc, wait, cd_s))
+        except ConnectionClosedError:
+            pass
+
+    # sends a message to every client that registered the chunk
+    def broadcast(self, d, i, j, data):
+        for client in list(self.clients):
+            if client.canvas == d and (i, j) in client.chunks:
+                try:
+                    client.conn.send_binary(data)
+                    self.stats['frames_sent'] += 1
+                except ConnectionClosedError:
+                    pass
+
+    # "other players" that change random pixels of the registered chunks
+    async def flood(self):
+        rate, batch = self.args.flood, self.args.flood_batch
+        debt = 0.0
+        last = time.time()
+        while True:
+            await asyncio.sleep(FLOOD_TICK)
+            now = time.time()
+            debt += (now - last) * rate
+            last = now
+            targets = sorted(set((c.canvas, key) for c in self.clients if c.canvas in self.canvases for key in c.chunks))
+            if len(targets) == 0:
+                debt = 0
+                continue
+            while debt >= 1:
+                n = min(batch, int(debt))
+                debt -= n
+                d, (i, j) = targets[self.rng.integers(len(targets))]
+                desc = self.canvases[d].desc
+                offs = self.rng.integers(0, self.canvases[d].chunk_len, n)
+                colors = self.rng.integers(desc['cli'], len(desc['colors']), n).astype(np.uint8)
+                self.canvases[d].set_many(i, j, offs, colors)
+                self.broadcast(d, i, j, ppfun2.encode_pixel_updates(i, j, offs, colors))
+                self.stats['flood_updates'] += n
+            # don't let slow clients make the buffers grow forever
+            await asyncio.gather(*[c.conn.writer.drain() for c in list(self.clients)], return_exceptions=True)
+
+    # online counters and statistics
+    async def report(self):
+        while True:
+            await asyncio.sleep(STATS_INTERVAL)
+            for client in list(self.clients):
+                try:
+                    client.conn.send_binary(ppfun2.encode_online(len(self.clients)))
+                except ConnectionClosedError:
+                    pass
+            stats, self.stats = self.stats, defaultdict(int)
+            print(f'{Fore.YELLOW}Clients: {Fore.GREEN}{len(self.clients)}' +
+                f'{Fore.YELLOW}, placed: {Fore.GREEN}{stats["placed"] / STATS_INTERVAL:.1f}/s' +
+                f'{Fore.YELLOW}, rejected: {Fore.GREEN}{stats["rejected"] / STATS_INTERVAL:.1f}/s' +
+                f'{Fore.YELLOW}, flood: {Fore.GREEN}{stats["flood_updates"] / STATS_INTERVAL:.0f} px/s' +
+                f'{Fore.YELLOW}, frames sent: {Fore.GREEN}{stats["frames_sent"] / STATS_INTERVAL:.0f}/s' +
+                f'{Fore.YELLOW}, chunk requests: {Fore.GREEN}{stats["chunks"]}{Style.RESET_ALL}')
+
+    async def run(self):
+        server = await asyncio.start_server(self.handle, self.args.host, self.args.port)
+        print(f'{Fore.YELLOW}Listening on {Fore.GREEN}http://{self.args.host}:{self.args.port}{Style.RESET_ALL}')
+        tasks = [asyncio.ensure_future(self.report())]
+        if self.args.flood > 0:
+            tasks.append(asyncio.ensure_future(self.flood()))
+        async with server:
+            await server.serve_forever()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Local PixelPlanet server simulator')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8080, help='port to listen on (default: 8080)')
+    parser.add_argument('--me', metavar='FILE', default=DEFAULT_ME, help='the api/me response to serve')
+    parser.add_argument('--bcd', metavar='MS', type=int, help='cooldown of placing over an unset pixel')
+    parser.add_argument('--pcd', metavar='MS', type=int, help='cooldown of placing over a set pixel')
+    parser.add_argument('--cds', metavar='MS', type=int, help='how much cooldown can be stacked')
+    parser.add_argument('--latency', metavar='MS', type=float, default=0, help='delay before answering placements')
+    parser.add_argument('--chunk-latency', metavar='MS', type=float, default=0, help='delay before answering chunk requests')
+    parser.add_argument('--chunk-error-rate', metavar='P', type=float, default=0,
+        help='probability of answering a chunk request with a 502 error page')
+    parser.add_argument('--captcha-rate', metavar='P', type=float, default=0,
+        help='probability of answering a placement with a CAPTCHA request')
+    parser.add_argument('--error-rate', metavar='P', type=float, default=0,
+        help='probability of rejecting a placement with a cooldown error')
+    parser.add_argument('--disconnect-after', metavar='SEC', type=float, default=0,
+        help='close every WebSocket connection after it has been open for SEC seconds')
+    parser.add_argument('--flood', metavar='RATE', type=float, default=0,
+        help='pixel updates per second from other players in the registered chunks')
+    parser.add_argument('--flood-batch', metavar='N', type=int, default=16, help='pixels per update message')
+    parser.add_argument('--seed', type=int, help='random seed of the flood')
+    return parser.parse_args()
+
+def main():
+    init()
+    args = parse_args()
+    with open(args.me) as f:
+        me = json.load(f)
+    try:
+        asyncio.run(SimServer(args, me).run())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,4 @@
+import sys, os.path as path
+
+# the bot is a single file in the root of the repository
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
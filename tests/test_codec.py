@@ -0,0 +1,99 @@
+# round trips of the binary protocol codec
+
+import struct
+import numpy as np
+import pytest
+
+import ppfun2
+
+# placing a pixel: the offset is 24 bits wide, big-endian
+def test_pixel_round_trip():
+    data = ppfun2.encode_pixel(17, 250, 0x01FFFE, 33)
+    assert data == bytes([ppfun2.OP_PIXEL_UPDATE, 17, 250, 0x01, 0xFF, 0xFE, 33])
+    assert ppfun2.decode_pixel(data) == (17, 250, 0x01FFFE, 33)
+
+@pytest.mark.parametrize('offs', [0, 1, 255, 256, 65535, 65536, 0xFFFFFF])
+def test_pixel_offsets(offs):
+    assert ppfun2.decode_pixel(ppfun2.encode_pixel(0, 0, offs, 0))[2] == offs
+
+def test_pixel_return_is_big_endian():
+    data = ppfun2.encode_pixel_return(10, 0x01020304, 0x0506)
+    assert data == bytes([ppfun2.OP_PIXEL_RETURN, 10, 1, 2, 3, 4, 5, 6])
+    assert ppfun2.decode_pixel_return(data) == (10, 0x01020304, 0x0506)
+
+def test_cooldown_is_little_endian():
+    data = ppfun2.encode_cooldown(0x01020304)
+    assert data == bytes([ppfun2.OP_COOLDOWN, 4, 3, 2, 1])
+    assert ppfun2.decode_cooldown(data) == 0x01020304
+
+def test_online_round_trip():
+    data = ppfun2.encode_online(1234)
+    assert data == bytes([ppfun2.OP_ONLINE]) + struct.pack('>H', 1234)
+    assert ppfun2.decode_online(data) == 1234
+
+def test_select_canvas_round_trip():
+    data = ppfun2.encode_select_canvas(7)
+    assert data == bytes([ppfun2.OP_REG_CANVAS, 7])
+    assert ppfun2.decode_select_canvas(data) == 7
+
+def test_register_chunk_round_trip():
+    data = ppfun2.encode_register_chunk(3, 200)
+    assert data == bytes([ppfun2.OP_REG_CHUNK, 3, 200])
+    assert ppfun2.decode_register_chunk(data) == (3, 200)
+
+@pytest.mark.parametrize('decode, data', [
+    (ppfun2.decode_pixel,           ppfun2.encode_pixel(1, 2, 3, 4)[:-1]),
+    (ppfun2.decode_pixel_return,    ppfun2.encode_pixel_return(0, 0, 0)[:5]),
+    (ppfun2.decode_cooldown,        ppfun2.encode_cooldown(5)[:3]),
+    (ppfun2.decode_online,          bytes([ppfun2.OP_ONLINE])),
+    (ppfun2.decode_select_canvas,   bytes([ppfun2.OP_REG_CANVAS])),
+    (ppfun2.decode_register_chunk,  ppfun2.encode_register_chunk(1, 2)[:2]),
+])
+def test_truncated_messages(decode, data):
+    with pytest.raises(struct.error):
+        decode(data)
+
+@pytest.mark.parametrize('encode, args', [
+    (ppfun2.encode_pixel,           (256, 0, 0, 0)),
+    (ppfun2.encode_pixel,           (0, 0, 1 << 24, 0)),
+    (ppfun2.encode_online,          (65536,)),
+    (ppfun2.encode_cooldown,        (-1,)),
+    (ppfun2.encode_register_chunk,  (0, 256)),
+])
+def test_out_of_range_values(encode, args):
+    with pytest.raises(struct.error):
+        encode(*args)
+
+def test_pixel_updates_round_trip():
+    rng = np.random.default_rng(0)
+    chunks = [(0, 0), (5, 9), (255, 255)]
+    frames, expected = [], []
+    for n, (i, j) in enumerate(chunks):
+        offs = rng.integers(0, 1 << 24, 10 + n)
+        colors = rng.integers(0, 64, 10 + n)
+        frames.append(ppfun2.encode_pixel_updates(i, j, offs, colors))
+        expected += [(i, j, o, c) for o, c in zip(offs.tolist(), colors.tolist())]
+    i, j, offs, colors = ppfun2.decode_pixel_updates(frames)
+    assert colors.dtype == np.uint8
+    assert list(zip(i.tolist(), j.tolist(), offs.tolist(), colors.tolist())) == expected
+
+# a single-pixel update has the same layout as a placement
+def test_pixel_updates_match_pixel():
+    data = ppfun2.encode_pixel_updates(4, 5, [0x123456], [7])
+    assert data == ppfun2.encode_pixel(4, 5, 0x123456, 7)
+
+def test_pixel_updates_empty():
+    i, j, offs, colors = ppfun2.decode_pixel_updates([])
+    assert len(i) == len(j) == len(offs) == len(colors) == 0
+    i, j, offs, colors = ppfun2.decode_pixel_updates([ppfun2.encode_pixel_updates(1, 2, [], [])])
+    assert len(offs) == 0
+
+# incomplete entries and frames without a header are dropped, the rest is decoded
+def test_pixel_updates_truncated():
+    whole = ppfun2.encode_pixel_updates(1, 2, [10, 20, 30], [1, 2, 3])
+    frames = [whole[:-2], bytes([ppfun2.OP_PIXEL_UPDATE, 9]), b'', ppfun2.encode_pixel_updates(3, 4, [40], [4])]
+    i, j, offs, colors = ppfun2.decode_pixel_updates(frames)
+    assert i.tolist() == [1, 1, 3]
+    assert j.tolist() == [2, 2, 4]
+    assert offs.tolist() == [10, 20, 40]
+    assert colors.tolist() == [1, 2, 4]
@@ -0,0 +1,42 @@
+# damage tracking and the pixel streams of the drawing strategies
+
+import numpy as np
+import pytest
+
+import ppfun2
+
+COLORS = [[255, 255, 255], [0, 0, 0], [255, 0, 0], [0, 255, 0]]
+
+def tracker(w=8, h=4, count_overwrites=False):
+    return ppfun2.DamageTracker(np.full((h, w), 2, np.uint8), COLORS, count_overwrites=count_overwrites)
+
+# only the strategies that use the counts get them
+def test_overwrites_are_only_counted_when_needed():
+    t = tracker()
+    assert t.overwrites is None and t.window(0, 0, 4, 4).overwrites is None
+    t.on_updates(np.array([1, 2]), np.array([0, 0]), np.array([3, 3], np.uint8))
+    assert t.backlog() == 2
+    assert ppfun2.STRATEGIES['contested'].needs_overwrites
+    assert not ppfun2.STRATEGIES['forward'].needs_overwrites
+
+def test_overwrites_saturate():
+    t = tracker(count_overwrites=True)
+    t.overwrites[0, 1] = ppfun2.OVERWRITES_MAX - 1
+    # repeated pixels and pixels that get the right color
+    t.on_updates(np.array([1, 1, 1, 2, 3]), np.array([0, 0, 0, 0, 0]), np.array([3, 3, 3, 3, 2], np.uint8))
+    assert t.overwrites.dtype == np.uint16
+    assert t.overwrites[0, :4].tolist() == [0, ppfun2.OVERWRITES_MAX, 1, 0]
+
+# the counts are raised before the stream is bumped, the stream mustn't end in between
+def test_priority_stream_between_count_and_bump():
+    t = tracker(count_overwrites=True)
+    stream = ppfun2.STRATEGIES['contested'].plan(np.eye(4, 8, dtype=np.bool_), t.window(0, 0, 8, 4))
+    assert [stream.next() for _ in range(3)] == [(0, 0), (1, 1), (2, 2)]
+    # what on_updates does before it gets to bump_many
+    t.overwrites[3, 3] += 1
+    assert stream.next() == (3, 3)
+    assert stream.next() is None
+    # the pixel has been damaged again
+    stream.bump_many(np.array([3]), np.array([3]))
+    assert stream.next() == (3, 3)
+    assert stream.next() is None and stream.remaining() == 0
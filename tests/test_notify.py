@@ -0,0 +1,56 @@
+# delivering and merging notifications
+
+import threading, time
+
+import ppfun2
+
+# remembers what it's been told
+class RecordingSink(object):
+    name = 'recording'
+
+    def __init__(self):
+        self.prepared = 0
+        self.delivered = []
+
+    def prepare(self):
+        self.prepared += 1
+
+    def notify(self, title, text):
+        self.delivered.append((title, text, time.monotonic()))
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+# the setup thread and the first alert may start it at the same time
+def test_started_once():
+    sink = RecordingSink()
+    notifier = ppfun2.Notifier([sink])
+    threads = [threading.Thread(target=notifier.start) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    notifier.notify('captcha', 'CAPTCHA', 'text')
+    assert wait_for(lambda: len(sink.delivered) == 1)
+    assert sink.prepared == 1
+
+# alerts within the window are merged into one that's delivered when the window is over,
+# even if no other alert comes
+def test_merged_alerts_are_delivered_when_the_window_is_over():
+    sink = RecordingSink()
+    notifier = ppfun2.Notifier([sink], coalesce=0.3)
+    notifier.notify('captcha', 'CAPTCHA', 'text 0')
+    assert wait_for(lambda: len(sink.delivered) == 1)
+    for n in range(1, 3):
+        notifier.notify('captcha', 'CAPTCHA', f'text {n}')
+    notifier.notify('other', 'Other', 'text')
+    assert wait_for(lambda: len(sink.delivered) == 3)
+    (_, _, first), (other, _, _), (merged, text, at) = sink.delivered
+    assert other == 'Other' and merged == 'CAPTCHA'
+    assert text == 'text 2 (2 times)'
+    assert at - first >= 0.3
+    time.sleep(0.5)
+    assert len(sink.delivered) == 3
@@ -0,0 +1,240 @@
+# the bot against the local simulator (ppfun2_sim.py), each in its own process
+
+import asyncio, json, os, re, signal, socket, subprocess, sys, threading, time, pickle
+import os.path as path
+import numpy as np
+import cv2
+import pytest
+import requests
+
+import ppfun2
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+ANSI = re.compile(r'\x1b\[[0-9;]*m')
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+# a running simulator
+class Sim(object):
+    def __init__(self, tmp_path, *args):
+        self.port = free_port()
+        self.url = f'http://127.0.0.1:{self.port}'
+        self.log = open(tmp_path / f'sim-{self.port}.log', 'w+')
+        self.proc = subprocess.Popen([sys.executable, path.join(ROOT, 'ppfun2_sim.py'), '--port', str(self.port),
+            '--bcd', '10', '--pcd', '10', '--seed', '1'] + list(args), stdout=self.log, stderr=subprocess.STDOUT)
+        deadline = time.time() + 20
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', self.port), timeout=1).close()
+                break
+            except OSError:
+                if time.time() > deadline or self.proc.poll() is not None:
+                    raise RuntimeError('the simulator didn\'t start')
+                time.sleep(0.1)
+
+    def stop(self):
+        self.proc.terminate()
+        self.proc.wait()
+        self.log.close()
+
+@pytest.fixture
+def sim_factory(tmp_path):
+    sims = []
+    def start(*args):
+        sims.append(Sim(tmp_path, *args))
+        return sims[-1]
+    yield start
+    for sim in sims:
+        sim.stop()
+
+@pytest.fixture
+def sim(sim_factory):
+    return sim_factory()
+
+# places a pixel like another player would, returns the return code
+def place_as_other(sim, d, i, j, offs, c):
+    async def place():
+        conn = await ppfun2.ws_connect(ppfun2.server_ws_url(sim.url))
+        try:
+            conn.send_binary(ppfun2.encode_select_canvas(d))
+            conn.send_binary(ppfun2.encode_pixel(i, j, offs, c))
+            while True:
+                data = await conn.recv()
+                if isinstance(data, bytes) and data[:1] == bytes([ppfun2.OP_PIXEL_RETURN]):
+                    return ppfun2.decode_pixel_return(data)[0]
+        finally:
+            await conn.close()
+    return asyncio.run(place())
+
+# a preset that draws and defends a 16x16 image of random colors across the corner of four chunks
+@pytest.fixture
+def preset(tmp_path):
+    with open(path.join(ROOT, 'benchmarks', 'fixtures', 'me.json')) as f:
+        colors = np.array(json.load(f)['canvases']['0']['colors'], np.uint8)
+    rng = np.random.default_rng(0)
+    img = colors[rng.integers(2, len(colors), (16, 16))]
+    cv2.imwrite(str(tmp_path / 'tpl.png'), img[:, :, ::-1])
+    config = ppfun2.PpfunConfig()
+    config.image.path = str(tmp_path / 'tpl.png')
+    config.image.x, config.image.y = -8, -8
+    config.image.defend = True
+    config.image.strategy = 'forward'
+    config.image.canv_id = 0
+    with open(tmp_path / 'preset.pickle', 'wb') as f:
+        pickle.dump(config, f)
+    return tmp_path / 'preset.pickle'
+
+# runs the bot for some time, then stops it with Ctrl+C and returns what it printed
+def run_bot(tmp_path, sim, preset, seconds, *args):
+    with open(tmp_path / 'bot.log', 'w+') as log:
+        proc = subprocess.Popen([sys.executable, path.join(ROOT, 'ppfun2.py'), str(preset), '--server', sim.url,
+            '--notify', 'log'] + list(args), cwd=tmp_path, stdout=log, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL)
+        time.sleep(seconds)
+        proc.send_signal(signal.SIGINT)
+        try:
+            proc.wait(20)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            raise
+        log.seek(0)
+        return ANSI.sub('', log.read())
+
+# the header and the tiles of a checkpoint
+def read_checkpoint(file_path):
+    with open(file_path, 'rb') as f:
+        assert f.read(len(ppfun2.CHECKPOINT_MAGIC)) == ppfun2.CHECKPOINT_MAGIC
+        length = int.from_bytes(f.read(4), 'little')
+        header = json.loads(f.read(length))
+        f.seek(ppfun2.checkpoint_data_offset(length))
+        tiles = np.frombuffer(f.read(), np.uint8).reshape(-1, ppfun2.CHUNK_BYTES)
+    return header, tiles
+
+def write_checkpoint(file_path, header, tiles):
+    data = json.dumps(header).encode()
+    with open(file_path, 'wb') as f:
+        f.write(ppfun2.CHECKPOINT_MAGIC + len(data).to_bytes(4, 'little') + data)
+        f.seek(ppfun2.checkpoint_data_offset(len(data)))
+        f.write(tiles.tobytes())
+
+# the bot is the only one placing pixels, so the echoes of its own placements must not make its chunks look busy
+def test_checkpoint_reuses_tiles_the_bot_drew_in(tmp_path, sim, preset):
+    out = run_bot(tmp_path, sim, preset, 8, '--checkpoint', 'ck.bin')
+    assert 'Interrupting' in out
+    header, _ = read_checkpoint(tmp_path / 'ck.bin')
+    assert header['pixels_drawn'] > 1
+    # long enough offline for chunks with the bot's placement rate to count as changed
+    time.sleep(3)
+    out = run_bot(tmp_path, sim, preset, 4, '--checkpoint', 'ck.bin')
+    assert re.search(r'reusing 4 of 4 tiles', out), out
+
+# an error page is an error, not an empty chunk
+def test_chunk_errors_are_raised(sim_factory, monkeypatch):
+    sim = sim_factory('--chunk-error-rate', '1')
+    loader = ppfun2.ChunkLoader(requests.Session(), sim.url)
+    with pytest.raises(requests.HTTPError):
+        loader.fetch(0, 1, 1)
+    assert len(loader.chunks) == 0
+    monkeypatch.setattr(ppfun2, 'chunk_loader', loader)
+    store = ppfun2.CanvasStore(0, 65536)
+    with pytest.raises(requests.HTTPError):
+        store.load([(1, 1)])
+    assert store.keys() == []
+
+# updates that arrive while a tile is being downloaded end up in it
+def test_updates_during_downloads_are_kept(sim_factory, monkeypatch):
+    sim = sim_factory('--chunk-latency', '500')
+    loader = ppfun2.ChunkLoader(requests.Session(), sim.url)
+    monkeypatch.setattr(ppfun2, 'chunk_loader', loader)
+    store = ppfun2.CanvasStore(0, 65536)
+    thread = threading.Thread(target=store.load, args=([(1, 1)],))
+    thread.start()
+    time.sleep(0.2)
+    i, j, offs, c = np.array([1]), np.array([1]), np.array([0x0102]), np.array([7], np.uint8)
+    store.apply_many(i, j, offs, c)
+    loader.patch_many(0, i, j, offs, c)
+    thread.join()
+    assert store.tile((1, 1), load=False)[1, 2] == 7
+    assert loader.fetch(0, 1, 1, max_age=60)[0x0102] == 7
+    assert store.loading == {} and loader.loading == {}
+
+# a stored chunk is revalidated with a conditional request, and only downloaded again when it has changed
+def test_conditional_requests(sim, monkeypatch):
+    monkeypatch.setattr(ppfun2, 'metrics', ppfun2.Metrics())
+    def fetches(status):
+        return ppfun2.metrics.values.get(('chunk_fetches_total', (('status', status),)), 0)
+    loader = ppfun2.ChunkLoader(requests.Session(), sim.url)
+    assert place_as_other(sim, 0, 128, 128, 0x0101, 7) == 0
+    data = loader.fetch(0, 128, 128)
+    assert data[0x0101] == 7 and fetches(200) == 1
+    # young enough, no request at all
+    assert loader.fetch(0, 128, 128, max_age=60) == data and fetches('cached') == 1
+    # not modified, the stored copy is returned
+    assert loader.fetch(0, 128, 128) == data and fetches(304) == 1
+    assert place_as_other(sim, 0, 128, 128, 0x0102, 9) == 0
+    data = loader.fetch(0, 128, 128)
+    assert data[0x0101] == 7 and data[0x0102] == 9 and fetches(200) == 2 and fetches(304) == 1
+    # empty chunks are sent without any data, that's stored (and revalidated) too
+    assert loader.fetch(0, 1, 1) == b'' and loader.fetch(0, 1, 1) == b''
+    assert fetches(200) == 3 and fetches(304) == 2
+
+# only unpinned tiles are evicted, the least recently used first, and evicted tiles are downloaded again
+def test_eviction_keeps_pinned_tiles(sim, monkeypatch):
+    monkeypatch.setattr(ppfun2, 'chunk_loader', ppfun2.ChunkLoader(requests.Session(), sim.url))
+    store = ppfun2.CanvasStore(0, 65536, capacity=2)
+    pinned = [(0, 0), (0, 1)]
+    store.pin(pinned)
+    store.load(pinned)
+    store.load([(1, 0), (1, 1)])
+    store.tile((1, 0))
+    store.load([(1, 2)])
+    assert sorted(store.keys()) == [(0, 0), (0, 1), (1, 0), (1, 2)]
+    # a page of a huge template is done with
+    store.unpin([(0, 1)])
+    assert sorted(store.keys()) == [(0, 0), (1, 0), (1, 2)]
+    assert place_as_other(sim, 0, 0, 1, 0x0203, 9) == 0
+    assert store.tile((0, 1))[2, 3] == 9
+    assert sorted(store.keys()) == [(0, 0), (0, 1), (1, 2)]
+
+# connections that don't last make the bot back off more and more, and after every reconnect
+# it downloads the chunks that have probably changed (with a flood, all of them) and carries on drawing
+def test_reconnect_backoff_and_resync(tmp_path, sim_factory, preset):
+    sim = sim_factory('--flood', '200', '--disconnect-after', '3')
+    out = run_bot(tmp_path, sim, preset, 14)
+    assert 'Traceback' not in out, out
+    delays = [float(d) for d in re.findall(r'trying to reconnect in ([\d.]+)s', out)]
+    assert len(delays) >= 3, out
+    for n, delay in enumerate(delays):
+        assert delay <= ppfun2.RECONNECT_MIN_DELAY * 2 ** n
+    refreshed = re.findall(r'Reconnected after [\d.]+s, refreshed (\d+) of (\d+) chunks', out)
+    assert len(refreshed) >= 2 and all(n == total == '4' for n, total in refreshed), out
+    placements = re.findall(r'placements: ([\d.]+)/s', out)
+    assert len(placements) >= 2 and float(placements[-1]) > 0, out
+
+# a checkpoint holds the canvas as the server has it and the progress,
+# restoring it reuses the tiles that are current enough and downloads the rest
+def test_checkpoint_save_and_restore(tmp_path, sim, preset):
+    out = run_bot(tmp_path, sim, preset, 6, '--checkpoint', 'ck.bin')
+    assert 'Interrupting' in out, out
+    header, tiles = read_checkpoint(tmp_path / 'ck.bin')
+    keys = [(i, j) for i, j, _ in header['tiles']]
+    assert sorted(keys) == [(127, 127), (127, 128), (128, 127), (128, 128)]
+    loader = ppfun2.ChunkLoader(requests.Session(), sim.url)
+    for (i, j), tile in zip(keys, tiles):
+        chunk = np.frombuffer(loader.fetch(0, i, j).ljust(ppfun2.CHUNK_BYTES, b'\0'), np.uint8)
+        # (but a placement may have been made just before the bot was stopped)
+        assert np.count_nonzero(tile != chunk) <= 1
+    # one of the tiles is too old to be reused, and it has changed meanwhile
+    header['tiles'] = [[i, j, 0 if (i, j) == (128, 128) else t] for i, j, t in header['tiles']]
+    write_checkpoint(tmp_path / 'ck.bin', header, tiles)
+    assert place_as_other(sim, 0, 128, 128, 100 * 256 + 100, 9) == 0
+    out = run_bot(tmp_path, sim, preset, 4, '--checkpoint', 'ck.bin')
+    assert 'reusing 3 of 4 tiles' in out, out
+    restored, tiles = read_checkpoint(tmp_path / 'ck.bin')
+    keys = [(i, j) for i, j, _ in restored['tiles']]
+    assert tiles[keys.index((128, 128))][100 * 256 + 100] == 9
+    # the progress carries on from where it was
+    assert restored['pixels_drawn'] > header['pixels_drawn']
+    assert restored['drawing_time'] > header['drawing_time'] + 1
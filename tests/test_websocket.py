@@ -0,0 +1,214 @@
+# the RFC 6455 framing of WebSocketConnection, without a network
+
+import asyncio, ssl, struct, threading
+import pytest
+
+import ppfun2
+
+# collects what a connection writes
+class BufferWriter(object):
+    def __init__(self, error=None):
+        self.data = bytearray()
+        self.error = error
+        self.closed = False
+
+    def write(self, data):
+        if self.error is not None:
+            raise self.error
+        self.data += data
+
+    async def drain(self):
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.closed = True
+
+# a reader that fails like a broken connection does
+class FailingReader(object):
+    def __init__(self, error):
+        self.error = error
+
+    async def readexactly(self, n):
+        raise self.error
+
+def run(coro):
+    return asyncio.run(coro)
+
+# a connection that reads `data` and writes into a BufferWriter
+def connection(data=b'', client=True, eof=True):
+    async def make():
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        if eof:
+            reader.feed_eof()
+        return ppfun2.WebSocketConnection(reader, BufferWriter(), client)
+    return run(make())
+
+# the bytes of the frames a client (masked) or a server (unmasked) would send
+def frames(*frames, client=False):
+    conn = ppfun2.WebSocketConnection(None, BufferWriter(), client)
+    for opcode, payload in frames:
+        conn.write_frame(opcode, payload)
+    return bytes(conn.writer.data)
+
+# the same, but with the FIN bit of every frame set as given
+def fragments(*frames):
+    out = b''
+    for fin, opcode, payload in frames:
+        conn = ppfun2.WebSocketConnection(None, BufferWriter(), False)
+        conn.write_frame(opcode, payload)
+        data = bytearray(conn.writer.data)
+        if not fin:
+            data[0] &= 0x7F
+        out += bytes(data)
+    return out
+
+def test_mask_round_trip():
+    key = b'\x01\x02\x03\x04'
+    payload = bytes(range(11))
+    masked = ppfun2.ws_mask(payload, key)
+    assert masked == bytes(b ^ key[n % 4] for n, b in enumerate(payload))
+    assert ppfun2.ws_mask(masked, key) == payload
+    assert ppfun2.ws_mask(b'', key) == b''
+
+def test_accept_key():
+    # the example from RFC 6455
+    assert ppfun2.ws_accept_key('dGhlIHNhbXBsZSBub25jZQ==') == 's3pPLMBiTxaQ9kYGzzhZRbK+xOo='
+
+# clients mask their frames, servers don't
+def test_client_frames_are_masked():
+    data = frames((ppfun2.WS_OP_BINARY, b'hello'), client=True)
+    assert data[0] == 0x80 | ppfun2.WS_OP_BINARY
+    assert data[1] == 0x80 | 5
+    key = data[2:6]
+    assert ppfun2.ws_mask(data[6:], key) == b'hello'
+    assert frames((ppfun2.WS_OP_BINARY, b'hello')) == bytes([0x80 | ppfun2.WS_OP_BINARY, 5]) + b'hello'
+
+@pytest.mark.parametrize('client', [True, False])
+def test_binary_and_text_round_trip(client):
+    data = frames((ppfun2.WS_OP_BINARY, b'\x00\xC1\xFF'), (ppfun2.WS_OP_TEXT, 'привет'.encode()), client=client)
+    conn = connection(data, client=not client)
+    assert run(conn.recv()) == b'\x00\xC1\xFF'
+    assert run(conn.recv()) == 'привет'
+
+@pytest.mark.parametrize('n, length_bytes', [(125, 0), (126, 2), (65535, 2), (65536, 8), (70000, 8)])
+def test_length_forms(n, length_bytes):
+    payload = bytes(range(256)) * (n // 256) + bytes(n % 256)
+    data = frames((ppfun2.WS_OP_BINARY, payload))
+    if length_bytes == 0:
+        assert data[1] == n
+    elif length_bytes == 2:
+        assert data[1] == 126 and struct.unpack('>H', data[2:4])[0] == n
+    else:
+        assert data[1] == 127 and struct.unpack('>Q', data[2:10])[0] == n
+    assert len(data) == 2 + length_bytes + n
+    assert run(connection(data).recv()) == payload
+    # the same, masked
+    assert run(connection(frames((ppfun2.WS_OP_BINARY, payload), client=True), client=False).recv()) == payload
+
+# a message split into a first frame and continuations, with a ping in between
+def test_fragmentation():
+    data = fragments((False, ppfun2.WS_OP_TEXT, b'abc'),
+                     (True, ppfun2.WS_OP_PING, b'p'),
+                     (False, ppfun2.WS_OP_CONT, b'def'),
+                     (True, ppfun2.WS_OP_CONT, b'ghi'),
+                     (True, ppfun2.WS_OP_BINARY, b'next'))
+    conn = connection(data)
+    assert run(conn.recv()) == 'abcdefghi'
+    assert run(conn.recv()) == b'next'
+    pong = bytes(conn.writer.data)
+    assert pong[0] == 0x80 | ppfun2.WS_OP_PONG
+    assert ppfun2.ws_mask(pong[6:], pong[2:6]) == b'p'
+
+def test_ping_is_answered_with_pong():
+    conn = connection(frames((ppfun2.WS_OP_PING, b'1234'), (ppfun2.WS_OP_BINARY, b'x')), client=False)
+    assert run(conn.recv()) == b'x'
+    assert bytes(conn.writer.data) == bytes([0x80 | ppfun2.WS_OP_PONG, 4]) + b'1234'
+
+def test_pongs_are_ignored():
+    conn = connection(frames((ppfun2.WS_OP_PONG, b'1'), (ppfun2.WS_OP_BINARY, b'x')))
+    assert run(conn.recv()) == b'x'
+    assert conn.writer.data == b''
+
+# a close frame is answered with the same status code and the connection is closed
+def test_close_from_the_other_side():
+    conn = connection(frames((ppfun2.WS_OP_CLOSE, struct.pack('>H', 1001) + b'going away')), client=False)
+    with pytest.raises(ppfun2.ConnectionClosedError):
+        run(conn.recv())
+    assert conn.closed
+    assert bytes(conn.writer.data) == bytes([0x80 | ppfun2.WS_OP_CLOSE, 2]) + struct.pack('>H', 1001)
+    with pytest.raises(ppfun2.ConnectionClosedError):
+        conn.send_binary(b'x')
+
+def test_close():
+    conn = connection(client=False)
+    run(conn.close())
+    assert bytes(conn.writer.data) == bytes([0x80 | ppfun2.WS_OP_CLOSE, 2]) + struct.pack('>H', 1000)
+    assert conn.closed and conn.writer.closed
+    # closing again doesn't send anything
+    run(conn.close())
+    assert len(conn.writer.data) == 4
+
+@pytest.mark.parametrize('data', [b'', b'\x82', b'\x82\x05abc', b'\x82\x7e\x01', b'\x82\x85\x01\x02'])
+def test_truncated_frames(data):
+    conn = connection(data)
+    with pytest.raises(ppfun2.ConnectionClosedError):
+        run(conn.recv())
+    assert conn.closed
+
+# whatever the socket fails with ends up as a ConnectionClosedError
+@pytest.mark.parametrize('error', [ConnectionResetError(), ssl.SSLError('bad record mac'), TimeoutError(), OSError(113, 'No route to host')])
+def test_socket_errors(error):
+    conn = ppfun2.WebSocketConnection(FailingReader(error), BufferWriter(), True)
+    with pytest.raises(ppfun2.ConnectionClosedError):
+        run(conn.recv())
+    assert conn.closed
+    conn = ppfun2.WebSocketConnection(None, BufferWriter(error), True)
+    with pytest.raises(ppfun2.ConnectionClosedError):
+        conn.send_binary(b'x')
+    assert conn.closed
+
+# a frame header claiming a huge payload is refused before anything is allocated
+@pytest.mark.parametrize('head', [b'\x82\x7f' + struct.pack('>Q', 1 << 40), b'\x82\x7f' + struct.pack('>Q', ppfun2.WS_MAX_MESSAGE + 1)])
+def test_too_big_frames(head):
+    conn = connection(head, eof=False)
+    with pytest.raises(ppfun2.ConnectionClosedError):
+        run(conn.recv())
+    assert conn.closed
+    assert ppfun2.ws_mask(bytes(conn.writer.data[6:]), conn.writer.data[2:6]) == struct.pack('>H', ppfun2.WS_CLOSE_TOO_BIG)
+
+# the same for a message of fragments that are small enough on their own
+def test_too_big_messages():
+    part = bytes(ppfun2.WS_MAX_MESSAGE // 2)
+    conn = connection(fragments((False, ppfun2.WS_OP_BINARY, part), (False, ppfun2.WS_OP_CONT, part),
+                                (True, ppfun2.WS_OP_CONT, b'x')))
+    with pytest.raises(ppfun2.ConnectionClosedError):
+        run(conn.recv())
+    assert ppfun2.ws_mask(bytes(conn.writer.data[6:]), conn.writer.data[2:6]) == struct.pack('>H', ppfun2.WS_CLOSE_TOO_BIG)
+
+# messages sent from other threads are written (and drained) by the event loop, and failures reach the sender
+def test_async_client_send_from_another_thread():
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    try:
+        client = ppfun2.AsyncClient()
+        client.loop = loop
+        client.conn = ppfun2.WebSocketConnection(None, BufferWriter(), True)
+        client.send_binary(b'ok')
+        assert len(client.conn.writer.data) == 2 + 4 + 2
+        client.conn.writer.error = ConnectionResetError()
+        with pytest.raises(ppfun2.ConnectionClosedError):
+            client.send_binary(b'x')
+        assert not client.connected and client.conn.writer.closed
+        with pytest.raises(ppfun2.ConnectionClosedError):
+            client.send_binary(b'x')
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+    # the loop is gone
+    loop.close()
+    client.conn = ppfun2.WebSocketConnection(None, BufferWriter(), True)
+    with pytest.raises(ppfun2.ConnectionClosedError):
+        client.send_binary(b'x')